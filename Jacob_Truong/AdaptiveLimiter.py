@@ -0,0 +1,168 @@
+import threading
+import time
+import logging
+from contextlib import contextmanager
+
+class AdaptiveLimiter():
+    """
+    A class that limits the number of calls in flight to a service with AIMD (additive increase, multiplicative decrease),
+    like TCP congestion control: the limit grows by one call per round of successful calls while latency is stable,
+    and is cut sharply when the service pushes back (e.g. 429 or 503) or latency spikes.
+    Calls beyond the limit wait in the order they arrived until a slot frees up.
+    Calls that time out or lose their connection count as pushback as well, and calls failing otherwise leave the limit as it is.
+    Latency is compared per kind of call (e.g. per pipeline stage), so that slow vision calls do not count as spikes of fast text calls.
+    NOTE: A limiter is safe to share between threads, and is meant to be shared by every call to the same service (e.g. one Gemini model).
+    """
+
+    # Names of the exception classes of calls that timed out or lost their connection, which count as congestion. They are
+    # matched by name, as every client library has its own (e.g. httpx.ReadTimeout, httpx.ConnectError, requests.ConnectionError).
+    CONGESTION_ERRORS = ("TimeoutError", "TimeoutException", "Timeout", "ConnectError", "ConnectionError", "ReadError",
+                         "RemoteProtocolError")
+
+    def __init__(self, name: str = "", initial_limit: int = 4, min_limit: int = 1, max_limit: int = 32,
+                 decrease_factor: float = 0.5, latency_tolerance: float = 2.0, smoothing: float = 0.1):
+        """
+        Initialise the limiter.
+
+        Args:
+            name (str): The name of the service, for logging.
+            initial_limit (int): The number of calls allowed in flight at first.
+            min_limit (int): The lowest the limit is cut to.
+            max_limit (int): The highest the limit grows to.
+            decrease_factor (float): The factor the limit is multiplied by when the service pushes back or latency spikes.
+            latency_tolerance (float): How many times slower than the smoothed latency a call has to be to count as a spike.
+            smoothing (float): The weight of each new latency in the smoothed latency (exponentially weighted moving average).
+        """
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.smoothing = smoothing
+
+        # NOTE: The limit is kept as a float so that it can grow by a fraction of a call per success (one call per full round).
+        self._limit = float(min(max(initial_limit, min_limit), max_limit))
+        self._in_flight = 0
+        # Smoothed latency per kind of call, see release()
+        self._smoothed_latency_s = {}
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+        # Tickets keep the waiting calls in arrival order
+        self._next_ticket = 0
+        self._serving_ticket = 0
+
+    @property
+    def limit(self) -> int:
+        """The number of calls currently allowed in flight."""
+        return int(self._limit)
+
+    @property
+    def in_flight(self) -> int:
+        """The number of calls currently in flight."""
+        return self._in_flight
+
+    def acquire(self) -> tuple[float, float]:
+        """
+        Waits for a free slot and takes it. Every acquire() must be followed by one release().
+
+        Returns:
+            tuple[float, float]: The time the call waited in the queue in seconds, and the time the slot was taken (to pass to release()).
+        """
+        start = time.monotonic()
+        with self._condition:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            while ticket != self._serving_ticket or self._in_flight >= int(self._limit):
+                self._condition.wait()
+            self._serving_ticket += 1
+            self._in_flight += 1
+            # The next call in line may fit as well
+            self._condition.notify_all()
+        acquired_at = time.monotonic()
+        return acquired_at - start, acquired_at
+
+    @classmethod
+    def is_congestion(cls, error: BaseException) -> bool:
+        """Checks whether a call failed by timing out or losing its connection, see CONGESTION_ERRORS."""
+        return any(error_class.__name__ in cls.CONGESTION_ERRORS for error_class in type(error).__mro__)
+
+    def release(self, acquired_at: float, overloaded: bool = False, failed: bool = False, latency_key: str | None = None) -> None:
+        """
+        Frees a slot and adapts the limit to how the call went.
+
+        Args:
+            acquired_at (float): The time the slot was taken, as returned by acquire().
+            overloaded (bool): True if the service pushed back on the call (e.g. 429 or 503), or the call timed out or lost its connection.
+            failed (bool): True if the call failed otherwise. The limit is then neither grown nor cut.
+            latency_key (str | None): The kind of call (e.g. its pipeline stage). Its latency is only compared with calls of the same kind.
+        """
+        latency_s = time.monotonic() - acquired_at
+        with self._condition:
+            self._in_flight -= 1
+
+            smoothed_latency_s = self._smoothed_latency_s.get(latency_key)
+            spike = not overloaded and not failed and smoothed_latency_s is not None and latency_s > self.latency_tolerance * smoothed_latency_s
+            if overloaded or spike:
+                # NOTE: Calls that were already in flight when the limit was last cut saw the old limit, so they do not cut it again.
+                if acquired_at > self._last_decrease:
+                    self._decrease("overloaded" if overloaded else f"latency spike ({latency_s:.2f}s)")
+            elif not failed:
+                self._limit = min(self._limit + 1.0 / self._limit, float(self.max_limit))
+
+            # Only the latency of calls the service actually served is representative
+            if not overloaded and not failed:
+                self._smoothed_latency_s[latency_key] = latency_s if smoothed_latency_s is None else \
+                    (1 - self.smoothing) * smoothed_latency_s + self.smoothing * latency_s
+
+            self._condition.notify_all()
+
+    def _decrease(self, reason: str) -> None:
+        """Cuts the limit. Must be called with the condition held."""
+        previous_limit = int(self._limit)
+        self._limit = max(self._limit * self.decrease_factor, float(self.min_limit))
+        self._last_decrease = time.monotonic()
+        if int(self._limit) != previous_limit:
+            logging.warning(f"Cut the concurrency limit of {self.name} from {previous_limit} to {int(self._limit)}: {reason}.")
+
+    @contextmanager
+    def slot(self, latency_key: str | None = None):
+        """
+        Holds a slot for the duration of the block. The yielded dict holds the queue wait ("queue_wait_s"), and the block can set
+        "overloaded" on it when the service pushed back. An exception raised in the block counts as pushback if the call timed
+        out or lost its connection (see is_congestion()), and as a failure that leaves the limit as it is otherwise.
+
+        Args:
+            latency_key (str | None): The kind of call, see release().
+
+        Yields:
+            dict: The slot.
+        """
+        queue_wait_s, acquired_at = self.acquire()
+        slot = {"queue_wait_s": queue_wait_s, "overloaded": False}
+        failed = False
+        try:
+            yield slot
+        except BaseException as e:
+            if self.is_congestion(e):
+                slot["overloaded"] = True
+            else:
+                failed = not slot["overloaded"]
+            raise
+        finally:
+            self.release(acquired_at, overloaded=slot["overloaded"], failed=failed, latency_key=latency_key)
+
+    def stats(self) -> dict:
+        """
+        Summarises the state of the limiter.
+
+        Returns:
+            dict: The current limit, the calls in flight and waiting, and the smoothed latency in seconds per kind of call.
+        """
+        with self._condition:
+            return {
+                "limit": int(self._limit),
+                "in_flight": self._in_flight,
+                "waiting": self._next_ticket - self._serving_ticket,
+                "smoothed_latency_s": {str(key): round(latency_s, 4) for key, latency_s in self._smoothed_latency_s.items()}
+            }
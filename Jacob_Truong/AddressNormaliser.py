@@ -0,0 +1,59 @@
+import re
+import unicodedata
+
+class AddressNormaliser():
+    """
+    A class to reduce the different spellings of an address to one canonical key, so that equivalent addresses
+    (e.g. "100 Main Boulevard, Suite 200, Tyler, TX 75701, USA" and "100 main blvd tyler tx 75701") are recognised as the same location.
+    NOTE: The key is only used for matching and fingerprinting. The address sent to Google Maps is always an original spelling.
+    """
+
+    # Common street types, directions and words spelled out or abbreviated, mapped to their USPS-style abbreviation
+    ABBREVIATIONS = {
+        "street": "st", "str": "st", "avenue": "ave", "av": "ave", "boulevard": "blvd", "road": "rd", "drive": "dr",
+        "highway": "hwy", "hiway": "hwy", "lane": "ln", "court": "ct", "place": "pl", "parkway": "pkwy", "expressway": "expy",
+        "freeway": "fwy", "circle": "cir", "terrace": "ter", "square": "sq", "crescent": "cres", "close": "cl",
+        "north": "n", "south": "s", "east": "e", "west": "w", "northeast": "ne", "northwest": "nw", "southeast": "se", "southwest": "sw",
+        "mount": "mt", "saint": "st", "farm-to-market": "fm", "interstate": "i"
+    }
+
+    # Country names that are dropped when they end the address, as they do not change the location
+    TRAILING_COUNTRIES = (
+        ("united", "states", "of", "america"), ("united", "states"), ("usa",), ("us",), ("united", "kingdom"), ("uk",),
+        ("australia",), ("singapore",), ("canada",), ("germany",), ("viet", "nam"), ("vietnam",)
+    )
+
+    # Suite, unit and floor designators with their number (e.g. "Suite 200", "Ste. 4B", "Unit C", "Level 3", "#03-01").
+    # NOTE: A designator is only dropped together with a unit id, i.e. a number or a single letter, and never when a street type
+    # follows, as the same words also name streets (e.g. "12 Unit Street", "3 Level Crossing Rd", "5 Room Ave").
+    # "fl" is deliberately not included, as it is also the abbreviation of Florida.
+    _STREET_TYPES = ("st|street|ave|avenue|av|rd|road|blvd|boulevard|dr|drive|hwy|highway|ln|lane|ct|court|pl|place|pkwy|parkway|"
+                     "cres|crescent|cl|close|cir|circle|ter|terrace|sq|square|way|crossing|expy|fwy|loop")
+    _SUB_PREMISE = re.compile(r"(?:\b(?:suite|ste|unit|apt|apartment|room|rm|floor|level|lvl)\b\.?\s*#?\s*(?:\d[\w-]*|[a-z]\d*)|#\s*\d[\w-]*)\b"
+                              rf"(?!\s+(?:{_STREET_TYPES})\b)")
+    _ZIP_PLUS_FOUR = re.compile(r"\b(\d{5})-\d{4}\b")
+    _PUNCTUATION = re.compile(r"[^\w\s/-]")
+
+    @classmethod
+    def normalise(cls, address: str) -> str:
+        """
+        Normalises an address to its canonical key.
+
+        Args:
+            address (str): The address to normalise.
+
+        Returns:
+            str: The canonical key, e.g. "100 main blvd tyler tx 75701".
+        """
+        text = unicodedata.normalize("NFKC", str(address)).casefold()
+        text = cls._SUB_PREMISE.sub(" ", text)
+        text = cls._ZIP_PLUS_FOUR.sub(r"\1", text)
+        text = cls._PUNCTUATION.sub(" ", text)
+
+        tokens = [cls.ABBREVIATIONS.get(token, token) for token in text.split()]
+        for country in cls.TRAILING_COUNTRIES:
+            if len(tokens) > len(country) and tuple(tokens[-len(country):]) == country:
+                tokens = tokens[:-len(country)]
+                break
+
+        return " ".join(tokens).strip(" -/")
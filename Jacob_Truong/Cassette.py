@@ -0,0 +1,618 @@
+import base64
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+import logging
+from datetime import datetime
+from pathlib import Path
+
+from Metrics import metrics
+
+class CassetteMiss(Exception):
+    """
+    Raised when a request replayed from a cassette was never recorded.
+    """
+
+
+class Cassette():
+    """
+    A class that records every external request of the pipeline (website pages, Google Maps geocodes and static maps, and
+    Gemini requests including its context caches) together with its response, and replays them offline, so that a run can be
+    reproduced exactly (e.g. to investigate a bad report, or to benchmark an optimisation on the same inputs) without
+    touching the network.
+    Requests are recorded into one cassette per company, a gzip-compressed JSON file under <cassette_dir>/<company_slug>.json.gz,
+    keyed by a hash of the request. Failed requests are recorded and replayed as failures too. A request made more than once is
+    replayed in the order it was recorded, repeating the last response once they run out.
+    The cassette is used by the API clients of the client registry (see ClientRegistry.use_cassette()), which wrap the pages
+    session, the Google Maps client and the Gemini client with it, and by the clock of the registry (see ClientRegistry.now()).
+    The company of a request comes from the metrics tags.
+    NOTE: A replayed request missing from the cassette of its company is looked up in the other cassettes of the directory, as
+    a location shared by several companies is only geocoded and imaged for the first of them (see LocationIndex). Requests
+    missing from every cassette fail the way an unreachable service would, and are listed by format_summary().
+    """
+
+    RECORD = "record"
+    REPLAY = "replay"
+
+    # Bump this whenever the format of the recorded requests or responses changes, so that old cassettes are no longer replayed.
+    CASSETTE_VERSION = 1
+
+    # Requests made outside of any company (e.g. by the report service before a job) are recorded under this name
+    SHARED = "_shared"
+
+    def __init__(self, cassette_dir: str, mode: str):
+        """
+        Initialise the cassette. Recorded requests are only written by save().
+
+        Args:
+            cassette_dir (str): Directory the cassettes are written to or replayed from.
+            mode (str): RECORD to make the requests and record them, or REPLAY to answer them from the cassettes.
+
+        Raises:
+            ValueError: If the mode is unknown, or there is nothing to replay in the directory.
+        """
+        if mode not in (self.RECORD, self.REPLAY):
+            raise ValueError(f"Unknown cassette mode {mode!r}, expected {self.RECORD!r} or {self.REPLAY!r}.")
+        self.cassette_path = Path(cassette_dir)
+        self.mode = mode
+        if mode == self.REPLAY and not any(self.cassette_path.glob("*.json.gz")):
+            raise ValueError(f"No cassettes to replay in {self.cassette_path}.")
+
+        # Recorded or loaded interactions per company, keyed by request hash, each a list of responses in the order they were made
+        self._interactions = {}
+        # The next response to replay per company and request hash
+        self._cursors = {}
+        self._loaded_all = False
+        self.replayed = 0
+        self.misses = []
+        self._lock = threading.Lock()
+
+    @property
+    def replaying(self) -> bool:
+        """Whether the requests are answered from the cassettes rather than made."""
+        return self.mode == self.REPLAY
+
+    @staticmethod
+    def _company() -> str:
+        """The company of the current context, see Metrics.tags()."""
+        return metrics.current_tags()["company"] or Cassette.SHARED
+
+    def _file_path(self, company: str) -> Path:
+        """Builds the file path of the cassette of a company."""
+        return self.cassette_path / f"{re.sub(r'[^A-Za-z0-9_.-]', '_', company)}.json.gz"
+
+    @staticmethod
+    def request_key(service: str, request: dict) -> str:
+        """
+        Hashes a request, so that the same request is found again whatever the process or the order of the calls.
+
+        Args:
+            service (str): The service the request is made to (http, maps or gemini).
+            request (dict): Everything that determines the response (e.g. the URL, or the model, contents and config).
+
+        Returns:
+            str: The key of the request.
+        """
+        payload = json.dumps({"service": service, **request}, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+    def _load(self, path: Path) -> dict:
+        """
+        Loads the interactions of a cassette file.
+
+        Args:
+            path (Path): The cassette file.
+
+        Returns:
+            dict: The interactions, or an empty dict if the file is missing, unreadable or from an older version.
+        """
+        if not path.exists():
+            return {}
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                cassette = json.load(f)
+        except (OSError, EOFError, json.JSONDecodeError) as e:
+            logging.warning(f"Ignoring unreadable cassette {path}: {e}")
+            return {}
+        if cassette.get("version") != self.CASSETTE_VERSION:
+            logging.warning(f"Ignoring outdated cassette {path}.")
+            return {}
+        return cassette["interactions"]
+
+    def _find(self, company: str, key: str) -> tuple[str, list] | None:
+        """
+        Finds the recorded responses of a request, in the cassette of its company first. Must be called with the lock held.
+
+        Returns:
+            tuple[str, list] | None: The company whose cassette holds the request and its responses, or None if it was never recorded.
+        """
+        if company not in self._interactions:
+            self._interactions[company] = self._load(self._file_path(company))
+        if key in self._interactions[company]:
+            return company, self._interactions[company][key]
+
+        if not self._loaded_all:
+            for path in sorted(self.cassette_path.glob("*.json.gz")):
+                other = path.name.removesuffix(".json.gz")
+                if other not in self._interactions:
+                    self._interactions[other] = self._load(path)
+            self._loaded_all = True
+        for other, interactions in self._interactions.items():
+            if key in interactions:
+                return other, interactions[key]
+        return None
+
+    def _replay(self, service: str, request: dict, description: str) -> dict:
+        """
+        Takes the next recorded response of a request.
+
+        Args:
+            service (str): The service the request is made to.
+            request (dict): The request, see request_key().
+            description (str): A short description of the request (e.g. its URL), for the list of misses.
+
+        Returns:
+            dict: The recorded entry, with the response under "response" or the failure under "error".
+
+        Raises:
+            CassetteMiss: If the request was never recorded.
+        """
+        company = self._company()
+        key = self.request_key(service, request)
+        with self._lock:
+            found = self._find(company, key)
+            if found is None:
+                self.misses.append({"company": company, "service": service, "request": description})
+            else:
+                owner, entries = found
+                cursor = self._cursors.get((owner, key), 0)
+                self._cursors[(owner, key)] = cursor + 1
+                self.replayed += 1
+                return entries[min(cursor, len(entries) - 1)]
+
+        logging.warning(f"Cassette miss for {company}: {service} {description}")
+        raise CassetteMiss(f"{service} request not in the cassette: {description}")
+
+    def record(self, service: str, request: dict, entry: dict) -> None:
+        """
+        Records the response (or failure) of a request under the company of the current context.
+
+        Args:
+            service (str): The service the request was made to.
+            request (dict): The request, see request_key().
+            entry (dict): The JSON-serialisable response under "response", or the failure under "error".
+        """
+        company = self._company()
+        key = self.request_key(service, request)
+        with self._lock:
+            self._interactions.setdefault(company, {}).setdefault(key, []).append(entry)
+
+    @staticmethod
+    def describe_error(error: Exception) -> dict:
+        """
+        Describes a failed request, so that it can be raised again on replay.
+
+        Args:
+            error (Exception): The exception the request failed with.
+
+        Returns:
+            dict: The exception type and message, and its status code, if any.
+        """
+        message = getattr(error, "message", None)
+        described = {"type": type(error).__name__, "message": message if isinstance(message, str) else str(error)}
+        for field in ("code", "status"):
+            value = getattr(error, field, None)
+            if isinstance(value, (int, str)):
+                described[field] = value
+        return described
+
+    def call(self, service: str, request: dict, make_request, description: str, encode=None, decode=None, to_error=None):
+        """
+        Makes a request through the cassette: in record mode the request is made and its response recorded, in replay mode
+        the recorded response is returned instead.
+
+        Args:
+            service (str): The service the request is made to (http, maps or gemini).
+            request (dict): Everything that determines the response, see request_key().
+            make_request (Callable): Makes the request and returns its response. Only called in record mode.
+            description (str): A short description of the request, for the list of misses.
+            encode (Callable | None): Turns the response into JSON for the cassette.
+            decode (Callable | None): Turns the recorded JSON back into the response.
+            to_error (Callable | None): Builds the exception to raise for a recorded failure (see describe_error()), e.g. the
+                exception type of the client library, so that the callers handle it as before.
+
+        Returns:
+            The response.
+
+        Raises:
+            CassetteMiss: If the request was never recorded (replay mode).
+        """
+        if self.replaying:
+            entry = self._replay(service, request, description)
+            if "error" in entry:
+                raise to_error(entry["error"]) if to_error else RuntimeError(entry["error"]["message"])
+            return decode(entry["response"]) if decode else entry["response"]
+
+        try:
+            response = make_request()
+        except Exception as e:
+            self.record(service, request, {"error": self.describe_error(e)})
+            raise
+        self.record(service, request, {"response": encode(response) if encode else response})
+        return response
+
+    def save(self) -> list[str]:
+        """
+        Writes the cassette of every company recorded so far, replacing any older recording of the company. Each file is written
+        to a temporary path first and then moved into place, so that a crash mid-write never leaves a truncated cassette behind.
+
+        Returns:
+            list[str]: The paths of the cassettes written. Nothing is written in replay mode.
+        """
+        if self.replaying:
+            return []
+
+        with self._lock:
+            interactions = {company: dict(company_interactions) for company, company_interactions in self._interactions.items()}
+
+        self.cassette_path.mkdir(parents=True, exist_ok=True)
+        paths = []
+        for company, company_interactions in interactions.items():
+            cassette = {
+                "version": self.CASSETTE_VERSION,
+                "company": company,
+                "recorded_at": datetime.now().isoformat(timespec="seconds"),
+                "interactions": company_interactions
+            }
+            path = self._file_path(company)
+            tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+                json.dump(cassette, f, ensure_ascii=False, separators=(",", ":"))
+            os.replace(tmp_path, path)
+            paths.append(str(path))
+
+        logging.info(f"Wrote {len(paths)} cassettes to {self.cassette_path}")
+        return paths
+
+    def format_summary(self) -> str:
+        """
+        Summarises the requests recorded, or the requests replayed and every request that missed the cassettes.
+
+        Returns:
+            str: The summary, with one line per missed request.
+        """
+        if not self.replaying:
+            with self._lock:
+                counts = {company: sum(len(entries) for entries in interactions.values()) for company, interactions in self._interactions.items()}
+            return f"Recorded {sum(counts.values())} requests of {len(counts)} companies to {self.cassette_path}."
+
+        with self._lock:
+            misses = list(self.misses)
+        lines = [f"Replayed {self.replayed} requests from {self.cassette_path}, {len(misses)} missed the cassettes" + (":" if misses else ".")]
+        lines.extend(f"  - {miss['company']} / {miss['service']}: {miss['request']}" for miss in misses)
+        return "\n".join(lines)
+
+    def now(self) -> datetime:
+        """
+        The current time, recorded like a request, so that a replayed report carries the date and time of the recording
+        rather than those of the replay (which would also change the report prompt, and so miss the cassette).
+
+        Returns:
+            datetime: The current time when recording, or the recorded one when replaying.
+        """
+        return self.call("clock", {"operation": "now"}, datetime.now, "now", encode=datetime.isoformat, decode=datetime.fromisoformat)
+
+    def wrap_session(self, session) -> "_CassetteSession":
+        """
+        Wraps the requests session the website pages are fetched with.
+
+        Args:
+            session (requests.Session): The session, only used in record mode.
+
+        Returns:
+            _CassetteSession: The session recording or replaying the pages.
+        """
+        return _CassetteSession(self, session)
+
+    def wrap_maps(self, make_client) -> "_CassetteMapsClient":
+        """
+        Wraps the Google Maps client.
+
+        Args:
+            make_client (Callable): Builds the googlemaps.Client, only called for the first request made in record mode.
+
+        Returns:
+            _CassetteMapsClient: The client recording or replaying the geocodes and static maps.
+        """
+        return _CassetteMapsClient(self, make_client)
+
+    def wrap_gemini(self, make_client) -> "_CassetteGenaiClient":
+        """
+        Wraps the Gemini client.
+
+        Args:
+            make_client (Callable): Builds the genai.Client, only called for the first request made in record mode.
+
+        Returns:
+            _CassetteGenaiClient: The client recording or replaying the generate_content and context cache requests.
+        """
+        return _CassetteGenaiClient(self, make_client)
+
+    @staticmethod
+    def add_arguments(parser) -> None:
+        """
+        Adds the record and replay options shared by the runners to an argument parser.
+
+        Args:
+            parser (argparse.ArgumentParser): The parser of a runner.
+        """
+        group = parser.add_mutually_exclusive_group()
+        group.add_argument('--record', default=None, metavar='DIR',
+                           help='Record every page, Maps and Gemini request and its response into one cassette per company in DIR')
+        group.add_argument('--replay', default=None, metavar='DIR',
+                           help='Answer every request from the cassettes in DIR instead of the network, and list the requests they miss')
+
+    @classmethod
+    def from_args(cls, args, parser) -> "Cassette | None":
+        """
+        Builds the cassette from the options added by add_arguments().
+
+        Args:
+            args (argparse.Namespace): The parsed arguments.
+            parser (argparse.ArgumentParser): The parser, to report an invalid option.
+
+        Returns:
+            Cassette | None: The cassette, or None if neither option was given.
+        """
+        if not args.record and not args.replay:
+            return None
+        try:
+            return cls(args.record, cls.RECORD) if args.record else cls(args.replay, cls.REPLAY)
+        except ValueError as e:
+            parser.error(str(e))
+
+
+class _CassetteResponse():
+    """
+    A page response replayed from a cassette, with the parts of requests.Response used by the pipeline.
+    """
+
+    def __init__(self, url: str, entry: dict):
+        from requests.structures import CaseInsensitiveDict
+
+        self.url = url
+        self.status_code = entry["status"]
+        self.reason = entry.get("reason", "")
+        self.headers = CaseInsensitiveDict(entry.get("headers", {}))
+        self.content = entry["text"].encode("utf-8") if "text" in entry else base64.b64decode(entry.get("body_b64", ""))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self) -> None:
+        pass
+
+    def raise_for_status(self) -> None:
+        import requests
+
+        if self.status_code >= 400:
+            kind = "Client" if self.status_code < 500 else "Server"
+            raise requests.HTTPError(f"{self.status_code} {kind} Error: {self.reason} for url: {self.url}", response=self)
+
+    def iter_content(self, chunk_size: int = 1):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+
+class _RecordingResponse():
+    """
+    A live page response that records its status, headers and the part of the body that was read once it is closed.
+    NOTE: Only what the pipeline reads is recorded (e.g. not the rest of a page cut off at MAX_PAGE_BYTES, or the body of
+    a PDF dropped on its Content-Type), which is also all that is replayed.
+    """
+
+    def __init__(self, response, record):
+        self._response = response
+        self._record = record
+        self._chunks = []
+        self._recorded = False
+
+    def __getattr__(self, name: str):
+        return getattr(self._response, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def iter_content(self, chunk_size: int = 1):
+        for chunk in self._response.iter_content(chunk_size=chunk_size):
+            self._chunks.append(chunk)
+            yield chunk
+
+    def close(self) -> None:
+        if not self._recorded:
+            self._recorded = True
+            body = b"".join(self._chunks)
+            entry = {"status": self._response.status_code, "reason": self._response.reason or "",
+                     "headers": {name: value for name, value in self._response.headers.items() if name.lower() in ("content-type", "content-length")}}
+            try:
+                entry["text"] = body.decode("utf-8")
+            except UnicodeDecodeError:
+                entry["body_b64"] = base64.b64encode(body).decode("ascii")
+            self._record({"response": entry})
+        self._response.close()
+
+
+class _CassetteSession():
+    """
+    A requests session that records or replays the GET requests of the website pages. Anything else is passed on to the session.
+    """
+
+    def __init__(self, cassette: Cassette, session):
+        self._cassette = cassette
+        self._session = session
+
+    def __getattr__(self, name: str):
+        return getattr(self._session, name)
+
+    def get(self, url: str, **kwargs):
+        import requests
+
+        request = {"method": "GET", "url": url}
+        if self._cassette.replaying:
+            try:
+                entry = self._cassette._replay("http", request, url)
+            except CassetteMiss as e:
+                raise requests.ConnectionError(str(e))
+            if "error" in entry:
+                error = entry["error"]
+                raise getattr(requests.exceptions, error["type"], requests.RequestException)(error["message"])
+            return _CassetteResponse(url, entry["response"])
+
+        try:
+            response = self._session.get(url, **kwargs)
+        except requests.RequestException as e:
+            self._cassette.record("http", request, {"error": Cassette.describe_error(e)})
+            raise
+        # NOTE: The response is recorded when it is closed, in the context of the caller, which is that of its company
+        return _RecordingResponse(response, lambda entry: self._cassette.record("http", request, entry))
+
+
+class _CassetteMapsClient():
+    """
+    A googlemaps.Client recording or replaying the geocode and static_map requests.
+    """
+
+    def __init__(self, cassette: Cassette, make_client):
+        self._cassette = cassette
+        self._make_client = make_client
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = self._make_client()
+        return self._client
+
+    @staticmethod
+    def _to_error(error: dict) -> Exception:
+        import googlemaps
+
+        if error["type"] == "ApiError" and "status" in error:
+            return googlemaps.exceptions.ApiError(error["status"], error["message"])
+        if error["type"] == "Timeout":
+            return googlemaps.exceptions.Timeout(error["message"])
+        return googlemaps.exceptions.TransportError(error["message"])
+
+    def _call(self, request: dict, make_request, description: str, encode=None, decode=None):
+        try:
+            return self._cassette.call("maps", request, make_request, description, encode=encode, decode=decode, to_error=self._to_error)
+        except CassetteMiss as e:
+            import googlemaps
+            raise googlemaps.exceptions.TransportError(str(e))
+
+    def geocode(self, address: str, **kwargs) -> list:
+        return self._call({"operation": "geocode", "address": address, **kwargs}, lambda: self.client.geocode(address, **kwargs),
+                          f"geocode {address}")
+
+    def static_map(self, **kwargs):
+        # NOTE: The image is read whole while recording, as the pipeline joins it anyway, and replayed as a single chunk
+        image_data = self._call({"operation": "static_map", **kwargs}, lambda: b"".join(self.client.static_map(**kwargs)),
+                                f"static_map {kwargs.get('center')}",
+                                encode=lambda data: base64.b64encode(data).decode("ascii"), decode=base64.b64decode)
+        return iter([image_data])
+
+
+class _CassetteGenaiClient():
+    """
+    A genai.Client recording or replaying the generate_content and context cache requests.
+    """
+
+    def __init__(self, cassette: Cassette, make_client):
+        self._cassette = cassette
+        self._make_client = make_client
+        self._client = None
+        self.models = _CassetteModels(self)
+        self.caches = _CassetteCaches(self)
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = self._make_client()
+        return self._client
+
+    @staticmethod
+    def dump(value):
+        """Turns the contents or config of a request into JSON, leaving out the per-request HTTP options (e.g. the timeout)."""
+        if value is None or isinstance(value, (str, int, float, bool)):
+            return value
+        if isinstance(value, (list, tuple)):
+            return [_CassetteGenaiClient.dump(item) for item in value]
+        return value.model_dump(mode="json", exclude_none=True, exclude={"http_options"})
+
+    @staticmethod
+    def _to_error(error: dict) -> Exception:
+        from google.genai import errors
+
+        if "code" in error and isinstance(error["code"], int):
+            error_type = errors.ClientError if error["code"] < 500 else errors.ServerError
+            return error_type(error["code"], {"error": {"code": error["code"], "message": error["message"], "status": error.get("status")}})
+        return RuntimeError(error["message"])
+
+    def call(self, operation: str, request: dict, make_request, description: str, response_type):
+        """Makes a request through the cassette, turning the response into JSON and back into its genai type."""
+        encode = lambda response: response.model_dump(mode="json", exclude_none=True) if response is not None else None
+        decode = lambda data: response_type.model_validate(data) if data is not None else None
+        return self._cassette.call("gemini", {"operation": operation, **request}, make_request, description,
+                                   encode=encode, decode=decode, to_error=self._to_error)
+
+
+class _CassetteModels():
+    """The models of a _CassetteGenaiClient."""
+
+    def __init__(self, client: _CassetteGenaiClient):
+        self._client = client
+
+    def generate_content(self, model: str, contents, config=None):
+        from google.genai import types
+
+        prompt = contents if isinstance(contents, str) else next((item for item in contents if isinstance(item, str)), "")
+        return self._client.call("generate_content", {"model": model, "contents": self._client.dump(contents), "config": self._client.dump(config)},
+                                 lambda: self._client.client.models.generate_content(model=model, contents=contents, config=config),
+                                 f"generate_content {model}: {prompt[:80]!r}", types.GenerateContentResponse)
+
+
+class _CassetteCaches():
+    """The context caches of a _CassetteGenaiClient."""
+
+    def __init__(self, client: _CassetteGenaiClient):
+        self._client = client
+
+    def create(self, model: str, config=None):
+        from google.genai import types
+
+        return self._client.call("create_cache", {"model": model, "config": self._client.dump(config)},
+                                 lambda: self._client.client.caches.create(model=model, config=config),
+                                 f"create_cache {model}", types.CachedContent)
+
+    def update(self, name: str, config=None):
+        from google.genai import types
+
+        return self._client.call("update_cache", {"name": name, "config": self._client.dump(config)},
+                                 lambda: self._client.client.caches.update(name=name, config=config),
+                                 f"update_cache {name}", types.CachedContent)
+
+    def delete(self, name: str, config=None):
+        from google.genai import types
+
+        return self._client.call("delete_cache", {"name": name},
+                                 lambda: self._client.client.caches.delete(name=name, config=config),
+                                 f"delete_cache {name}", types.DeleteCachedContentResponse)
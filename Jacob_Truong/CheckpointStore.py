@@ -0,0 +1,134 @@
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import threading
+import logging
+from pathlib import Path
+from datetime import datetime
+
+class CheckpointStore():
+    """
+    A class to persist the output of each pipeline stage per company, so that a failed run can be resumed
+    without repeating the stages that already succeeded.
+    Each checkpoint is stored as a small gzip-compressed JSON file under <checkpoint_dir>/<company_slug>/<stage>.json.gz.
+    """
+
+    # Bump this whenever the shape of a stage's output changes, so that old checkpoints are no longer trusted.
+    CHECKPOINT_VERSION = 2
+
+    def __init__(self, checkpoint_dir: str = "checkpoints"):
+        """
+        Initialise the checkpoint store.
+
+        Args:
+            checkpoint_dir (str): Directory to store the checkpoints in.
+        """
+        self.checkpoint_path = Path(checkpoint_dir)
+        self.checkpoint_path.mkdir(parents=True, exist_ok=True)
+
+    def _stage_path(self, company_slug: str, stage: str) -> Path:
+        """
+        Builds the file path of a stage checkpoint.
+
+        Args:
+            company_slug (str): The slug of the company (e.g. openstream_ai).
+            stage (str): The name of the pipeline stage.
+
+        Returns:
+            Path: The path to the checkpoint file.
+        """
+        return self.checkpoint_path / company_slug / f"{stage}.json.gz"
+
+    @staticmethod
+    def fingerprint(*parts) -> str:
+        """
+        Computes a content hash of the inputs of a stage. Byte strings (e.g. image bytes) are hashed as-is,
+        everything else is hashed through its JSON representation.
+
+        Args:
+            *parts: The inputs of the stage (e.g. scraped text, normalised address, model and prompt version).
+
+        Returns:
+            str: The SHA-256 hex digest of the inputs.
+        """
+        digest = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, (bytes, bytearray)):
+                digest.update(b"b")
+                digest.update(part)
+            else:
+                digest.update(b"j")
+                digest.update(json.dumps(part, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+            # Separator so that ("ab", "c") and ("a", "bc") do not collide
+            digest.update(b"\x00")
+        return digest.hexdigest()
+
+    def save(self, company_slug: str, stage: str, data, fingerprint: str | None = None) -> None:
+        """
+        Persists the output of a stage. The file is written to a temporary path first and then moved into place,
+        so that a crash mid-write never leaves a truncated checkpoint behind.
+
+        Args:
+            company_slug (str): The slug of the company.
+            stage (str): The name of the pipeline stage.
+            data: The JSON-serialisable output of the stage.
+            fingerprint (str | None): The fingerprint of the inputs the output was computed from.
+        """
+        stage_path = self._stage_path(company_slug, stage)
+        stage_path.parent.mkdir(parents=True, exist_ok=True)
+
+        checkpoint = {
+            "version": self.CHECKPOINT_VERSION,
+            "stage": stage,
+            "saved_at": datetime.now().isoformat(timespec="seconds"),
+            "fingerprint": fingerprint,
+            "data": data
+        }
+
+        # NOTE: The temporary path is unique per process and thread, as several workers may save the same company at once.
+        tmp_path = stage_path.with_name(f"{stage_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            json.dump(checkpoint, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, stage_path)
+
+        logging.info("Saved '%s' checkpoint for %s to %s", stage, company_slug, stage_path)
+
+    def load(self, company_slug: str, stage: str) -> dict | None:
+        """
+        Loads the checkpoint of a stage if a valid one exists.
+
+        Args:
+            company_slug (str): The slug of the company.
+            stage (str): The name of the pipeline stage.
+
+        Returns:
+            dict | None: The checkpoint, with the stage output under "data" and the input fingerprint under "fingerprint",
+            or None if the checkpoint is missing, unreadable or from an older version.
+        """
+        stage_path = self._stage_path(company_slug, stage)
+        if not stage_path.exists():
+            return None
+
+        try:
+            with gzip.open(stage_path, "rt", encoding="utf-8") as f:
+                checkpoint = json.load(f)
+        except (OSError, EOFError, json.JSONDecodeError) as e:
+            logging.warning(f"Ignoring unreadable '{stage}' checkpoint for {company_slug}: {e}")
+            return None
+
+        if checkpoint.get("version") != self.CHECKPOINT_VERSION or checkpoint.get("stage") != stage:
+            logging.warning(f"Ignoring outdated '{stage}' checkpoint for {company_slug}.")
+            return None
+
+        return checkpoint
+
+    def clear(self, company_slug: str) -> None:
+        """
+        Removes all checkpoints of a company.
+
+        Args:
+            company_slug (str): The slug of the company.
+        """
+        shutil.rmtree(self.checkpoint_path / company_slug, ignore_errors=True)
@@ -0,0 +1,222 @@
+from GeminiAPI import *
+from GoogleMapsAPI import *
+from Cassette import *
+from Metrics import metrics
+from typing import TYPE_CHECKING
+import threading
+import logging
+from datetime import datetime
+
+# NOTE: requests and httpx are only imported when the first client is built, like the API client libraries themselves.
+if TYPE_CHECKING:
+    import requests
+
+class ClientRegistry():
+    """
+    A process-wide registry of the API clients and HTTP connection pools, so that every agent of every company shares one
+    Gemini client, one Google Maps client and one session for the website fetches, each with a connection pool of its own
+    size, instead of opening new connections (and TLS sessions) for every agent.
+    The agents take their clients by injection and fall back to the ones of the registry.
+    The requests and new connections of each pool are counted, so that the connection reuse rate of each service can be reported.
+    When a cassette is in use, the website session and the API clients record their requests into it, or replay them from it.
+    NOTE: A single process-wide instance (clients) is used by every module, see the bottom of this file. The pool sizes and the
+    cassette must be set with configure() and use_cassette() before the first client is built, e.g. by a runner right after
+    parsing its arguments.
+    """
+
+    # Connections kept per service: the website fetches ("http"), Google Maps ("maps") and Gemini ("gemini").
+    # For the website fetches, this is also the number of websites connections are kept to.
+    DEFAULT_POOL_SIZES = {"http": 16, "maps": 16, "gemini": 32}
+
+    def __init__(self, pool_sizes: dict[str, int] | None = None):
+        """
+        Initialise an empty registry. Clients are built on first use.
+
+        Args:
+            pool_sizes (dict[str, int] | None): The connections kept per service. Services left out use DEFAULT_POOL_SIZES.
+        """
+        self.pool_sizes = {**self.DEFAULT_POOL_SIZES, **(pool_sizes or {})}
+        self._sessions = {}
+        self._gemini = None
+        self._maps = None
+        self.cassette = None
+        # Requests and new connections per service, including those of the pools already closed
+        self._counts = {}
+        self._lock = threading.RLock()
+
+    def configure(self, pool_sizes: dict[str, int]) -> None:
+        """
+        Sets the connections kept per service, for the clients built from now on.
+
+        Args:
+            pool_sizes (dict[str, int]): The connections kept per service, e.g. {"gemini": 64}.
+        """
+        with self._lock:
+            if self._sessions or self._gemini or self._maps:
+                logging.warning("Client pool sizes changed after the first client was built. Only new clients use them.")
+            self.pool_sizes.update(pool_sizes)
+
+    def use_cassette(self, cassette: Cassette | None) -> None:
+        """
+        Records the requests of the clients built from now on into a cassette, or replays them from it.
+
+        Args:
+            cassette (Cassette | None): The cassette, or None to make the requests without one.
+        """
+        with self._lock:
+            if self._sessions or self._gemini or self._maps:
+                logging.warning("Cassette set after the first client was built. Only new clients use it.")
+            self.cassette = cassette
+
+    def now(self) -> datetime:
+        """
+        The current time, for anything sent to the APIs (e.g. the date of a report), so that it is recorded and replayed
+        along with the requests when a cassette is in use.
+
+        Returns:
+            datetime: The current time, or the recorded one when replaying.
+        """
+        return self.cassette.now() if self.cassette else datetime.now()
+
+    def _count(self, service: str, requests: int = 0, connections: int = 0) -> None:
+        """Adds to the requests and new connections counted for a service."""
+        with self._lock:
+            counts = self._counts.setdefault(service, {"requests": 0, "connections": 0})
+            counts["requests"] += requests
+            counts["connections"] += connections
+
+    def session(self, service: str = "http") -> "requests.Session":
+        """
+        Returns the shared requests session of a service, creating it on first use.
+
+        Args:
+            service (str): "http" for the website fetches, or "maps" for the Google Maps client.
+
+        Returns:
+            requests.Session: The session, with a connection pool of the service's size.
+        """
+        with self._lock:
+            session = self._sessions.get(service)
+            if session is None:
+                import requests
+                from http.cookiejar import DefaultCookiePolicy
+                from requests.adapters import HTTPAdapter
+
+                size = self.pool_sizes.get(service, self.DEFAULT_POOL_SIZES["http"])
+                session = requests.Session()
+                # NOTE: The session is shared by every company, so cookies set by one website must not be sent along with
+                # the requests of another. Pages were fetched without a session (and so without cookies) before.
+                session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+                adapter = HTTPAdapter(pool_connections=size, pool_maxsize=size)
+                # The pools of the least recently used hosts are closed beyond pool_connections, so their counts are kept before that
+                adapter.poolmanager.pools.dispose_func = lambda pool, service=service: self._close_pool(service, pool)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                # NOTE: The Google Maps session is left as it is, as the cassette wraps the Google Maps client itself
+                if self.cassette and service == "http":
+                    session = self.cassette.wrap_session(session)
+                self._sessions[service] = session
+            return session
+
+    def _close_pool(self, service: str, pool) -> None:
+        """Counts the requests and connections of a connection pool evicted from a session, and closes it."""
+        self._count(service, pool.num_requests, pool.num_connections)
+        pool.close()
+
+    def gemini(self) -> GeminiAPI:
+        """
+        Returns the shared Gemini API client, creating it on first use.
+
+        Returns:
+            GeminiAPI: The client, whose connection pool holds the Gemini pool size.
+        """
+        with self._lock:
+            if self._gemini is None:
+                import httpx
+
+                def trace(event: str, info: dict) -> None:
+                    if event == "connection.connect_tcp.complete":
+                        self._count("gemini", connections=1)
+
+                def on_request(request) -> None:
+                    # NOTE: The trace extension reports the steps of sending the request, including opening a new connection
+                    self._count("gemini", requests=1)
+                    request.extensions["trace"] = trace
+
+                size = self.pool_sizes["gemini"]
+                self._gemini = GeminiAPI(client_args={"limits": httpx.Limits(max_connections=size, max_keepalive_connections=size),
+                                                      "event_hooks": {"request": [on_request]}}, cassette=self.cassette)
+            return self._gemini
+
+    def maps(self) -> GoogleMapsAPI:
+        """
+        Returns the shared Google Maps API client, creating it on first use.
+
+        Returns:
+            GoogleMapsAPI: The client, using the shared session of the "maps" service.
+        """
+        with self._lock:
+            if self._maps is None:
+                self._maps = GoogleMapsAPI(requests_session=self.session("maps"), cassette=self.cassette)
+            return self._maps
+
+    def reset(self) -> None:
+        """
+        Closes the shared sessions and drops every client and count, so that the next use builds new clients (e.g. after
+        the API client libraries were replaced by stand-ins). The cassette is kept.
+        """
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
+            self._gemini = self._maps = None
+            self._counts = {}
+
+    def connection_stats(self) -> dict:
+        """
+        Summarises how often each service reused a connection instead of opening a new one.
+
+        Returns:
+            dict: Per service, the pool size, the requests made, the connections opened and the reuse rate (the share of
+            requests sent on a connection that was already open).
+        """
+        with self._lock:
+            counts = {service: dict(service_counts) for service, service_counts in self._counts.items()}
+            for service, session in self._sessions.items():
+                service_counts = counts.setdefault(service, {"requests": 0, "connections": 0})
+                for adapter in dict.fromkeys(session.adapters.values()):
+                    pools = adapter.poolmanager.pools
+                    for key in pools.keys():
+                        pool = pools.get(key)
+                        if pool is not None:
+                            service_counts["requests"] += pool.num_requests
+                            service_counts["connections"] += pool.num_connections
+
+        stats = {}
+        for service, service_counts in counts.items():
+            requests, connections = service_counts["requests"], service_counts["connections"]
+            stats[service] = {"pool_size": self.pool_sizes.get(service), "requests": requests, "connections": connections,
+                              "reuse_rate": round(max(0, requests - connections) / requests, 3) if requests else 0.0}
+        return stats
+
+    def export_metrics(self) -> None:
+        """
+        Exports the connection stats of every service as gauges of the process-wide metrics.
+        """
+        for service, service_stats in self.connection_stats().items():
+            metrics.set_gauge("connection_reuse_rate", service_stats["reuse_rate"], "Share of requests sent on an already open connection", service=service)
+            metrics.set_gauge("connections_opened", service_stats["connections"], "Connections opened by the shared client of a service", service=service)
+
+    def format_stats(self) -> str:
+        """
+        Formats the connection stats, one line per service.
+
+        Returns:
+            str: The lines, e.g. "  - gemini: 120 requests on 8 connections (93% reused, pool of 32)".
+        """
+        return "\n".join(f"  - {service}: {service_stats['requests']} requests on {service_stats['connections']} connections "
+                         f"({service_stats['reuse_rate']:.0%} reused, pool of {service_stats['pool_size']})"
+                         for service, service_stats in self.connection_stats().items())
+
+
+clients = ClientRegistry()
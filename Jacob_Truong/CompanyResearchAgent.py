@@ -1,29 +1,68 @@
-import requests
 from GoogleMapsAPI import *
 from GeminiAPI import *
-from bs4 import BeautifulSoup
+from ClientRegistry import clients
+from Metrics import metrics
+from Deadline import *
+from PageParser import page_parser
+from StageResult import StageResult
 from urllib.parse import urljoin, urlparse
+from collections.abc import Iterator
+from typing import TYPE_CHECKING
+import codecs
 import re
+import time
 import logging
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# NOTE: requests is only imported when the first page is fetched (see _fetch_page_content).
+if TYPE_CHECKING:
+    import requests
 
 class CompanyResearchAgent():
     """
     This agent is responsible for programmatically scraping a company's website.
-    Its main tasks include identifying key pages, extracting text, and finding one physical company address.
+    Its main tasks include identifying key pages, extracting text, and finding the physical addresses of the company's sites.
     NOTE: The scraping logic used in this project is *extremely* basic and is only intended for demonstration purposes.
     NOTE: For production use, more complex implementations would be required, such as handling pagination, rate limiting,
     domain redirection, content filtering, as well as leveraging the use of sitemaps and structured data (e.g., JSON-LD) when available.
     """
 
-    def __init__(self, company_name: str, company_url: str):
+    # Bump this whenever the address extraction prompt changes, so that incremental refreshes re-extract the addresses.
+    PROMPT_VERSION = 2
+
+    # Pages are downloaded up to this many bytes and seconds. Anything beyond is cut off, as the text that matters comes first.
+    MAX_PAGE_BYTES = 2 * 1024 * 1024
+    MAX_PAGE_SECONDS = 20
+
+    # Seconds to wait for the server to connect or send more data
+    REQUEST_TIMEOUT_S = 10
+
+    # Content types that are parsed. Other responses are dropped without downloading their body.
+    HTML_MEDIA_TYPES = ("text/html", "application/xhtml+xml", "text/plain")
+
+    # Links to files that are never web pages, which are not requested at all
+    SKIPPED_EXTENSIONS = (".pdf", ".zip", ".doc", ".docx", ".xls", ".xlsx", ".ppt", ".pptx", ".jpg", ".jpeg", ".png", ".gif",
+                          ".webp", ".svg", ".mp4", ".mov", ".avi", ".webm", ".mp3", ".exe", ".dmg")
+
+    # The text kept per category (background, products, contact) of a company, roughly 50,000 tokens. Pages beyond it are not fetched.
+    MAX_CATEGORY_CHARS = 200000
+
+    # A block of text already found on this many earlier pages is taken for boilerplate (e.g. the navigation and footer) and dropped
+    BOILERPLATE_PAGES = 2
+
+    # A charset declared in a <meta> tag, e.g. <meta charset="utf-8"> or <meta http-equiv="Content-Type" content="text/html; charset=windows-1252">
+    _META_CHARSET = re.compile(rb"<meta[^>]+charset\s*=\s*[\"']?\s*([A-Za-z0-9_.:-]+)", re.IGNORECASE)
+
+    def __init__(self, company_name: str, company_url: str, llm: GeminiAPI | None = None, maps_client: GoogleMapsAPI | None = None,
+                 http_session: "requests.Session | None" = None):
         """
         Initialises the agent with the company name and URL.
 
         Args:
             company_name (str): The name of the company to analyse.
             company_url (str): The URL of the company's website.
+            llm (GeminiAPI | None): A Gemini API client to reuse. If not provided, the shared one of the client registry is used.
+            maps_client (GoogleMapsAPI | None): A Google Maps API client to reuse. If not provided, the shared one of the client registry is used.
+            http_session (requests.Session | None): The session the pages are fetched with. If not provided, the shared one of the client registry is used.
         """
         self.company_name = company_name
         self.base_url = company_url
@@ -38,27 +77,158 @@ class CompanyResearchAgent():
             "contact": ["imprint", "contact-us", "contact", "locations", "address", "find us", "stores"]
         }
         # Initialise Google Maps API client
-        self.maps_client = GoogleMapsAPI()
+        self.maps_client = maps_client if maps_client else clients.maps()
 
         # Initialise Gemini API client
-        self.llm = GeminiAPI()
+        self.llm = llm if llm else clients.gemini()
+
+        # The session the pages are fetched with, which keeps their connections open for the next pages of the website
+        self._http_session = http_session
+
+    @property
+    def http_session(self) -> "requests.Session":
+        """The session the pages are fetched with, by default the shared one of the client registry (created on first use)."""
+        return self._http_session if self._http_session else clients.session("http")
+
+    @staticmethod
+    def _declared_charset(content_type: str) -> str | None:
+        """
+        Reads the charset declared in a Content-Type header, if any.
+
+        Args:
+            content_type (str): The Content-Type header (e.g. text/html; charset=utf-8).
+
+        Returns:
+            str | None: The declared charset, or None so that it is detected from the page itself.
+        """
+        for parameter in content_type.split(";")[1:]:
+            name, _, value = parameter.partition("=")
+            if name.strip().lower() == "charset" and value.strip():
+                return value.strip().strip('"\'')
+        return None
+
+    @staticmethod
+    def _decode_page(content: bytes, declared_charset: str | None) -> str:
+        """
+        Decodes the raw bytes of a page with, in order of precedence, its byte order mark, the charset declared by the server,
+        or the charset declared in a <meta> tag at the top of the page. Pages without any are read as UTF-8, or as Windows-1252
+        (the default of browsers for legacy pages) if they are not valid UTF-8, so that no replacement characters end up in the text.
+        A character cut in half at the end of a truncated page is dropped.
 
-    def _fetch_page_content(self, url: str) -> BeautifulSoup | None:
+        Args:
+            content (bytes): The raw bytes of the page.
+            declared_charset (str | None): The charset declared in the Content-Type header, if any.
+
+        Returns:
+            str: The decoded page.
+        """
+        for bom, encoding in ((codecs.BOM_UTF8, "utf-8-sig"), (codecs.BOM_UTF16_LE, "utf-16"), (codecs.BOM_UTF16_BE, "utf-16")):
+            if content.startswith(bom):
+                return content.decode(encoding, errors="replace")
+
+        meta_charset = CompanyResearchAgent._META_CHARSET.search(content[:4096])
+        for charset in (declared_charset, meta_charset.group(1).decode("ascii") if meta_charset else None):
+            if not charset:
+                continue
+            try:
+                encoding = codecs.lookup(charset).name
+            except LookupError:
+                continue
+            # NOTE: Pages declared as Latin-1 are decoded as Windows-1252, its superset, like browsers do.
+            encoding = "cp1252" if encoding in ("latin-1", "iso8859-1", "ascii") else encoding
+            return codecs.getincrementaldecoder(encoding)(errors="replace").decode(content, final=False)
+
+        # NOTE: A page cut off at MAX_PAGE_BYTES can end inside a multi-byte character. Decoding with final=False drops that
+        # partial character instead of failing on it, so only invalid bytes before the end make the page Windows-1252.
+        try:
+            return codecs.getincrementaldecoder("utf-8")().decode(content, final=False)
+        except UnicodeDecodeError:
+            return content.decode("cp1252", errors="replace")
+
+    def _download_page(self, url: str, call: dict) -> str | None:
+        """
+        Downloads a page in chunks, keeping at most MAX_PAGE_BYTES and giving up after MAX_PAGE_SECONDS.
+        Responses that are not HTML (e.g. PDFs, images or videos linked from a products page) are dropped as soon as their headers arrive.
+        Both the request timeout and the download time are bounded by the company's time budget, if any (see Deadline).
+
+        Args:
+            url (str): The URL of the page.
+            call (dict): The metrics call record of the fetch, for the bytes received and the reason a page was skipped or truncated.
+
+        Returns:
+            str | None: The decoded page, or None if it is not an HTML page.
+
+        Raises:
+            DeadlineExceeded: If the time budget is exhausted before the page is requested.
+        """
+        if urlparse(url).path.lower().endswith(self.SKIPPED_EXTENSIONS):
+            call["skipped"] = "extension"
+            logging.info("Skipping %s, as it does not link to a web page.", url)
+            return None
+
+        timeout_s = Deadline.timeout_for(self.REQUEST_TIMEOUT_S, f"fetch of {url}")
+        max_seconds = Deadline.timeout_for(self.MAX_PAGE_SECONDS, f"fetch of {url}")
+        start = time.monotonic()
+        with self.http_session.get(url, headers=self.headers, timeout=timeout_s, stream=True) as response:
+            response.raise_for_status()
+
+            content_type = response.headers.get("Content-Type", "")
+            media_type = content_type.split(";", 1)[0].strip().lower()
+            if media_type and media_type not in self.HTML_MEDIA_TYPES:
+                call["skipped"] = media_type
+                logging.info("Skipping %s, as it is not a web page (%s).", url, media_type)
+                return None
+
+            chunks = []
+            size = 0
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                chunks.append(chunk)
+                size += len(chunk)
+                if size >= self.MAX_PAGE_BYTES or time.monotonic() - start > max_seconds:
+                    call["truncated"] = True
+                    logging.warning(f"Truncated {url} after {size} bytes and {time.monotonic() - start:.1f}s.")
+                    break
+
+        call["bytes_received"] = size
+        content = b"".join(chunks)[:self.MAX_PAGE_BYTES]
+
+        # Without a Content-Type, only keep what looks like markup
+        if not media_type and content.lstrip()[:1] != b"<":
+            call["skipped"] = "unknown"
+            return None
+
+        return self._decode_page(content, self._declared_charset(content_type))
+
+    def _fetch_page_content(self, url: str) -> dict | None:
         """Fetches and parses the HTML content of a given URL. The content is then used by other methods to extract information.
+        NOTE: Parsing is done by the shared PageParser in a worker process, which only returns the page text and links.
 
         Args:
             url (str): The homepage URL to fetch content from.
 
         Returns:
-            BeautifulSoup | None: The parsed HTML content or None if an error occurred.
+            dict | None: The page text under "text" and its (link text, href) pairs under "links", or None if an error occurred,
+            the URL is not an HTML page, the page could not be parsed or the time budget is exhausted.
         """
+        import requests
+
         try:
-            response = requests.get(url, headers=self.headers, timeout=10)
-            response.raise_for_status()
-            return BeautifulSoup(response.text, 'html.parser')
+            with metrics.track("http", "fetch", url=url) as call:
+                page = self._download_page(url, call)
+        except DeadlineExceeded:
+            return None
         except requests.RequestException as e:
             logging.error(f"Could not fetch content from {url}. Error: {e}")
             return None
+        if page is None:
+            return None
+
+        # A page that cannot be parsed (or that kills the parser process) is skipped, rather than failing the whole company
+        try:
+            return page_parser.parse(page)
+        except Exception as e:
+            logging.error(f"Could not parse the content of {url}. Error: {e!r}")
+            return None
 
     def find_key_page_urls(self) -> dict:
         """
@@ -69,17 +239,16 @@ class CompanyResearchAgent():
             dict: A dictionary mapping page categories to one absolute URL.
         """
         logging.info(f"Searching for key page URLs on {self.base_url}...")
-        homepage_soup = self._fetch_page_content(self.base_url)
-        if not homepage_soup:
+        homepage = self._fetch_page_content(self.base_url)
+        if not homepage:
             return {}
 
         # Default to homepage URL, so if a specific page isn't found, we can use the homepage for its content
         found_links = {key: self.base_url for key in self.link_keywords}
         found_links_count = 0
 
-        for a_tag in homepage_soup.find_all('a', href=True):
-            link_text = a_tag.get_text(strip=True).lower() # E.g. contact us
-            link_href = a_tag['href'] # E.g. /contact-us
+        for link_text, link_href in homepage["links"]: # E.g. ("Contact Us", "/contact-us")
+            link_text = link_text.lower() # E.g. contact us
 
             # Remove links that are not from the same domain as the homepage
             # NOTE: This might not work well when a site recently migrated to a new domain and has
@@ -95,7 +264,7 @@ class CompanyResearchAgent():
                     if any(keyword in link_href for keyword in keywords):
                         absolute_url = urljoin(self.base_url, link_href)
                         found_links[category] = absolute_url
-                        logging.info(f"Found '{category}' page link: {absolute_url} (matched on text='{link_text}' or href='{link_href}')")
+                        logging.info("Found '%s' page link: %s (matched on text='%s' or href='%s')", category, absolute_url, link_text, link_href)
                         found_links_count += 1
                         break # Stop checking keywords for this link and move to the next <a> tag
 
@@ -122,16 +291,15 @@ class CompanyResearchAgent():
             dict: A dictionary mapping page categories to multiple candidate absolute URLs.
         """
         logging.info(f"Searching for key page URLs on {self.base_url}...")
-        homepage_soup = self._fetch_page_content(self.base_url)
-        if not homepage_soup:
+        homepage = self._fetch_page_content(self.base_url)
+        if not homepage:
             return {}
 
         # Default to homepage URL, so if a specific page isn't found, we can use the homepage for its content
         found_links = {key: [self.base_url] for key in self.link_keywords}
 
-        for a_tag in homepage_soup.find_all('a', href=True):
-            link_text = a_tag.get_text(strip=True).lower() # E.g. contact us
-            link_href = a_tag['href'] # E.g. /contact-us
+        for link_text, link_href in homepage["links"]: # E.g. ("Contact Us", "/contact-us")
+            link_text = link_text.lower() # E.g. contact us
 
             # Remove links that are not from the same domain as the homepage
             # NOTE: This might not work well when a site recently migrated to a new domain and has
@@ -149,7 +317,7 @@ class CompanyResearchAgent():
                         if absolute_url in found_links[category]:
                             continue
                         found_links[category].append(absolute_url)
-                        logging.info(f"Found '{category}' page link: {absolute_url} (matched on text='{link_text}' or href='{link_href}')")
+                        logging.info("Found '%s' page link: %s (matched on text='%s' or href='%s')", category, absolute_url, link_text, link_href)
 
         # Log any missing specific pages
         if len(found_links["background"]) == 1:
@@ -172,9 +340,9 @@ class CompanyResearchAgent():
         Returns:
             str: A string containing the extracted text from the page.
         """
-        logging.info(f"Extracting main content text from {url}...")
-        page_soup = self._fetch_page_content(url)
-        if not page_soup:
+        logging.info("Extracting main content text from %s...", url)
+        page = self._fetch_page_content(url)
+        if not page:
             return ""
 
         # NOTE: Depending on the website structure, it might be necessary to filter the content more aggressively. I decided not
@@ -195,9 +363,8 @@ class CompanyResearchAgent():
         # tags_to_remove = ['nav', 'aside', 'script', 'style', 'form']
         # for tag in page_soup(tags_to_remove):
         #     tag.decompose()
-        target_soup = page_soup
 
-        return target_soup.get_text(separator=' ', strip=True)
+        return page["text"]
 
     # NOTE: This is the programmatic extraction method
     def extract_specific_address_block(self, text: str) -> str | None:
@@ -256,7 +423,7 @@ class CompanyResearchAgent():
         """
         
         try:
-            response = self.llm.generate_content(prompt)
+            response = self.llm.generate_content(prompt, stage="addresses")
             logging.info("Successfully received address extraction from LLM.")
             return str(response.text).strip().replace("�", "")
         except Exception as e:
@@ -267,6 +434,148 @@ class CompanyResearchAgent():
 
             return "Error: Could not extract address."
 
+    # NOTE: This method uses a language model for extraction
+    def extract_all_address_blocks_llm(self, address_text: str) -> list[str]:
+        """
+        Uses a language model to extract every site address from the given text (e.g. all stores, offices and plants).
+        NOTE: Same trade-offs as extract_specific_address_block_llm, but returns all addresses instead of the first one.
+
+        Args:
+            address_text (str): The text containing the address information (e.g. content from the contact and locations pages).
+
+        Returns:
+            list[str]: The extracted addresses in the order they appear, or an empty list if none are found or the extraction failed.
+        """
+
+        logging.info("Sending address text to LLM for extraction of every address...")
+
+        prompt = f"""
+        You are given text scraped from a company's contact and locations pages. This text contains a lot of noise and/or scraping artifacts.
+        Your task is to analyse the text and extract every address of the company's locations (e.g. offices, stores, plants and warehouses).
+        Note that the full addresses might have varying formats depending on the country. Strictly return one full address per line,
+        in the order they appear in the text, without numbering, bullet points or any additional commentary or text. Do not make up
+        addresses; if none are found on the page, simply return an empty string.
+
+        --- TEXT ---
+        {address_text}
+
+        """
+
+        try:
+            response = self.llm.generate_content(prompt, stage="addresses")
+            logging.info("Successfully received address extraction from LLM.")
+        except Exception as e:
+            logging.error(f"LLM address extraction failed: {e}")
+
+            if "500 INTERNAL" in str(e):
+                raise RuntimeError("IMPORTANT: 500 INTERNAL ERROR IS A SERVER-SIDED ERROR. CHANGING TO ANOTHER MODEL COULD HELP.")
+
+            return []
+
+        addresses = []
+        for line in str(response.text).replace("�", "").splitlines():
+            # Remove any numbering or bullet points the model added anyway
+            address = re.sub(r"^\s*(?:[-*•]|\d+[.)])\s+", "", line).strip()
+            if address:
+                addresses.append(address)
+
+        logging.info(f"Extracted {len(addresses)} address(es).")
+        return addresses
+
+    def iter_page_texts(self, urls: list[str], wanted=None) -> Iterator[tuple[str, str]]:
+        """
+        Fetches pages one at a time and yields their text, so that only one page is held in memory at once.
+        Once the company's time budget (see Deadline) is down to its reserve, the pages after the first are no longer fetched.
+
+        Args:
+            urls (list[str]): The URLs of the pages. Each URL is fetched once, even if listed several times.
+            wanted (Callable | None): Called with each URL before it is fetched. The page is skipped if it returns False.
+
+        Yields:
+            tuple[str, str]: The URL and text of each page that could be fetched.
+        """
+        urls = list(dict.fromkeys(urls))
+        deadline = Deadline.current()
+        for index, url in enumerate(urls):
+            # NOTE: The pages collected so far are kept, the rest are dropped along with the time they would take
+            if deadline and index > 0 and not deadline.has_time():
+                deadline.truncate(f"scrape ({len(urls) - index} page(s) not fetched)")
+                return
+            if wanted is not None and not wanted(url):
+                continue
+            text = self.extract_text_from_url(url)
+            if text:
+                yield url, text
+
+    @staticmethod
+    def iter_text_blocks(text: str) -> Iterator[str]:
+        """
+        Yields the visible strings of a page text (one per line, see parse_page) without splitting the whole text up front.
+
+        Args:
+            text (str): The page text.
+
+        Yields:
+            str: Each non-empty block of text.
+        """
+        for match in re.finditer(r"[^\n]+", text):
+            block = match.group().strip()
+            if block:
+                yield block
+
+    def collect_page_texts(self) -> dict:
+        """
+        Finds all candidate key pages and collects the text extracted from them per category.
+        Pages are streamed through one at a time: each page is fetched once (even when it belongs to several categories),
+        its text is filtered block by block into the bounded buffer of each of its categories and then dropped.
+        Blocks already found on BOILERPLATE_PAGES earlier pages (e.g. the navigation and footer repeated on every page) are
+        dropped, and a category stops taking text at MAX_CATEGORY_CHARS.
+        NOTE: Blocks repeated within one page are kept, as on a locations page they can belong to different sites (e.g. "Suite 100").
+        The contact text is never deduplicated, as its address lines (e.g. the city, state and postcode line) are often the same
+        on several contact and location pages, and each address needs all of its lines.
+        NOTE: This is the "Brute-Force" (multi page) approach, see the README for details.
+
+        Returns:
+            dict: A dictionary containing the background, products and contact text.
+        """
+        key_urls = self.find_key_page_urls_many()
+        categories = ("background", "products", "contact")
+
+        # Per category: the kept parts and their length
+        buffers = {category: {"parts": [], "chars": 0} for category in categories}
+        # The number of pages each block was found on so far, by block hash
+        block_pages = {}
+        url_categories = {}
+        for category in categories:
+            for url in key_urls.get(category, []):
+                url_categories.setdefault(url, []).append(category)
+
+        def wanted(url: str) -> bool:
+            # Pages are only fetched while one of their categories still has room
+            return any(buffers[category]["chars"] < self.MAX_CATEGORY_CHARS for category in url_categories[url])
+
+        for url, text in self.iter_page_texts(list(url_categories), wanted):
+            page_hashes = set()
+            for category in url_categories[url]:
+                buffer = buffers[category]
+                page_parts = []
+                for block in self.iter_text_blocks(text):
+                    if buffer["chars"] >= self.MAX_CATEGORY_CHARS:
+                        logging.info(f"The {category} text of {self.company_name} reached {self.MAX_CATEGORY_CHARS} characters, the rest is dropped.")
+                        break
+                    block_hash = hash(block)
+                    page_hashes.add(block_hash)
+                    if category != "contact" and block_pages.get(block_hash, 0) >= self.BOILERPLATE_PAGES:
+                        continue
+                    page_parts.append(block)
+                    buffer["chars"] += len(block) + 1
+                if page_parts:
+                    buffer["parts"].append(" ".join(page_parts))
+            for block_hash in page_hashes:
+                block_pages[block_hash] = block_pages.get(block_hash, 0) + 1
+
+        return {f"{category}_text": "".join("\n" + part for part in buffers[category]["parts"]) for category in categories}
+
     def run_full_research(self) -> dict:
         """
         Performs full fetching and extraction of company information.
@@ -288,18 +597,10 @@ class CompanyResearchAgent():
         # ------------------------------------------------------------------------
 
         # ------------------- MULTI PAGE APPROACH --------------------------------
-        key_urls = self.find_key_page_urls_many()
-
-        background_text = ""
-        products_text = ""
-        contact_text = ""
-
-        for url in key_urls["background"]:
-            background_text += "\n" + self.extract_text_from_url(url)
-        for url in key_urls["products"]:
-            products_text += "\n" + self.extract_text_from_url(url)
-        for url in key_urls["contact"]:
-            contact_text += "\n" + self.extract_text_from_url(url)
+        page_texts = self.collect_page_texts()
+        background_text = page_texts["background_text"]
+        products_text = page_texts["products_text"]
+        contact_text = page_texts["contact_text"]
         # ------------------------------------------------------------------------
 
         # --------------- Find a company location address ------------------------
@@ -308,8 +609,14 @@ class CompanyResearchAgent():
         address = self.extract_specific_address_block_llm(contact_text)
         # ------------------------------------------------------------------------
 
-        # Extract discrete location information from the address
-        location_info = self.maps_client.extract_location_info_from_address(address)
+        # Extract discrete location information from the address, unless the extraction failed
+        address_result = StageResult.of_address(address)
+        if address_result:
+            location_info = self.maps_client.extract_location_info_from_address(address)
+        else:
+            logging.warning(f"Not geocoding the extracted address ({address_result.reason}): {address!r}")
+            metrics.record_avoided_call("maps", "geocode", address_result.reason)
+            location_info = {}
 
         scraped_data = {
             "background_text": background_text,
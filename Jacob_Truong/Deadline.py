@@ -0,0 +1,122 @@
+import threading
+import time
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+class DeadlineExceeded(Exception):
+    """
+    Raised instead of starting an external call when the time budget of the company it is made for is exhausted.
+    """
+
+
+class Deadline():
+    """
+    A class holding the time budget of one company's research, which every external call made for the company is bounded by:
+    a call gets the smaller of its own timeout and the time left (see timeout_for()), and is not started at all once too
+    little time is left. Whatever was cut short is recorded, so that the report can say what it is missing.
+    The deadline is set for the calls made inside the activate() block (and in the threads started from it with a copy of
+    its context), the same way as the metrics tags, so that the agents pick it up without it being passed to every method.
+    NOTE: Part of the budget can be held back (reserve_s) for the report, so that the optional work before it (e.g. the
+    satellite analysis) is cut short early enough for the report to still be generated.
+    """
+
+    # Calls are not started with less time than this left, as they could not finish anyway
+    MIN_CALL_S = 1.0
+
+    _current = ContextVar("deadline", default=None)
+
+    def __init__(self, budget_s: float, reserve_s: float = 0.0):
+        """
+        Initialise a deadline, which starts counting down right away.
+
+        Args:
+            budget_s (float): The time budget in seconds.
+            reserve_s (float): The part of the budget held back for the work that must still be done at the end, see has_time().
+        """
+        self.budget_s = budget_s
+        self.reserve_s = min(reserve_s, budget_s)
+        self.expires_at = time.monotonic() + budget_s
+        # What was cut short, in the order it happened
+        self.truncations = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def current(cls) -> "Deadline | None":
+        """
+        Gets the deadline of the current context, see activate().
+
+        Returns:
+            Deadline | None: The deadline, or None if the calls of the current context are not bounded.
+        """
+        return cls._current.get()
+
+    @contextmanager
+    def activate(self):
+        """
+        Bounds every external call made inside the block by this deadline.
+        """
+        token = self._current.set(self)
+        try:
+            yield self
+        finally:
+            self._current.reset(token)
+
+    def remaining(self) -> float:
+        """
+        Returns:
+            float: The time left in seconds, never below 0.
+        """
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        """Whether too little time is left to start another call."""
+        return self.remaining() < self.MIN_CALL_S
+
+    def has_time(self, needed_s: float = 0.0) -> bool:
+        """
+        Checks whether optional work can still be started without eating into the reserve.
+
+        Args:
+            needed_s (float): The time the work is expected to take, in seconds.
+
+        Returns:
+            bool: True if more than the reserve plus needed_s (and at least MIN_CALL_S) is left.
+        """
+        return self.remaining() - self.reserve_s >= max(needed_s, self.MIN_CALL_S)
+
+    def truncate(self, what: str) -> None:
+        """
+        Records work that was cut short or not started because of the deadline.
+
+        Args:
+            what (str): What was cut short, e.g. "satellite_analysis" or "fetch of https://example.com/about".
+        """
+        with self._lock:
+            self.truncations.append(what)
+        logging.warning(f"Time budget of {self.budget_s:g}s exhausted: {what} cut short.")
+
+    @classmethod
+    def timeout_for(cls, timeout_s: float, what: str) -> float:
+        """
+        Bounds the timeout of an external call by the deadline of the current context, if any.
+
+        Args:
+            timeout_s (float): The timeout the call would have on its own, in seconds.
+            what (str): The call, recorded if it is not started (e.g. "geocode").
+
+        Returns:
+            float: The smaller of timeout_s and the time left.
+
+        Raises:
+            DeadlineExceeded: If less than MIN_CALL_S is left, in which case the call must not be made.
+        """
+        deadline = cls.current()
+        if deadline is None:
+            return timeout_s
+        remaining = deadline.remaining()
+        if remaining < cls.MIN_CALL_S:
+            deadline.truncate(what)
+            raise DeadlineExceeded(f"time budget exhausted before {what}")
+        return min(timeout_s, remaining)
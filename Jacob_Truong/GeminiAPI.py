@@ -1,54 +1,356 @@
-from google import genai
+from Metrics import metrics
+from Deadline import *
+from ModelRouter import *
+from typing import TYPE_CHECKING
+from AdaptiveLimiter import *
+from QuotaManager import *
 import os
+import random
+import threading
+import time
 import logging
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# NOTE: google.genai is slow to import, so it is only imported when the first request is made (see the llm property).
+if TYPE_CHECKING:
+    from google import genai
+    from Cassette import Cassette
 
 class GeminiAPI():
     """
     A class to create and manage interactions with the Google Gemini API.
-    NOTE: In this implementation, this class is only used to quickly instantiate a client.
+    NOTE: In this implementation, this class is only used to quickly instantiate a client and manage explicit context caches.
+    One instance is shared by every agent of the process, see ClientRegistry.
     """
 
-    def __init__(self, gemini_model: str = ""):
+    # The minimum size of an explicit context cache in tokens, per model. Smaller caches are rejected by the API.
+    MIN_CACHE_TOKENS = {"gemini-2.5-pro": 4096, "default": 1024}
+
+    # Response codes with which the API pushes back under load (rate limited, overloaded). Calls failing with these are
+    # retried with exponential backoff and cut the concurrency limit of their model.
+    OVERLOAD_CODES = (429, 503)
+    MAX_ATTEMPTS = 4
+    RETRY_BACKOFF_S = 1.0
+
+    # The longest a single generate_content request may take, in seconds, unless the time budget of its company ends sooner (see Deadline)
+    REQUEST_TIMEOUT_S = 180
+
+    # NOTE: The limiters are shared by every GeminiAPI instance in the process, as the quota applies per project and model
+    # rather than per client. Each model gets its own limiter, so that pushback on one model does not slow down the others.
+    LIMITER_SETTINGS = {"initial_limit": 4, "min_limit": 1, "max_limit": 32, "latency_tolerance": 3.0}
+    _limiters = {}
+    _limiters_lock = threading.Lock()
+
+    def __init__(self, gemini_model: str = "", router: ModelRouter | None = None, quota: QuotaManager | None = None,
+                 client_args: dict | None = None, cassette: "Cassette | None" = None):
         """
         Initialise a Gemini API client.
 
         Args:
-            gemini_model (str): The model to use for the Gemini API. If this is not provided, the default model will be used.
+            gemini_model (str): The model to use for requests made without a stage. If this is not provided, the default model will be used.
+            router (ModelRouter | None): The routing table giving the model and generation config of each stage. If not provided, the default table is used.
+            quota (QuotaManager | None): The rate limit budget shared with other processes. If not provided, the one in ARCS_QUOTA_DB is used, if any.
+            client_args (dict | None): Arguments for the underlying httpx client (e.g. its connection limits), see ClientRegistry.
+            cassette (Cassette | None): The cassette the requests are recorded into or replayed from, if any. No API key is needed to replay.
         """
         self.llm_api_key = os.getenv("GOOGLE_GEMINI_API_KEY")
-        self.gemini_model = os.getenv("GEMINI_MODEL", "gemini-2.5-flash") if not gemini_model else gemini_model
+        self.gemini_model = self.default_model() if not gemini_model else gemini_model
+        self.router = router if router else ModelRouter()
+        self.quota = quota if quota else QuotaManager.shared()
+        self.client_args = client_args
+        self.cassette = cassette
 
-        if not self.llm_api_key:
+        if not self.llm_api_key and not (cassette and cassette.replaying):
             raise ValueError("LLM API key is required.")
         
-        # Configure the Gemini client
-        self.llm = genai.Client(api_key=self.llm_api_key)
+        # The Gemini client is configured on first use
+        self._llm = None
+        self._llm_lock = threading.Lock()
+
+    @property
+    def llm(self) -> "genai.Client":
+        """
+        The Gemini client, created on first use so that building a GeminiAPI (and importing google.genai) costs nothing
+        until a request is actually made.
+
+        Returns:
+            genai.Client: The Gemini client.
+        """
+        if self._llm is None:
+            with self._llm_lock:
+                if self._llm is None:
+                    def make_client() -> "genai.Client":
+                        from google import genai
+                        http_options = genai.types.HttpOptions(client_args=self.client_args) if self.client_args else None
+                        return genai.Client(api_key=self.llm_api_key, http_options=http_options)
+
+                    self._llm = self.cassette.wrap_gemini(make_client) if self.cassette else make_client()
+        return self._llm
+
+    @classmethod
+    def limiter(cls, model: str) -> AdaptiveLimiter:
+        """
+        Returns the adaptive concurrency limiter of a model, creating it on first use.
+
+        Args:
+            model (str): The Gemini model.
+
+        Returns:
+            AdaptiveLimiter: The limiter shared by every call to the model in this process.
+        """
+        with cls._limiters_lock:
+            if model not in cls._limiters:
+                cls._limiters[model] = AdaptiveLimiter(f"Gemini ({model})", **cls.LIMITER_SETTINGS)
+            return cls._limiters[model]
+
+    @staticmethod
+    def default_model() -> str:
+        """
+        Returns the model used when none is given explicitly.
+
+        Returns:
+            str: The model set in the GEMINI_MODEL environment variable, or gemini-2.5-flash.
+        """
+        return os.getenv("GEMINI_MODEL") or "gemini-2.5-flash"
+
+    def create_cache(self, system_instruction: str, contents: str, ttl_s: int = 600, display_name: str = "", model: str | None = None) -> str | None:
+        """
+        Creates an explicit context cache holding system instructions and a block of content (e.g. a company's scraped corpus),
+        so that later calls can reference it instead of resending it.
+        NOTE: Cached tokens are billed at a reduced rate on every call referencing the cache, plus storage for as long as it lives,
+        so a cache only pays off when it is referenced by several calls. It should be deleted as soon as it is no longer needed.
+
+        Args:
+            system_instruction (str): The system instructions to cache.
+            contents (str): The content to cache.
+            ttl_s (int): How long the cache lives, in seconds, unless it is deleted or extended earlier.
+            display_name (str): A name to recognise the cache by (e.g. the company name).
+            model (str | None): The model of the calls that will reference the cache, as a cache can only be used with its own model.
+                If not provided, the default model is used.
+
+        Returns:
+            str | None: The name of the cache, or None if the content is too small to be cached or the cache could not be created.
+        """
+        model = model if model else self.gemini_model
+        estimated_tokens = (len(system_instruction) + len(contents)) // 4
+        minimum_tokens = self.MIN_CACHE_TOKENS.get(model, self.MIN_CACHE_TOKENS["default"])
+        if estimated_tokens < minimum_tokens:
+            logging.info(f"Not caching ~{estimated_tokens} tokens, below the minimum of {minimum_tokens} tokens for {model}.")
+            return None
+
+        from google import genai
+
+        try:
+            with metrics.track("gemini", "create_cache", model=model) as call:
+                call["bytes_sent"] = len(system_instruction.encode("utf-8")) + len(contents.encode("utf-8"))
+                cache = self.llm.caches.create(
+                    model=model,
+                    config=genai.types.CreateCachedContentConfig(
+                        system_instruction=system_instruction,
+                        contents=[contents],
+                        ttl=f"{ttl_s}s",
+                        display_name=display_name
+                    ))
+                call["prompt_tokens"] = getattr(cache.usage_metadata, "total_token_count", None) or 0
+        except Exception as e:
+            # NOTE: Caching is only an optimisation, so the calls fall back to sending the content themselves.
+            logging.warning(f"Could not create context cache: {e}")
+            return None
+
+        logging.info(f"Created context cache {cache.name} ({display_name}) for {ttl_s}s.")
+        return cache.name
+
+    def extend_cache(self, cache_name: str, ttl_s: int) -> None:
+        """
+        Sets a new time to live on a context cache, counted from now.
+
+        Args:
+            cache_name (str): The name of the cache.
+            ttl_s (int): How long the cache lives from now, in seconds.
+        """
+        from google import genai
+
+        try:
+            with metrics.track("gemini", "update_cache", model=self.gemini_model):
+                self.llm.caches.update(name=cache_name, config=genai.types.UpdateCachedContentConfig(ttl=f"{ttl_s}s"))
+        except Exception as e:
+            logging.warning(f"Could not extend context cache {cache_name}: {e}")
+
+    def delete_cache(self, cache_name: str) -> None:
+        """
+        Deletes a context cache, so that its storage is no longer billed.
+
+        Args:
+            cache_name (str): The name of the cache.
+        """
+        try:
+            with metrics.track("gemini", "delete_cache", model=self.gemini_model):
+                self.llm.caches.delete(name=cache_name)
+            logging.info(f"Deleted context cache {cache_name}.")
+        except Exception as e:
+            # NOTE: The cache still expires at the end of its time to live.
+            logging.warning(f"Could not delete context cache {cache_name}: {e}")
+
+    def _generation_config(self, route: dict | None, system_instruction: str | None, cached_content: str | None,
+                           timeout_s: float | None = None) -> "genai.types.GenerateContentConfig | None":
+        """
+        Builds the generation config of a request from the route of its stage.
+
+        Args:
+            route (dict | None): The route of the stage (see ModelRouter), or None for the model defaults.
+            system_instruction (str | None): Optional system instructions.
+            cached_content (str | None): Optional name of a context cache to reference.
+            timeout_s (float | None): The timeout of the request in seconds, or None for the client default.
+
+        Returns:
+            genai.types.GenerateContentConfig | None: The config, or None if there is nothing to set.
+        """
+        from google import genai
+
+        fields = {}
+        if timeout_s is not None:
+            # NOTE: The API takes the timeout in milliseconds
+            fields["http_options"] = genai.types.HttpOptions(timeout=max(1, int(timeout_s * 1000)))
+        # NOTE: A request referencing a context cache cannot set its own system instructions, they come from the cache.
+        if cached_content:
+            fields["cached_content"] = cached_content
+        elif system_instruction:
+            fields["system_instruction"] = system_instruction
+
+        if route:
+            if route.get("max_output_tokens"):
+                fields["max_output_tokens"] = route["max_output_tokens"]
+            if route.get("temperature") is not None:
+                fields["temperature"] = route["temperature"]
+            if route.get("thinking_budget") is not None:
+                fields["thinking_config"] = genai.types.ThinkingConfig(thinking_budget=route["thinking_budget"])
 
-    def generate_content(self, prompt: str, image_bytes: bytes | None = None) -> genai.types.GenerateContentResponse:
+        return genai.types.GenerateContentConfig(**fields) if fields else None
+
+    def _generate(self, model: str, route: dict | None, prompt: str, image_bytes: bytes | None, system_instruction: str | None,
+                  cached_content: str | None, stage: str | None = None, **fields) -> "genai.types.GenerateContentResponse":
+        """
+        Makes one generate_content request and records its metrics, see generate_content().
+
+        Args:
+            model (str): The model to use.
+            route (dict | None): The route of the stage, for the generation config.
+            prompt (str): The text prompt to generate content for.
+            image_bytes (bytes | None): Optional image bytes to include in the request.
+            system_instruction (str | None): Optional system instructions.
+            cached_content (str | None): Optional name of a context cache to reference.
+            stage (str | None): The pipeline stage the request is made for. The adaptive limiter compares its latency with the
+                requests of the same stage only, as e.g. vision requests take much longer than short text requests.
+            **fields: Any additional fields to store on the call metrics (e.g. escalated_from).
+
+        Returns:
+            genai.types.GenerateContentResponse: The response.
+
+        Raises:
+            DeadlineExceeded: If the time budget of the company is exhausted before the request (or its next retry) is made,
+                or while it waits for the shared rate limit quota.
+        """
+        from google import genai
+
+        with metrics.track("gemini", "generate_content", model=model, **fields) as call:
+            call["bytes_sent"] = len(prompt.encode("utf-8")) + (len(image_bytes) if image_bytes else 0)
+            if system_instruction and not cached_content:
+                call["bytes_sent"] += len(system_instruction.encode("utf-8"))
+
+            # If no image is provided, only take in text input
+            contents = prompt if not image_bytes else [genai.types.Part.from_bytes(data=image_bytes, mime_type='image/png'), prompt]
+
+            # Roughly 4 characters per token, and a fixed number of tokens per image. Corrected once the call returns.
+            estimated_tokens = (call["bytes_sent"] - (len(image_bytes) if image_bytes else 0)) // 4 + (258 if image_bytes else 0)
+
+            limiter = self.limiter(model)
+            for attempt in range(self.MAX_ATTEMPTS):
+                if self.quota:
+                    call["quota_wait_s"] += self.quota.acquire_gemini(model, estimated_tokens)
+                call["concurrency_limit"] = limiter.limit
+                with limiter.slot(latency_key=stage if stage else ("image" if image_bytes else "text")) as slot:
+                    call["queue_wait_s"] += slot["queue_wait_s"]
+                    try:
+                        # NOTE: The timeout is taken once the slot is held, so that the time spent waiting for it counts against the budget
+                        config = self._generation_config(route, system_instruction, cached_content,
+                                                         Deadline.timeout_for(self.REQUEST_TIMEOUT_S, f"{model} generate_content"))
+                        response = self.llm.models.generate_content(model=model, contents=contents, config=config)
+                        break
+                    except Exception as e:
+                        # A failed attempt used none of the tokens taken for it (its request still counts), and the next one takes them again
+                        if self.quota:
+                            self.quota.settle_gemini(model, estimated_tokens, 0)
+                        # Only rate limiting and overload are retried, other errors are passed on as before
+                        if getattr(e, "code", None) not in self.OVERLOAD_CODES:
+                            raise
+                        slot["overloaded"] = True
+                        backoff_s = self.RETRY_BACKOFF_S * 2 ** attempt * random.uniform(0.5, 1.5)
+                        if attempt == self.MAX_ATTEMPTS - 1:
+                            raise
+                        # A retry that could not start before the time budget ends is not waited for
+                        deadline = Deadline.current()
+                        if deadline and deadline.remaining() < backoff_s + Deadline.MIN_CALL_S:
+                            deadline.truncate(f"{model} generate_content retries")
+                            raise
+                        logging.warning(f"Gemini ({model}) pushed back with {e.code}, retrying (attempt {attempt + 2} of {self.MAX_ATTEMPTS}).")
+                call["retries"] += 1
+                # Back off outside of the slot, so that the freed slot can go to a call that is already waiting
+                # NOTE: A replayed pushback is answered from the cassette, so there is nothing to wait for
+                if not (self.cassette and self.cassette.replaying):
+                    time.sleep(backoff_s)
+
+            metrics.set_gauge("gemini_concurrency_limit", limiter.limit, "Current adaptive limit on Gemini calls in flight.", model=model)
+            metrics.record_gemini_usage(call, response)
+            if self.quota:
+                self.quota.settle_gemini(model, estimated_tokens, call["prompt_tokens"])
+            call["bytes_received"] = len((response.text or "").encode("utf-8"))
+
+        return response
+
+    @staticmethod
+    def _is_truncated(response) -> bool:
+        """Checks whether a response was cut off by its maximum output tokens."""
+        candidates = getattr(response, "candidates", None) or []
+        finish_reason = getattr(candidates[0], "finish_reason", None) if candidates else None
+        return str(getattr(finish_reason, "name", finish_reason)) == "MAX_TOKENS"
+
+    def generate_content(self, prompt: str, image_bytes: bytes | None = None, system_instruction: str | None = None,
+                         cached_content: str | None = None, stage: str | None = None) -> "genai.types.GenerateContentResponse":
         """
         Generate content using the Gemini API.
+        If a stage is given, the model and generation config come from the routing table (see ModelRouter), and an output
+        that fails the checks of the stage is generated again with the stronger model the stage escalates to.
 
         Args:
             prompt (str): The text prompt to generate content for.
             image_bytes (bytes | None): Optional image bytes to include in the request.
+            system_instruction (str | None): Optional system instructions. Ignored when a context cache is given, as the cache holds them.
+            cached_content (str | None): Optional name of a context cache (see create_cache) to reference.
+            stage (str | None): The pipeline stage the request is made for. If not provided, the default model and config are used.
         """
         if not prompt:
             raise ValueError("Prompt cannot be empty.")
 
-        # If no image is provided, only take in text input
-        if not image_bytes:
-            response = self.llm.models.generate_content(model=self.gemini_model, contents=prompt)
-        else:
-            response = self.llm.models.generate_content(
-                model = self.gemini_model,
-                contents = [
-                genai.types.Part.from_bytes(
-                    data=image_bytes,
-                    mime_type='image/png',
-                ),
-                prompt
-                ])
+        route = self.router.route(stage) if stage else None
+        model = route["model"] if route else self.gemini_model
 
-        return response
+        response = self._generate(model, route, prompt, image_bytes, system_instruction, cached_content, stage=stage)
+        if not route or not route.get("escalate_to"):
+            return response
+
+        if ModelRouter.is_valid(stage, response.text) and not self._is_truncated(response):
+            return response
+
+        # NOTE: Escalating is optional, so the output is kept as it is once the time budget is down to its reserve.
+        deadline = Deadline.current()
+        if deadline and not deadline.has_time():
+            deadline.truncate(f"escalation of '{stage}' to {route['escalate_to']}")
+            return response
+
+        # NOTE: A context cache belongs to the model it was created for, so calls referencing one cannot be escalated.
+        if cached_content:
+            logging.warning(f"Output of '{stage}' failed validation, but cannot be escalated as it references a context cache.")
+            return response
+
+        logging.warning(f"Output of '{stage}' from {model} failed validation. Escalating to {route['escalate_to']}.")
+        return self._generate(route["escalate_to"], ModelRouter.with_model(route, route["escalate_to"]), prompt, image_bytes, system_instruction, cached_content, stage=stage,
+                              escalated_from=model)
@@ -1,24 +1,95 @@
-import googlemaps
+from Metrics import metrics
+from Deadline import *
+from QuotaManager import *
+from typing import TYPE_CHECKING
 import os
+import threading
 import logging
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# NOTE: googlemaps (and requests with it) is only imported when the first request is made (see the maps_client property).
+if TYPE_CHECKING:
+    import googlemaps
+    import requests
+    from Cassette import Cassette
 
 class GoogleMapsAPI():
     """
     A class to create and manage interactions with the Google Maps API.
+    One instance is shared by every agent of the process, see ClientRegistry.
     """
 
-    def __init__(self):
+    # The longest a single request may take, and the longest the client keeps retrying a request that failed with a retriable error, in seconds.
+    # NOTE: The googlemaps client only takes its timeouts when it is created, so every request it sends (retries included) is
+    # bounded by the time budget of its company (see Deadline) by the subclass built in client_class().
+    REQUEST_TIMEOUT_S = 10
+    RETRY_TIMEOUT_S = 30
+
+    def __init__(self, quota: QuotaManager | None = None, requests_session: "requests.Session | None" = None, cassette: "Cassette | None" = None):
         """
         Initialise a Google Maps API client.
+
+        Args:
+            quota (QuotaManager | None): The rate limit budget shared with other processes. If not provided, the one in ARCS_QUOTA_DB is used, if any.
+            requests_session (requests.Session | None): The session whose connection pool the requests are sent on, see ClientRegistry.
+                If not provided, the googlemaps client creates its own.
+            cassette (Cassette | None): The cassette the requests are recorded into or replayed from, if any. No API key is needed to replay.
         """
         self.map_api_key = os.getenv("GOOGLE_MAPS_API_KEY")
+        self.quota = quota if quota else QuotaManager.shared()
+        self.requests_session = requests_session
+        self.cassette = cassette
         
-        if not self.map_api_key:
+        if not self.map_api_key and not (cassette and cassette.replaying):
             raise ValueError("Google Maps API key is required.")
         
-        self.maps_client = googlemaps.Client(key=self.map_api_key)
+        # The Google Maps client is configured on first use
+        self._maps_client = None
+        self._maps_client_lock = threading.Lock()
+
+    @staticmethod
+    def client_class() -> type:
+        """
+        Builds a googlemaps.Client whose requests, retries included, are bounded by the time budget of the current context.
+        Each request gets the smaller of the client's timeout and the time left, and a request (or retry) is not sent at all
+        once too little time is left.
+        NOTE: Built from googlemaps.Client when the client is created rather than once, so that a replaced googlemaps.Client
+        (e.g. the stand-in of the benchmarks) is picked up.
+
+        Returns:
+            type: The subclass of googlemaps.Client.
+        """
+        import googlemaps
+
+        class DeadlineBoundClient(googlemaps.Client):
+            def _request(self, url, params, first_request_time=None, retry_counter=0, base_url=None, accepts_clientid=True,
+                         extract_body=None, requests_kwargs=None, post_json=None):
+                # NOTE: The client retries by calling _request again, so every retry is bounded as well
+                timeout_s = Deadline.timeout_for(self.timeout, f"Google Maps request to {url}")
+                requests_kwargs = dict(requests_kwargs or {}, timeout=timeout_s)
+                return super()._request(url, params, first_request_time, retry_counter, base_url, accepts_clientid,
+                                        extract_body, requests_kwargs, post_json)
+
+        return DeadlineBoundClient
+
+    @property
+    def maps_client(self) -> "googlemaps.Client":
+        """
+        The Google Maps client, created on first use so that building a GoogleMapsAPI (and importing googlemaps) costs nothing
+        until a request is actually made.
+
+        Returns:
+            googlemaps.Client: The Google Maps client.
+        """
+        if self._maps_client is None:
+            with self._maps_client_lock:
+                if self._maps_client is None:
+                    def make_client() -> "googlemaps.Client":
+                        return self.client_class()(key=self.map_api_key, timeout=self.REQUEST_TIMEOUT_S, retry_timeout=self.RETRY_TIMEOUT_S,
+                                                 requests_session=self.requests_session)
+
+                    # NOTE: When replaying, the googlemaps client is never built, as it rejects a missing API key
+                    self._maps_client = self.cassette.wrap_maps(make_client) if self.cassette else make_client()
+        return self._maps_client
 
     def extract_location_info_from_address(self, address: str) -> dict:
             """
@@ -28,12 +99,18 @@ class GoogleMapsAPI():
                 address (str): The address to extract location information from.
 
             Returns:
-                dict: A dictionary containing location information (city, state, country) or an empty dictionary if not found.
+                dict: A dictionary containing location information (city, state, country) or an empty dictionary if not found
+                or the time budget is exhausted (see Deadline).
             """
 
             try:
                 # Geocode the address
-                geocode_result = self.maps_client.geocode(address)
+                Deadline.timeout_for(self.REQUEST_TIMEOUT_S, "geocode")
+                with metrics.track("maps", "geocode") as call:
+                    call["bytes_sent"] = len(address.encode("utf-8"))
+                    if self.quota:
+                        call["quota_wait_s"] = self.quota.acquire_maps("geocode")
+                    geocode_result = self.maps_client.geocode(address)
 
                 if not geocode_result:
                     return {}
@@ -52,6 +129,8 @@ class GoogleMapsAPI():
                         country = component['long_name']
                 
                 return {'city': city, 'state': state, 'country': country}
+            except DeadlineExceeded:
+                return {}
             except Exception as e:
                 logging.error(f"Failed to extract location information: {e}")
                 return {}
@@ -65,18 +144,26 @@ class GoogleMapsAPI():
             zoom_factor (float): The zoom level for the satellite image.
 
         Returns:
-            bytes: The satellite image bytes or an empty bytes object if retrieval failed.
+            bytes: The satellite image bytes or an empty bytes object if retrieval failed or the time budget is exhausted.
         """
         try:
-            image_data_generator = self.maps_client.static_map(
-                center=address,
-                zoom=zoom_factor,
-                size=(800, 600),
-                maptype='satellite'
-            )
-
-            image_data = b''.join(image_data_generator)
+            Deadline.timeout_for(self.REQUEST_TIMEOUT_S, "static_map")
+            with metrics.track("maps", "static_map") as call:
+                call["bytes_sent"] = len(address.encode("utf-8"))
+                if self.quota:
+                    call["quota_wait_s"] = self.quota.acquire_maps("static_map")
+                image_data_generator = self.maps_client.static_map(
+                    center=address,
+                    zoom=zoom_factor,
+                    size=(800, 600),
+                    maptype='satellite'
+                )
+
+                image_data = b''.join(image_data_generator)
+                call["bytes_received"] = len(image_data)
             return image_data if image_data else b''
+        except DeadlineExceeded:
+            return b''
         except Exception as e:
             logging.error(f"Failed to retrieve satellite image: {e}")
             return b''
\ No newline at end of file
@@ -0,0 +1,326 @@
+import struct
+import zlib
+
+# NOTE: numpy is only imported when the first image is analysed (see analyse), in line with the other heavy libraries.
+
+class ImageTriage():
+    """
+    A class that measures a satellite image locally with NumPy before it is sent to the vision model: the share of water and
+    how far it is from the site, a vegetation index, the brightness and texture of the roof at the centre of the image, and
+    whether the image is a "no imagery" placeholder or covered by cloud. Unusable images are not sent to the model at all,
+    and the measurements of the others are added to the prompt, so the model can ground its findings on them.
+    NOTE: Satellite images only have visible bands, so the water and vegetation masks are colour heuristics, not spectral indices.
+    """
+
+    # Placeholder: most of the image is one colour (quantised to 4 bits per channel), e.g. the grey "no imagery" tile
+    PLACEHOLDER_DOMINANT_SHARE = 0.85
+    # Cloud: bright, grey and smooth pixels, in regions reaching the edge of the image
+    # NOTE: A large white membrane or metal roof at the centre of the image looks the same, so bright regions that do not
+    # reach the edge of the image are taken for the site rather than for cloud.
+    CLOUD_MIN_LUMINANCE = 200
+    CLOUD_MAX_SATURATION = 30
+    CLOUD_MAX_TEXTURE = 6.0
+    # The cloud regions are traced on blocks of this many (measured) pixels a side
+    CLOUD_BLOCK = 4
+    # Share of cloud above which the ground can no longer be assessed, if the site at the centre is covered as well
+    CLOUD_MAX_SHARE = 0.7
+    # Share of cloud (over the image or the site) above which the image is still analysed, but with a caveat
+    CLOUD_CAVEAT_SHARE = 0.3
+    # Water: darker, cyan to blue (green and blue over red, unlike the blue-grey of dark roofs) and smooth, in regions rather than single pixels
+    WATER_MAX_LUMINANCE = 130
+    WATER_MIN_BLUE_OVER_RED = 8
+    WATER_MIN_GREEN_OVER_RED = 8
+    WATER_MAX_TEXTURE = 4.0
+    # Vegetation: excess green index (2G - R - B) / (R + G + B)
+    VEGETATION_MIN_EXCESS_GREEN = 0.06
+    # The roof is measured in a square at the centre of the image, where the site is, of this share of the shorter side
+    ROOF_WINDOW_SHARE = 0.2
+
+    def __init__(self, scale: int = 2, texture_radius: int = 2, region_radius: int = 6):
+        """
+        Initialise the triage.
+
+        Args:
+            scale (int): The image is measured at 1/scale of its resolution (averaging scale x scale blocks), which is enough
+                for a triage and several times faster. The distances are still given in pixels of the full image.
+            texture_radius (int): The radius in (measured) pixels of the window the local texture (standard deviation of brightness) is measured over.
+            region_radius (int): The radius in (measured) pixels of the window a pixel must mostly share with water to count as water,
+                so that single dark pixels (e.g. shadows) are not taken for water.
+        """
+        self.scale = max(scale, 1)
+        self.texture_radius = texture_radius
+        self.region_radius = region_radius
+
+    @staticmethod
+    def decode_png(image_bytes: bytes):
+        """
+        Decodes a non-interlaced PNG (the format of the Google Maps Static API) into an RGB array.
+        Rows without a filter or with the Sub or Up filter, as in the images of the Static API, are decoded without a Python
+        loop. Rows with the Average or Paeth filter are decoded pixel by pixel, which is slower but still correct.
+
+        Args:
+            image_bytes (bytes): The PNG file bytes.
+
+        Returns:
+            numpy.ndarray: The image as a (height, width, 3) array of uint8.
+
+        Raises:
+            ValueError: If the bytes are not a PNG this decoder supports.
+        """
+        import numpy as np
+
+        if image_bytes[:8] != b"\x89PNG\r\n\x1a\n":
+            raise ValueError("Not a PNG image.")
+
+        header = palette = None
+        data = []
+        position = 8
+        while position + 8 <= len(image_bytes):
+            length, chunk_type = struct.unpack(">I4s", image_bytes[position:position + 8])
+            chunk = image_bytes[position + 8:position + 8 + length]
+            if chunk_type == b"IHDR":
+                header = struct.unpack(">IIBBBBB", chunk)
+            elif chunk_type == b"PLTE":
+                palette = np.frombuffer(chunk, dtype=np.uint8).reshape(-1, 3)
+            elif chunk_type == b"IDAT":
+                data.append(chunk)
+            elif chunk_type == b"IEND":
+                break
+            position += 12 + length
+
+        if header is None:
+            raise ValueError("PNG without a header.")
+        width, height, bit_depth, colour_type, _, _, interlace = header
+        channels = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}.get(colour_type)
+        if channels is None or interlace or (colour_type == 3 and palette is None):
+            raise ValueError(f"Unsupported PNG (colour type {colour_type}, interlace {interlace}).")
+
+        bits_per_pixel = channels * bit_depth
+        row_bytes = (width * bits_per_pixel + 7) // 8
+        # Bytes per complete pixel, which the filters look back by (at least 1)
+        step = max(bits_per_pixel // 8, 1)
+
+        raw = np.frombuffer(zlib.decompress(b"".join(data)), dtype=np.uint8)
+        if raw.size < height * (row_bytes + 1):
+            raise ValueError("Truncated PNG data.")
+        rows = raw[:height * (row_bytes + 1)].reshape(height, row_bytes + 1)
+        filters = rows[:, 0]
+        pixels = rows[:, 1:].copy()
+
+        # Rows without a filter are already decoded, the others are undone in order, as each may depend on the row above
+        for y in np.flatnonzero(filters):
+            row = pixels[y]
+            previous = pixels[y - 1] if y else np.zeros(row_bytes, dtype=np.uint8)
+            if filters[y] == 1:
+                # Sub: each byte adds the byte one pixel to its left, i.e. a running sum per byte position within a pixel
+                padded = np.zeros(-(-row_bytes // step) * step, dtype=np.uint8)
+                padded[:row_bytes] = row
+                row[:] = np.cumsum(padded.reshape(-1, step), axis=0, dtype=np.uint8).reshape(-1)[:row_bytes]
+            elif filters[y] == 2:
+                row += previous
+            elif filters[y] in (3, 4):
+                row_values = row.astype(np.int16)
+                above = previous.astype(np.int16)
+                for x in range(row_bytes):
+                    left = row_values[x - step] if x >= step else 0
+                    if filters[y] == 3:
+                        predictor = (left + above[x]) // 2
+                    else:
+                        upper_left = above[x - step] if x >= step else 0
+                        estimate = left + above[x] - upper_left
+                        distances = (abs(estimate - left), abs(estimate - above[x]), abs(estimate - upper_left))
+                        predictor = (left, above[x], upper_left)[distances.index(min(distances))]
+                    row_values[x] = (row_values[x] + predictor) & 0xFF
+                row[:] = row_values.astype(np.uint8)
+            elif filters[y] != 0:
+                raise ValueError(f"Unknown PNG filter type {filters[y]}.")
+
+        if bit_depth == 16:
+            samples = pixels.reshape(height, width, channels * 2)[:, :, 0::2]
+        elif bit_depth < 8:
+            samples = np.unpackbits(pixels, axis=1).reshape(height, -1, bit_depth)[:, :width]
+            samples = (samples * (1 << np.arange(bit_depth - 1, -1, -1, dtype=np.uint8))).sum(axis=2, dtype=np.uint8)[:, :, None]
+            if colour_type == 0:
+                samples = samples * np.uint8(255 // ((1 << bit_depth) - 1))
+        else:
+            samples = pixels.reshape(height, width, channels)
+
+        if colour_type == 3:
+            # np.take is several times faster than fancy indexing for a lookup table
+            return np.take(palette, np.minimum(samples[:, :, 0], len(palette) - 1), axis=0)
+        if colour_type in (0, 4):
+            return np.repeat(samples[:, :, :1], 3, axis=2)
+        # Transparency is ignored, as satellite images are opaque
+        return np.ascontiguousarray(samples[:, :, :3])
+
+    @classmethod
+    def _edge_connected(cls, mask):
+        """
+        Keeps the regions of a mask that reach the edge of the image. The regions are traced on blocks of CLOUD_BLOCK pixels,
+        which is enough to tell a bank of cloud from a roof and keeps the number of passes small.
+
+        Args:
+            mask (numpy.ndarray): A (height, width) boolean array.
+
+        Returns:
+            numpy.ndarray: The pixels of the mask in a region connected to the edge of the image.
+        """
+        import numpy as np
+
+        block = cls.CLOUD_BLOCK
+        height, width = mask.shape
+        rows, columns = -(-height // block), -(-width // block)
+        padded = np.zeros((rows * block, columns * block), dtype=np.float32)
+        padded[:height, :width] = mask
+        blocks = padded.reshape(rows, block, columns, block).mean(axis=(1, 3)) >= 0.5
+
+        reached = np.zeros_like(blocks)
+        reached[0, :], reached[-1, :], reached[:, 0], reached[:, -1] = blocks[0, :], blocks[-1, :], blocks[:, 0], blocks[:, -1]
+        while True:
+            grown = reached.copy()
+            grown[1:, :] |= reached[:-1, :]
+            grown[:-1, :] |= reached[1:, :]
+            grown[:, 1:] |= reached[:, :-1]
+            grown[:, :-1] |= reached[:, 1:]
+            grown &= blocks
+            if (grown == reached).all():
+                break
+            reached = grown
+
+        return mask & np.repeat(np.repeat(reached, block, axis=0), block, axis=1)[:height, :width]
+
+    @staticmethod
+    def _box_mean(values, radius: int):
+        """
+        Averages every pixel over the square window of the given radius around it, with an integral image.
+
+        Args:
+            values (numpy.ndarray): A (height, width) array.
+            radius (int): The radius of the window in pixels.
+
+        Returns:
+            numpy.ndarray: The windowed means, of the same shape (the edges are extended to fill the windows).
+        """
+        import numpy as np
+
+        size = 2 * radius + 1
+        height, width = values.shape
+        integral = np.zeros((height + size, width + size), dtype=np.float64)
+        np.pad(values, radius, mode="edge").cumsum(axis=0, dtype=np.float64).cumsum(axis=1, out=integral[1:, 1:])
+        sums = integral[size:, size:] - integral[:-size, size:] - integral[size:, :-size] + integral[:-size, :-size]
+        return sums / (size * size)
+
+    def analyse(self, image_bytes: bytes, metres_per_pixel: float | None = None) -> dict:
+        """
+        Measures a satellite image.
+
+        Args:
+            image_bytes (bytes): The PNG file bytes.
+            metres_per_pixel (float | None): The ground size of a pixel, to also give the distance to water in metres.
+
+        Returns:
+            dict: Whether the image is "usable" (and the "reason" if not), a "caveat" for a partly clouded image that is still
+            usable (None otherwise), the "width" and "height", the "placeholder" flag, the "cloud_share", "site_cloud_share", "water_share", "distance_to_water_px" (and "distance_to_water_m", None without water),
+            "vegetation_share", "vegetation_index", and the "roof_brightness", "roof_brightness_std" and "roof_texture" at the centre.
+
+        Raises:
+            ValueError: If the image cannot be decoded.
+        """
+        import numpy as np
+
+        rgb = self.decode_png(image_bytes)
+        full_height, full_width, _ = rgb.shape
+
+        # A placeholder tile is (almost) a single colour
+        quantised = ((rgb[:, :, 0] >> 4).astype(np.int32) << 8) | ((rgb[:, :, 1] >> 4).astype(np.int32) << 4) | (rgb[:, :, 2] >> 4)
+        dominant_share = np.bincount(quantised.ravel(), minlength=4096).max() / quantised.size
+        placeholder = bool(dominant_share >= self.PLACEHOLDER_DOMINANT_SHARE)
+
+        scale = self.scale if min(full_height, full_width) >= 16 * self.scale else 1
+        height, width = full_height // scale, full_width // scale
+        # Average each block of scale x scale pixels, one channel at a time (faster than a strided mean over the blocks)
+        red, green, blue = (sum(rgb[dy:height * scale:scale, dx:width * scale:scale, channel].astype(np.float32)
+                                for dy in range(scale) for dx in range(scale)) / (scale * scale) for channel in range(3))
+        luminance = 0.299 * red + 0.587 * green + 0.114 * blue
+        saturation = np.maximum(np.maximum(red, green), blue) - np.minimum(np.minimum(red, green), blue)
+
+        # Local texture: the standard deviation of brightness around each pixel
+        mean = self._box_mean(luminance, self.texture_radius)
+        texture = np.sqrt(np.maximum(self._box_mean(luminance * luminance, self.texture_radius) - mean * mean, 0.0))
+
+        cloud = (luminance >= self.CLOUD_MIN_LUMINANCE) & (saturation <= self.CLOUD_MAX_SATURATION) & (texture <= self.CLOUD_MAX_TEXTURE)
+        cloud = self._edge_connected(cloud)
+        cloud_share = float(cloud.mean())
+
+        water = ((luminance <= self.WATER_MAX_LUMINANCE) & (blue - red >= self.WATER_MIN_BLUE_OVER_RED)
+                 & (green - red >= self.WATER_MIN_GREEN_OVER_RED) & (texture <= self.WATER_MAX_TEXTURE))
+        # Only keep pixels whose surroundings are mostly water as well
+        water = water & (self._box_mean(water.astype(np.float32), self.region_radius) >= 0.5)
+        water_share = float(water.mean())
+
+        # The site is at the centre of the image
+        distance_to_water_px = None
+        if water.any():
+            water_y, water_x = np.nonzero(water)
+            distance_to_water_px = float(np.sqrt(((water_y - (height - 1) / 2) ** 2 + (water_x - (width - 1) / 2) ** 2).min())) * scale
+
+        excess_green = (2 * green - red - blue) / (red + green + blue + 1.0)
+        vegetation_share = float((excess_green >= self.VEGETATION_MIN_EXCESS_GREEN).mean())
+
+        half = max(int(min(height, width) * self.ROOF_WINDOW_SHARE / 2), 1)
+        site_window = (slice(height // 2 - half, height // 2 + half), slice(width // 2 - half, width // 2 + half))
+        roof = luminance[site_window]
+        site_cloud_share = float(cloud[site_window].mean())
+        roof_texture = float((np.abs(np.diff(roof, axis=0)).mean() + np.abs(np.diff(roof, axis=1)).mean()) / 2)
+
+        features = {
+            "width": full_width,
+            "height": full_height,
+            "placeholder": placeholder,
+            "cloud_share": round(cloud_share, 3),
+            "site_cloud_share": round(site_cloud_share, 3),
+            "water_share": round(water_share, 3),
+            "distance_to_water_px": round(distance_to_water_px, 1) if distance_to_water_px is not None else None,
+            "distance_to_water_m": round(distance_to_water_px * metres_per_pixel, 1) if distance_to_water_px is not None and metres_per_pixel else None,
+            "vegetation_share": round(vegetation_share, 3),
+            "vegetation_index": round(float(excess_green.mean()), 3),
+            "roof_brightness": round(float(roof.mean()), 1),
+            "roof_brightness_std": round(float(roof.std()), 1),
+            "roof_texture": round(roof_texture, 2)
+        }
+
+        features.update(usable=True, reason=None, caveat=None)
+        if placeholder:
+            features.update(usable=False, reason="the image is a placeholder without imagery")
+        elif cloud_share > self.CLOUD_MAX_SHARE and site_cloud_share > self.CLOUD_MAX_SHARE:
+            features.update(usable=False, reason=f"{cloud_share:.0%} of the image, including the site, is covered by cloud")
+        elif max(cloud_share, site_cloud_share) > self.CLOUD_CAVEAT_SHARE:
+            features["caveat"] = (f"about {cloud_share:.0%} of the image and {site_cloud_share:.0%} of the site at its centre appear to be "
+                                  f"covered by cloud, so parts of the site and its surroundings may not be visible")
+        return features
+
+    @staticmethod
+    def describe(features: dict) -> str:
+        """
+        Describes the measurements of a usable image for the vision prompt.
+
+        Args:
+            features (dict): The output of analyse().
+
+        Returns:
+            str: One measurement per line.
+        """
+        if features["distance_to_water_px"] is None:
+            water = "No water detected in the image."
+        elif features["distance_to_water_m"] is not None:
+            water = f"Nearest water to the centre of the image: about {features['distance_to_water_m']:g} m ({features['distance_to_water_px']:g} pixels)."
+        else:
+            water = f"Nearest water to the centre of the image: {features['distance_to_water_px']:g} pixels."
+
+        return "\n".join([
+            f"- Water: {features['water_share']:.1%} of the image. {water}",
+            f"- Vegetation: {features['vegetation_share']:.1%} of the image (mean excess green index {features['vegetation_index']:g}).",
+            f"- Roof at the centre of the image: mean brightness {features['roof_brightness']:g}/255 (standard deviation {features['roof_brightness_std']:g}), "
+            f"texture {features['roof_texture']:g} (mean brightness step between neighbouring pixels).",
+            f"- Cloud: {features['cloud_share']:.1%} of the image, {features['site_cloud_share']:.1%} of the site at the centre."
+        ])
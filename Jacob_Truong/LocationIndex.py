@@ -0,0 +1,193 @@
+from AddressNormaliser import *
+from GoogleMapsAPI import *
+from ClientRegistry import clients
+from Metrics import metrics
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import hashlib
+import threading
+import time
+import logging
+from pathlib import Path
+
+class LocationIndex():
+    """
+    A portfolio-level index of locations, keyed by normalised address, so that a location referenced by several companies
+    (or spelled differently by the same company) is only geocoded and imaged once.
+    The results are fanned back out to every company that looks the location up, and the index keeps track of which companies these are.
+    Lookups are safe from several threads: concurrent lookups of the same location wait for the first one instead of repeating the call.
+    NOTE: One index is meant to be shared by every pipeline of a batch run or of the report service.
+    """
+
+    def __init__(self, maps_client: GoogleMapsAPI | None = None, output_dir: str = "satellite_images", max_locations: int = 10000, ttl_s: float = 3600.0):
+        """
+        Initialise an empty index.
+
+        Args:
+            maps_client (GoogleMapsAPI | None): A Google Maps API client to reuse. If not provided, the shared one of the client registry is used.
+            output_dir (str): Directory to save the satellite images of the locations in.
+            max_locations (int): The maximum number of locations kept. The least recently used ones are evicted beyond it.
+            ttl_s (float): How long a result is reused, in seconds. Older results are fetched again, e.g. for a refresh in a long-running service.
+        """
+        self._maps_client = maps_client
+        self.output_path = Path(output_dir)
+        self.max_locations = max_locations
+        self.ttl_s = ttl_s
+
+        # Normalised address -> {"address", "companies", "geocode", "images"} with each result stored with the time it was fetched
+        self._locations = OrderedDict()
+        self._key_locks = {}
+        self._lock = threading.Lock()
+
+    @property
+    def maps_client(self) -> GoogleMapsAPI:
+        """The Google Maps API client given to the index, or the shared one of the client registry."""
+        return self._maps_client if self._maps_client else clients.maps()
+
+    def _entry(self, address: str, company: str | None) -> tuple[str, dict, threading.Lock]:
+        """
+        Finds or creates the entry of a location and records the company referencing it.
+
+        Args:
+            address (str): The address of the location, in any spelling.
+            company (str | None): The company looking the location up.
+
+        Returns:
+            tuple[str, dict, threading.Lock]: The normalised address, its entry and the lock serialising the calls made for it.
+        """
+        key = AddressNormaliser.normalise(address)
+        with self._lock:
+            entry = self._locations.get(key)
+            if entry is None:
+                entry = {"address": address, "companies": set(), "geocode": None, "images": {}}
+                self._locations[key] = entry
+                self._key_locks[key] = threading.Lock()
+                while len(self._locations) > self.max_locations:
+                    evicted_key, _ = self._locations.popitem(last=False)
+                    self._key_locks.pop(evicted_key, None)
+            self._locations.move_to_end(key)
+            if company:
+                entry["companies"].add(company)
+            return key, entry, self._key_locks[key]
+
+    def _is_fresh(self, result: tuple | None) -> bool:
+        """Checks whether a stored (fetched_at, value) result can still be reused."""
+        return result is not None and time.monotonic() - result[0] < self.ttl_s
+
+    def geocode(self, address: str, company: str | None = None) -> dict:
+        """
+        Extracts the location information (city, state, country) of an address, geocoding each location only once.
+
+        Args:
+            address (str): The address of the location.
+            company (str | None): The company looking the location up.
+
+        Returns:
+            dict: A dictionary containing location information (city, state, country) or an empty dictionary if not found.
+        """
+        key, entry, key_lock = self._entry(address, company)
+        with key_lock:
+            if self._is_fresh(entry["geocode"]):
+                metrics.record_cache_hit("location_index", "geocode")
+                return entry["geocode"][1]
+
+            location_info = self.maps_client.extract_location_info_from_address(entry["address"])
+            # NOTE: Failed lookups are not stored, so that the next company referencing the location tries again.
+            if location_info:
+                entry["geocode"] = (time.monotonic(), location_info)
+            return location_info
+
+    def geocode_many(self, addresses: list[str], company: str | None = None, max_workers: int = 4) -> list[dict]:
+        """
+        Extracts the location information of several addresses, with at most max_workers geocoding requests in flight at once.
+
+        Args:
+            addresses (list[str]): The addresses of the locations.
+            company (str | None): The company looking the locations up.
+            max_workers (int): The maximum number of geocoding requests in flight at once.
+
+        Returns:
+            list[dict]: The location information of each address, in the same order.
+        """
+        if not addresses:
+            return []
+
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(addresses))) as executor:
+            # Each lookup runs in a copy of the caller's context, so its metrics keep the company and stage tags
+            futures = [executor.submit(contextvars.copy_context().run, self.geocode, address, company) for address in addresses]
+            return [future.result() for future in futures]
+
+    def satellite_image(self, address: str, zoom_factor: float, company: str | None = None) -> str | None:
+        """
+        Downloads the satellite image of a location, imaging each location only once per zoom level.
+
+        Args:
+            address (str): The address of the location.
+            zoom_factor (float): The zoom level of the satellite image.
+            company (str | None): The company looking the location up.
+
+        Returns:
+            str | None: The file path of the saved satellite image, or None if it could not be retrieved.
+        """
+        key, entry, key_lock = self._entry(address, company)
+        with key_lock:
+            image = entry["images"].get(zoom_factor)
+            if self._is_fresh(image) and Path(image[1]).exists():
+                metrics.record_cache_hit("location_index", "static_map")
+                return image[1]
+
+            image_data = self.maps_client.get_satellite_image_bytes(entry["address"], zoom_factor=zoom_factor)
+            if not image_data:
+                return None
+
+            # The image is named after the location rather than the company, as it is shared by every company referencing it
+            location_id = hashlib.sha256(f"{key}|{zoom_factor}".encode("utf-8")).hexdigest()[:16]
+            self.output_path.mkdir(parents=True, exist_ok=True)
+            image_path = self.output_path / f"location_{location_id}_satellite.png"
+            with open(image_path, "wb") as f:
+                f.write(image_data)
+
+            logging.info("Saved satellite image of %s to %s", entry['address'], image_path)
+            entry["images"][zoom_factor] = (time.monotonic(), str(image_path))
+            return str(image_path)
+
+    def companies(self, address: str) -> list[str]:
+        """
+        Lists the companies that referenced a location.
+
+        Args:
+            address (str): The address of the location, in any spelling.
+
+        Returns:
+            list[str]: The companies, sorted by name.
+        """
+        with self._lock:
+            entry = self._locations.get(AddressNormaliser.normalise(address))
+            return sorted(entry["companies"]) if entry else []
+
+    def shared_locations(self) -> list[dict]:
+        """
+        Lists the locations referenced by more than one company.
+
+        Returns:
+            list[dict]: The address and companies of each shared location.
+        """
+        with self._lock:
+            return [{"address": entry["address"], "companies": sorted(entry["companies"])}
+                    for entry in self._locations.values() if len(entry["companies"]) > 1]
+
+    def stats(self) -> dict:
+        """
+        Summarises the index.
+
+        Returns:
+            dict: The number of distinct and shared locations and of the companies referencing them.
+        """
+        with self._lock:
+            entries = list(self._locations.values())
+        return {
+            "locations": len(entries),
+            "shared_locations": sum(1 for entry in entries if len(entry["companies"]) > 1),
+            "references": sum(len(entry["companies"]) for entry in entries)
+        }
@@ -0,0 +1,515 @@
+import json
+import os
+import threading
+import time
+import uuid
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from pathlib import Path
+
+class MetricsRecorder():
+    """
+    A class to record metrics for every external call made by the pipeline (HTTP fetches, Google Maps calls and Gemini calls),
+    as well as stage timings and checkpoint cache hits.
+    Each call is tagged with the company and stage it was made for, which are set with the tags() context manager.
+    Calls are aggregated as they are recorded, and only the latest MAX_CALLS call records are kept, so that a long run (e.g. the
+    report service) does not hold every call it ever made. Likewise, only the latest MAX_COMPANIES companies are aggregated apart.
+    NOTE: A single process-wide instance (metrics) is used by every module, see the bottom of this file.
+    """
+
+    # Numeric fields that are summed when aggregating calls
+    SUMMED_FIELDS = ("latency_s", "bytes_sent", "bytes_received", "prompt_tokens", "output_tokens", "thinking_tokens",
+                     "cached_tokens", "retries", "cost_usd", "queue_wait_s", "quota_wait_s")
+
+    # Gemini list prices in USD per million tokens: input, output (including thinking) and cached input tokens
+    MODEL_PRICES = {
+        "gemini-2.5-pro": {"input": 1.25, "output": 10.00, "cached": 0.31},
+        "gemini-2.5-flash": {"input": 0.30, "output": 2.50, "cached": 0.075},
+        "gemini-2.5-flash-lite": {"input": 0.10, "output": 0.40, "cached": 0.025}
+    }
+
+    # The most call records kept for the JSON report. The summaries still count the calls dropped beyond it.
+    MAX_CALLS = 10000
+
+    # The most companies aggregated apart. The aggregates of the least recently seen ones beyond it are folded into OTHER_COMPANY,
+    # so that neither the memory of a long-running service nor the label set of its Prometheus metrics grows with every company.
+    MAX_COMPANIES = 1000
+    OTHER_COMPANY = "(other)"
+
+    def __init__(self):
+        """
+        Initialise an empty metrics recorder.
+        """
+        self.run_id = uuid.uuid4().hex[:12]
+        self.started_at = datetime.now()
+        # The latest call records, oldest first
+        self.calls = []
+        self.calls_dropped = 0
+        # Calls aggregated as they are recorded, per company, stage, kind, operation and model (see summary()),
+        # and the Gemini calls per stage and model (see stage_costs())
+        self._groups = {}
+        self._stage_cost_groups = {}
+        # Latest value of each gauge (e.g. the concurrency limit of a model), keyed by name and labels
+        self.gauges = {}
+        # Number of calls not made because their input was invalid, keyed by company, stage, kind, operation and reason
+        self.avoided_calls = {}
+        # The companies aggregated apart, least recently seen first
+        self._companies = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Tags applied to every call recorded in the current context
+        self._company = ContextVar("metrics_company", default=None)
+        self._stage = ContextVar("metrics_stage", default=None)
+
+    @contextmanager
+    def tags(self, company: str | None = None, stage: str | None = None):
+        """
+        Tags every call recorded inside the block with a company and/or stage.
+
+        Args:
+            company (str | None): The company the calls are made for.
+            stage (str | None): The pipeline stage the calls are made in.
+        """
+        tokens = []
+        if company is not None:
+            tokens.append((self._company, self._company.set(company)))
+        if stage is not None:
+            tokens.append((self._stage, self._stage.set(stage)))
+        try:
+            yield
+        finally:
+            for var, token in reversed(tokens):
+                var.reset(token)
+
+    def current_tags(self) -> dict:
+        """
+        Gets the tags of the current context, see tags().
+
+        Returns:
+            dict: The "company" and "stage" set in the current context, or None.
+        """
+        return {"company": self._company.get(), "stage": self._stage.get()}
+
+    def _new_call(self, kind: str, operation: str, **fields) -> dict:
+        """
+        Builds a call record with the current tags and all counters set to zero.
+
+        Args:
+            kind (str): The kind of call (e.g. http, maps, gemini, stage, checkpoint).
+            operation (str): The operation performed (e.g. fetch, geocode, generate_content).
+            **fields: Any additional fields to store on the call (e.g. model, url).
+
+        Returns:
+            dict: The call record.
+        """
+        call = {
+            "kind": kind,
+            "operation": operation,
+            "company": self._company.get(),
+            "stage": self._stage.get(),
+            "latency_s": 0.0,
+            "bytes_sent": 0,
+            "bytes_received": 0,
+            "prompt_tokens": 0,
+            "output_tokens": 0,
+            "thinking_tokens": 0,
+            "cached_tokens": 0,
+            "retries": 0,
+            "cost_usd": 0.0,
+            "queue_wait_s": 0.0,
+            "quota_wait_s": 0.0,
+            "cache_hit": False,
+            "error": None
+        }
+        call.update(fields)
+        return call
+
+    def _append(self, call: dict) -> None:
+        """Aggregates and stores a finished call record. Calls can be recorded from several threads at once."""
+        with self._lock:
+            self._aggregate(call)
+            self.calls.append(call)
+            # NOTE: Trimmed by a tenth of MAX_CALLS at a time, so that the list is not shifted on every call once full
+            if len(self.calls) > self.MAX_CALLS + self.MAX_CALLS // 10:
+                dropped = len(self.calls) - self.MAX_CALLS
+                del self.calls[:dropped]
+                self.calls_dropped += dropped
+
+    @property
+    def calls_recorded(self) -> int:
+        """
+        The number of calls recorded so far, including the ones dropped from calls. It only ever grows, so it can mark a point
+        of the run to pass to calls_since() later.
+        """
+        with self._lock:
+            return self.calls_dropped + len(self.calls)
+
+    def calls_since(self, mark: int) -> list[dict]:
+        """
+        Lists the call records recorded after a point of the run.
+        NOTE: calls is trimmed from the front in long runs, so slicing it with an earlier len(calls) would skip calls.
+
+        Args:
+            mark (int): The value of calls_recorded at that point.
+
+        Returns:
+            list[dict]: The call records recorded since, oldest first. Those already dropped (see MAX_CALLS) are missing.
+        """
+        with self._lock:
+            return self.calls[max(mark - self.calls_dropped, 0):]
+
+    def _track_company(self, company: str | None) -> str:
+        """
+        Marks a company as the most recently seen, and folds the least recently seen ones beyond MAX_COMPANIES into
+        OTHER_COMPANY. Must be called with the lock held.
+        NOTE: Folded by a tenth of MAX_COMPANIES at a time, as folding goes through every aggregate.
+
+        Args:
+            company (str | None): The company a call is recorded for.
+
+        Returns:
+            str: The company to aggregate the call under.
+        """
+        if company is None or company == self.OTHER_COMPANY:
+            return company
+        if company in self._companies:
+            self._companies.move_to_end(company)
+            return company
+
+        self._companies[company] = None
+        if len(self._companies) > self.MAX_COMPANIES + self.MAX_COMPANIES // 10:
+            folded = set()
+            while len(self._companies) > self.MAX_COMPANIES:
+                folded.add(self._companies.popitem(last=False)[0])
+            self._fold_companies(folded)
+        return company
+
+    def _fold_companies(self, companies: set[str]) -> None:
+        """Merges the aggregates of companies into those of OTHER_COMPANY. Must be called with the lock held."""
+        for key in [key for key in self._groups if key[0] in companies]:
+            group = self._groups.pop(key)
+            other_key = (self.OTHER_COMPANY, *key[1:])
+            other = self._groups.get(other_key)
+            if other is None:
+                group["company"] = self.OTHER_COMPANY
+                self._groups[other_key] = group
+                continue
+            for field in ("calls", "errors", "cache_hits", *self.SUMMED_FIELDS):
+                other[field] += group[field]
+            other["max_latency_s"] = max(other["max_latency_s"], group["max_latency_s"])
+
+        for key in [key for key in self.avoided_calls if key[0] in companies]:
+            other_key = (self.OTHER_COMPANY, *key[1:])
+            self.avoided_calls[other_key] = self.avoided_calls.get(other_key, 0) + self.avoided_calls.pop(key)
+
+    def _aggregate(self, call: dict) -> None:
+        """Adds a call record to the aggregated groups. Must be called with the lock held."""
+        key = (self._track_company(call["company"]), call["stage"], call["kind"], call["operation"], call.get("model"))
+        group = self._groups.get(key)
+        if group is None:
+            group = {"company": key[0], "stage": key[1], "kind": key[2], "operation": key[3], "model": key[4],
+                     "calls": 0, "errors": 0, "cache_hits": 0, "max_latency_s": 0.0}
+            group.update({field: 0 for field in self.SUMMED_FIELDS})
+            self._groups[key] = group
+
+        if call["cache_hit"]:
+            group["cache_hits"] += 1
+            return
+
+        group["calls"] += 1
+        group["errors"] += 1 if call["error"] else 0
+        group["max_latency_s"] = max(group["max_latency_s"], call["latency_s"])
+        for field in self.SUMMED_FIELDS:
+            group[field] += call[field]
+
+        if call["kind"] == "gemini":
+            key = (call["stage"], call.get("model"))
+            group = self._stage_cost_groups.setdefault(key, {"stage": key[0], "model": key[1], "calls": 0, "escalations": 0,
+                                                             "latency_s": 0.0, "max_latency_s": 0.0, "cost_usd": 0.0})
+            group["calls"] += 1
+            group["escalations"] += 1 if call.get("escalated_from") else 0
+            group["latency_s"] += call["latency_s"]
+            group["max_latency_s"] = max(group["max_latency_s"], call["latency_s"])
+            group["cost_usd"] += call["cost_usd"]
+
+    @contextmanager
+    def track(self, kind: str, operation: str, **fields):
+        """
+        Times the block as one call. The yielded call record can be filled in with bytes, tokens and retries inside the block.
+        If the block raises, the exception type is recorded as the call error and the exception is re-raised.
+
+        Args:
+            kind (str): The kind of call (e.g. http, maps, gemini).
+            operation (str): The operation performed (e.g. fetch, geocode, generate_content).
+            **fields: Any additional fields to store on the call (e.g. model, url).
+
+        Yields:
+            dict: The call record.
+        """
+        call = self._new_call(kind, operation, **fields)
+        start = time.perf_counter()
+        try:
+            yield call
+        except BaseException as e:
+            call["error"] = type(e).__name__
+            raise
+        finally:
+            call["latency_s"] = time.perf_counter() - start
+            self._append(call)
+
+    def record_cache_hit(self, kind: str, operation: str, **fields) -> None:
+        """
+        Records a call that was avoided because its result was already available (e.g. a reused checkpoint).
+
+        Args:
+            kind (str): The kind of cache (e.g. checkpoint).
+            operation (str): What was looked up (e.g. the stage name).
+            **fields: Any additional fields to store on the record.
+        """
+        call = self._new_call(kind, operation, **fields)
+        call["cache_hit"] = True
+        self._append(call)
+
+    def record_avoided_call(self, kind: str, operation: str, reason: str, count: int = 1) -> None:
+        """
+        Counts calls that were not made because their input was invalid (e.g. an address that could not be extracted is not
+        geocoded). They are counted apart from the recorded calls, as they never happened.
+
+        Args:
+            kind (str): The kind of call (e.g. maps, gemini).
+            operation (str): The operation that was not performed (e.g. geocode, generate_content).
+            reason (str): Why the input was invalid.
+            count (int): The number of calls avoided.
+        """
+        if count <= 0:
+            return
+        with self._lock:
+            key = (self._track_company(self._company.get()), self._stage.get(), kind, operation, reason)
+            self.avoided_calls[key] = self.avoided_calls.get(key, 0) + count
+
+    def avoided_summary(self, company: str | None = None) -> list[dict]:
+        """
+        Lists the calls avoided because their input was invalid, see record_avoided_call().
+
+        Args:
+            company (str | None): Only list the calls avoided for this company.
+
+        Returns:
+            list[dict]: One entry per company, stage, kind, operation and reason with the number of calls avoided.
+        """
+        with self._lock:
+            avoided_calls = list(self.avoided_calls.items())
+        return [{"company": key[0], "stage": key[1], "kind": key[2], "operation": key[3], "reason": key[4], "calls": count}
+                for key, count in avoided_calls if company is None or key[0] == company]
+
+    def set_gauge(self, name: str, value: float, help_text: str, **labels) -> None:
+        """
+        Sets the current value of a gauge, e.g. the concurrency limit of a Gemini model.
+
+        Args:
+            name (str): The name of the gauge, exported as arcs_<name>.
+            value (float): The current value.
+            help_text (str): What the gauge measures, for the Prometheus HELP line.
+            **labels: The labels identifying the gauge (e.g. model).
+        """
+        with self._lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = {"name": name, "help": help_text, "labels": labels, "value": value}
+
+    @classmethod
+    def record_gemini_usage(cls, call: dict, response) -> None:
+        """
+        Copies the token counts of a Gemini response onto a call record, and prices them with the model of the call.
+
+        Args:
+            call (dict): The call record.
+            response (genai.types.GenerateContentResponse): The Gemini response.
+        """
+        usage = getattr(response, "usage_metadata", None)
+        if not usage:
+            return
+        call["prompt_tokens"] += getattr(usage, "prompt_token_count", None) or 0
+        call["output_tokens"] += getattr(usage, "candidates_token_count", None) or 0
+        call["thinking_tokens"] += getattr(usage, "thoughts_token_count", None) or 0
+        call["cached_tokens"] += getattr(usage, "cached_content_token_count", None) or 0
+
+        # NOTE: Models without a known price (e.g. previews) are recorded at no cost rather than guessed.
+        prices = cls.MODEL_PRICES.get(call.get("model"))
+        if prices:
+            call["cost_usd"] = ((call["prompt_tokens"] - call["cached_tokens"]) * prices["input"] + call["cached_tokens"] * prices["cached"]
+                                + (call["output_tokens"] + call["thinking_tokens"]) * prices["output"]) / 1_000_000
+
+    def summary(self) -> list[dict]:
+        """
+        Aggregates the recorded calls per company, stage, kind, operation and model.
+        The calls of companies beyond MAX_COMPANIES are aggregated under OTHER_COMPANY.
+
+        Returns:
+            list[dict]: One entry per group with call, error and cache hit counts and the summed counters.
+        """
+        with self._lock:
+            return [dict(group) for group in self._groups.values()]
+
+    def stage_costs(self) -> list[dict]:
+        """
+        Aggregates the Gemini calls per stage and model, to compare the cost and latency of each route.
+
+        Returns:
+            list[dict]: One entry per stage and model with the calls, escalated calls, mean and max latency and the cost in USD.
+        """
+        with self._lock:
+            groups = [dict(group) for group in self._stage_cost_groups.values()]
+
+        return [{"stage": group["stage"], "model": group["model"], "calls": group["calls"], "escalations": group["escalations"],
+                 "mean_latency_s": round(group["latency_s"] / group["calls"], 4), "max_latency_s": round(group["max_latency_s"], 4),
+                 "cost_usd": round(group["cost_usd"], 6)} for group in groups]
+
+    def format_stage_costs(self) -> str:
+        """
+        Formats the Gemini cost and latency per stage and model, see stage_costs().
+
+        Returns:
+            str: One line per stage and model, followed by the total cost.
+        """
+        stage_costs = self.stage_costs()
+        lines = ["Gemini calls per stage and model:"]
+        for group in stage_costs:
+            escalations = f" ({group['escalations']} escalated)" if group["escalations"] else ""
+            lines.append(f"  - {group['stage']} / {group['model']}: {group['calls']} calls{escalations}, "
+                         f"{group['mean_latency_s']}s mean, {group['max_latency_s']}s max, ${group['cost_usd']:.4f}")
+        lines.append(f"  Total: ${sum(group['cost_usd'] for group in stage_costs):.4f}")
+        return "\n".join(lines)
+
+    def write_json(self, report_path: str) -> None:
+        """
+        Writes a JSON run report with the aggregated metrics and the latest recorded calls (see MAX_CALLS).
+
+        Args:
+            report_path (str): The path of the JSON file to write.
+        """
+        with self._lock:
+            calls = list(self.calls)
+            gauges = list(self.gauges.values())
+
+        report = {
+            "run_id": self.run_id,
+            "started_at": self.started_at.isoformat(timespec="seconds"),
+            "finished_at": datetime.now().isoformat(timespec="seconds"),
+            "summary": self.summary(),
+            "stage_costs": self.stage_costs(),
+            "avoided_calls": self.avoided_summary(),
+            "gauges": [{"name": gauge["name"], **gauge["labels"], "value": gauge["value"]} for gauge in gauges],
+            "calls_dropped": self.calls_dropped,
+            "calls": calls
+        }
+
+        Path(report_path).parent.mkdir(parents=True, exist_ok=True)
+        with open(report_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+    @staticmethod
+    def _prometheus_labels(group: dict) -> str:
+        """
+        Formats the labels of an aggregated group in the Prometheus text format.
+
+        Args:
+            group (dict): An entry returned by summary().
+
+        Returns:
+            str: The labels, e.g. {kind="gemini",operation="generate_content",...}.
+        """
+        labels = []
+        for name in ("company", "stage", "kind", "operation", "model"):
+            value = group.get(name) or ""
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            labels.append(f'{name}="{value}"')
+        return "{" + ",".join(labels) + "}"
+
+    def to_prometheus(self) -> str:
+        """
+        Formats the aggregated metrics in the Prometheus text exposition format.
+
+        Returns:
+            str: The metrics, one sample per line.
+        """
+        metric_fields = [
+            ("arcs_calls_total", "counter", "Number of external calls made.", "calls"),
+            ("arcs_call_errors_total", "counter", "Number of external calls that failed.", "errors"),
+            ("arcs_cache_hits_total", "counter", "Number of calls avoided because the result was cached.", "cache_hits"),
+            ("arcs_call_latency_seconds_sum", "counter", "Total time spent in external calls.", "latency_s"),
+            ("arcs_call_latency_seconds_max", "gauge", "Slowest external call.", "max_latency_s"),
+            ("arcs_bytes_sent_total", "counter", "Bytes sent to external services.", "bytes_sent"),
+            ("arcs_bytes_received_total", "counter", "Bytes received from external services.", "bytes_received"),
+            ("arcs_prompt_tokens_total", "counter", "Gemini prompt tokens.", "prompt_tokens"),
+            ("arcs_output_tokens_total", "counter", "Gemini output tokens.", "output_tokens"),
+            ("arcs_thinking_tokens_total", "counter", "Gemini thinking tokens.", "thinking_tokens"),
+            ("arcs_cached_tokens_total", "counter", "Gemini prompt tokens served from a context cache.", "cached_tokens"),
+            ("arcs_retries_total", "counter", "Retries of external calls.", "retries"),
+            ("arcs_cost_usd_total", "counter", "Estimated Gemini cost in USD at list prices.", "cost_usd"),
+            ("arcs_queue_wait_seconds_sum", "counter", "Total time calls waited for a concurrency slot.", "queue_wait_s"),
+            ("arcs_quota_wait_seconds_sum", "counter", "Total time calls waited for the shared rate limit quota.", "quota_wait_s"),
+        ]
+
+        summary = self.summary()
+        lines = []
+        for metric_name, metric_type, help_text, field in metric_fields:
+            lines.append(f"# HELP {metric_name} {help_text}")
+            lines.append(f"# TYPE {metric_name} {metric_type}")
+            for group in summary:
+                lines.append(f"{metric_name}{self._prometheus_labels(group)} {group[field]}")
+
+        avoided_summary = self.avoided_summary()
+        if avoided_summary:
+            lines.append("# HELP arcs_calls_avoided_total Number of external calls not made because their input was invalid.")
+            lines.append("# TYPE arcs_calls_avoided_total counter")
+            for group in avoided_summary:
+                reason = group["reason"].replace("\\", "\\\\").replace('"', '\\"')
+                lines.append(f'arcs_calls_avoided_total{self._prometheus_labels(group)[:-1]},reason="{reason}"}} {group["calls"]}')
+
+        with self._lock:
+            gauges = list(self.gauges.values())
+        for name in dict.fromkeys(gauge["name"] for gauge in gauges):
+            samples = [gauge for gauge in gauges if gauge["name"] == name]
+            lines.append(f"# HELP arcs_{name} {samples[0]['help']}")
+            lines.append(f"# TYPE arcs_{name} gauge")
+            for gauge in samples:
+                labels = ",".join(f'{label}="{value}"' for label, value in gauge["labels"].items())
+                lines.append(f"arcs_{name}{{{labels}}} {gauge['value']}")
+
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, textfile_path: str) -> None:
+        """
+        Writes the aggregated metrics as a Prometheus textfile (e.g. for the node_exporter textfile collector).
+        The file is written to a temporary path first and then moved into place, so that it is never read half-written.
+
+        Args:
+            textfile_path (str): The path of the .prom file to write.
+        """
+        Path(textfile_path).parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = f"{textfile_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, textfile_path)
+
+    def write_reports(self, metrics_dir: str) -> tuple[str, str]:
+        """
+        Writes both the JSON run report and the Prometheus textfile into a directory.
+
+        Args:
+            metrics_dir (str): The directory to write the reports into.
+
+        Returns:
+            tuple[str, str]: The paths of the JSON report and the Prometheus textfile.
+        """
+        json_path = str(Path(metrics_dir) / f"run_{self.run_id}.json")
+        prometheus_path = str(Path(metrics_dir) / "arcs.prom")
+        self.write_json(json_path)
+        self.write_prometheus(prometheus_path)
+        logging.info(f"Wrote metrics to {json_path} and {prometheus_path}")
+        return json_path, prometheus_path
+
+# Process-wide metrics recorder shared by every agent and API client
+metrics = MetricsRecorder()
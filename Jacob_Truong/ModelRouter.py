@@ -0,0 +1,107 @@
+import json
+import os
+
+class ModelRouter():
+    """
+    A class holding the routing table that sets the Gemini model and generation config of each pipeline stage, and the checks
+    that decide when the output of a cheap model is not good enough and the call is escalated to a stronger model.
+    NOTE: The table can be tuned without code changes by pointing the ARCS_MODEL_ROUTES environment variable to a JSON file
+    with the same shape as DEFAULT_ROUTES. Its entries are merged over the defaults, stage by stage.
+    """
+
+    # Per stage: the model, the maximum output tokens (which include the thinking tokens), the thinking budget (0 turns thinking off,
+    # -1 lets the model decide), the temperature, and the stronger model to escalate to when the output fails validation (or None).
+    DEFAULT_ROUTES = {
+        "addresses": {"model": "gemini-2.5-flash-lite", "max_output_tokens": 2048, "thinking_budget": 0, "temperature": 0.0, "escalate_to": "gemini-2.5-flash"},
+        "background": {"model": "gemini-2.5-flash", "max_output_tokens": 4096, "thinking_budget": 1024, "temperature": 0.3, "escalate_to": None},
+        "products": {"model": "gemini-2.5-flash", "max_output_tokens": 4096, "thinking_budget": 1024, "temperature": 0.2, "escalate_to": None},
+        "satellite_analysis": {"model": "gemini-2.5-flash", "max_output_tokens": 6144, "thinking_budget": 2048, "temperature": 0.2, "escalate_to": "gemini-2.5-pro"},
+        "report": {"model": "gemini-2.5-flash-lite", "max_output_tokens": 8192, "thinking_budget": 0, "temperature": 0.0, "escalate_to": "gemini-2.5-flash"}
+    }
+
+    # Models that only run in thinking mode, with the smallest thinking budget they accept. A route turning thinking off (0)
+    # is given a dynamic budget (-1) on them instead, as the API rejects every call otherwise.
+    THINKING_ONLY_MODELS = {"gemini-2.5-pro": 128}
+
+    def __init__(self, routes: dict | None = None):
+        """
+        Initialise the router.
+
+        Args:
+            routes (dict | None): Routes to merge over the defaults. If not provided, the file in ARCS_MODEL_ROUTES is used, if any.
+        """
+        self.routes = {stage: dict(route) for stage, route in self.DEFAULT_ROUTES.items()}
+
+        if routes is None and os.getenv("ARCS_MODEL_ROUTES"):
+            with open(os.getenv("ARCS_MODEL_ROUTES"), encoding="utf-8") as f:
+                routes = json.load(f)
+        for stage, route in (routes or {}).items():
+            self.routes.setdefault(stage, {}).update(route)
+
+    def route(self, stage: str) -> dict | None:
+        """
+        Returns the model and generation config of a stage.
+        NOTE: If the GEMINI_MODEL environment variable is set, it pins the model of every stage (escalations still apply).
+        The thinking budget of the stage is then fitted to the pinned model, see with_model(), e.g. the stages that turn
+        thinking off get a dynamic budget on gemini-2.5-pro, which only runs in thinking mode.
+
+        Args:
+            stage (str): The name of the pipeline stage.
+
+        Returns:
+            dict | None: The route of the stage, or None if the stage has no route.
+        """
+        route = self.routes.get(stage)
+        if route is None:
+            return None
+
+        route = self.with_model(route, os.getenv("GEMINI_MODEL") or route["model"])
+        if route.get("escalate_to") == route["model"]:
+            route["escalate_to"] = None
+        return route
+
+    @classmethod
+    def with_model(cls, route: dict, model: str) -> dict:
+        """
+        Returns a route run on another model (e.g. the pinned model, or the model an output is escalated to), with its
+        thinking budget fitted to the model, see THINKING_ONLY_MODELS.
+
+        Args:
+            route (dict): The route of the stage.
+            model (str): The model to run the route on.
+
+        Returns:
+            dict: A copy of the route with the model and the thinking budget it can be run with.
+        """
+        route = dict(route, model=model)
+        min_budget = cls.THINKING_ONLY_MODELS.get(model)
+        budget = route.get("thinking_budget")
+        if min_budget and budget is not None and budget != -1 and budget < min_budget:
+            route["thinking_budget"] = -1 if budget == 0 else min_budget
+        return route
+
+    @staticmethod
+    def is_valid(stage: str, text: str) -> bool:
+        """
+        Checks whether the output of a stage looks usable, e.g. whether an address contains a house number or the
+        vision analysis covers the flood risk and the roof.
+
+        Args:
+            stage (str): The name of the pipeline stage.
+            text (str): The output text of the model.
+
+        Returns:
+            bool: True if the output passes the checks of the stage (stages without checks always pass).
+        """
+        text = (text or "").strip()
+        if stage == "addresses":
+            return any(any(character.isdigit() for character in line) for line in text.splitlines())
+        if stage == "background":
+            return len(text.split()) >= 50
+        if stage == "products":
+            return any(line.strip().startswith(("-", "*")) for line in text.splitlines())
+        if stage == "satellite_analysis":
+            return "flood" in text.lower() and "roof" in text.lower()
+        if stage == "report":
+            return text.startswith("#") and "background" in text.lower()
+        return True
@@ -0,0 +1,127 @@
+import os
+import threading
+import multiprocessing
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+def parse_page(content: bytes | str, encoding: str | None = None) -> dict:
+    """
+    Parses raw HTML and extracts the visible text and the links of the page.
+    NOTE: This runs in a worker process, so it takes and returns only plain, compact data. The parse tree never leaves the worker.
+
+    Args:
+        content (bytes | str): The HTML of the page, raw or already decoded.
+        encoding (str | None): The character encoding of raw HTML, if known. Otherwise it is detected from the bytes.
+
+    Returns:
+        dict: The page text under "text" (one visible string per line), and a list of (link text, href) pairs under "links".
+    """
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(content, 'html.parser', from_encoding=encoding)
+    links = [(a_tag.get_text(strip=True), a_tag['href']) for a_tag in soup.find_all('a', href=True)]
+    text = soup.get_text(separator='\n', strip=True)
+    soup.decompose()
+
+    return {"text": text, "links": links}
+
+
+class PageParser():
+    """
+    A class that runs HTML parsing and text extraction in a pool of worker processes.
+    Parsing is CPU-bound and holds the GIL, so in a concurrent batch it would otherwise starve the threads waiting on
+    page downloads and API calls. Offloading it keeps those threads I/O-bound and lets parsing scale with the number of cores.
+    NOTE: A single process-wide instance (page_parser) is shared by every agent, see the bottom of this file.
+    """
+
+    def __init__(self, processes: int | None = None):
+        """
+        Initialise the parser. The worker processes are only started when the first page is parsed.
+
+        Args:
+            processes (int | None): The number of worker processes. 0 parses in the calling thread instead. If not provided,
+                the ARCS_PARSER_PROCESSES environment variable is used, or one process per core (up to 8) on multi-core machines.
+        """
+        if processes is None:
+            configured = os.getenv("ARCS_PARSER_PROCESSES")
+            if configured:
+                processes = int(configured)
+            else:
+                # NOTE: On a single core, a worker process only adds pickling overhead, so parse in the calling thread
+                cores = os.cpu_count() or 1
+                processes = min(cores, 8) if cores > 1 else 0
+
+        self.processes = processes
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        """
+        Starts the worker processes on first use.
+
+        Returns:
+            ProcessPoolExecutor: The pool of worker processes.
+        """
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    # NOTE: "spawn" is used rather than "fork", as forking a process that is running other threads
+                    # (HTTP servers, worker pools) can deadlock the child on a lock held at the time of the fork.
+                    self._pool = ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context("spawn"))
+                    logging.info(f"Started {self.processes} HTML parser processes.")
+        return self._pool
+
+    def _replace_broken_pool(self, pool: ProcessPoolExecutor) -> None:
+        """
+        Drops a pool that lost a worker process, so that the next page starts a new one.
+        NOTE: Several threads may see the same pool break, so it is only dropped if no other thread replaced it yet.
+
+        Args:
+            pool (ProcessPoolExecutor): The broken pool.
+        """
+        with self._pool_lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def parse(self, content: bytes | str, encoding: str | None = None) -> dict:
+        """
+        Parses a page in a worker process and waits for the result.
+        If a worker process dies (e.g. out of memory on a bad page), the pool is replaced and the page is parsed once more.
+
+        Args:
+            content (bytes | str): The HTML of the page, raw or already decoded.
+            encoding (str | None): The character encoding of raw HTML, if known.
+
+        Returns:
+            dict: The page text under "text", and a list of (link text, href) pairs under "links".
+
+        Raises:
+            BrokenProcessPool: If the page broke the new pool as well. The pool is replaced again for the next pages.
+        """
+        if not self.processes:
+            return parse_page(content, encoding)
+
+        for attempt in range(2):
+            pool = self._get_pool()
+            try:
+                return pool.submit(parse_page, content, encoding).result()
+            except BrokenProcessPool:
+                logging.warning(f"An HTML parser process died, starting new ones (attempt {attempt + 1} of 2).")
+                self._replace_broken_pool(pool)
+                # NOTE: The page is not parsed in this process instead, as whatever killed the worker would take the whole run down
+                if attempt == 1:
+                    raise
+
+    def shutdown(self) -> None:
+        """
+        Stops the worker processes. They are started again if another page is parsed afterwards.
+        """
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+# Process-wide parser shared by every agent
+page_parser = PageParser()
@@ -0,0 +1,156 @@
+import math
+import re
+import logging
+
+# NOTE: numpy is only imported when the first text is ranked (see rank), in line with the other heavy libraries.
+
+class PassageRanker():
+    """
+    A class that ranks passages of scraped text against a stage-specific query with BM25, entirely locally, so that only
+    the most relevant passages (within a token budget) are sent to Gemini instead of everything scraped from every page.
+    """
+
+    # What each stage is looking for in the scraped text
+    QUERIES = {
+        "background": "history founded founder founding established year since began started milestones milestone acquired acquisition "
+                      "merger expanded expansion growth headquarters headquartered offices employees staff team operations operates "
+                      "facility facilities plant manufacturing company about mission today global countries customers",
+        "products": "products product services service solutions solution offer offers offering range portfolio manufacture manufactures "
+                    "manufacturing supply supplies provide provides design build install platform software systems equipment brands "
+                    "industries customers applications features"
+    }
+
+    # Roughly 4 characters per token, like the Gemini tokeniser on English text
+    CHARS_PER_TOKEN = 4
+
+    def __init__(self, chunk_words: int = 120, overlap_words: int = 20, top_k: int = 20, token_budget: int = 4000, k1: float = 1.5, b: float = 0.75):
+        """
+        Initialise the ranker.
+
+        Args:
+            chunk_words (int): The number of words per passage.
+            overlap_words (int): The number of words shared by consecutive passages, so that a sentence cut in two is still found whole.
+            top_k (int): The maximum number of passages kept.
+            token_budget (int): The maximum number of (estimated) tokens kept.
+            k1 (float): The BM25 term frequency saturation.
+            b (float): The BM25 passage length normalisation.
+        """
+        self.chunk_words = chunk_words
+        self.overlap_words = min(overlap_words, chunk_words - 1)
+        self.top_k = top_k
+        self.token_budget = token_budget
+        self.k1 = k1
+        self.b = b
+
+    @staticmethod
+    def _tokenise(text: str) -> list[str]:
+        """Splits text into lowercase word tokens."""
+        return re.findall(r"[a-z0-9]+", text.casefold())
+
+    def estimate_tokens(self, text: str) -> int:
+        """
+        Estimates the number of tokens of a text.
+
+        Args:
+            text (str): The text.
+
+        Returns:
+            int: The estimated number of tokens.
+        """
+        return math.ceil(len(text) / self.CHARS_PER_TOKEN)
+
+    def chunk(self, text: str) -> list[str]:
+        """
+        Splits text into overlapping passages of chunk_words words. Passages repeated word for word (e.g. the same footer
+        scraped from several pages) are only kept once.
+
+        Args:
+            text (str): The scraped text.
+
+        Returns:
+            list[str]: The passages, in their original order.
+        """
+        words = text.split()
+        step = self.chunk_words - self.overlap_words
+        passages = {}
+        for start in range(0, max(len(words) - self.overlap_words, 1), step):
+            passage = " ".join(words[start:start + self.chunk_words])
+            if passage:
+                passages.setdefault(passage, None)
+        return list(passages)
+
+    def rank(self, passages: list[str], query: str) -> list[float]:
+        """
+        Scores every passage against the query with BM25.
+        NOTE: Only the query terms are counted, so the term matrix has one column per query term instead of one per word of the text.
+
+        Args:
+            passages (list[str]): The passages to score.
+            query (str): The query, as words separated by spaces.
+
+        Returns:
+            list[float]: The score of each passage, in the same order (0 for passages without any query term).
+        """
+        import numpy as np
+
+        query_terms = list(dict.fromkeys(self._tokenise(query)))
+        if not passages or not query_terms:
+            return [0.0] * len(passages)
+
+        term_ids = {term: i for i, term in enumerate(query_terms)}
+        passage_tokens = [self._tokenise(passage) for passage in passages]
+        lengths = np.array([len(tokens) for tokens in passage_tokens], dtype=np.float64)
+
+        # Term frequency matrix (passages x query terms), built in one pass over the (passage, term) pairs of query terms
+        pairs = [(row, term_ids[token]) for row, tokens in enumerate(passage_tokens) for token in tokens if token in term_ids]
+        term_frequencies = np.zeros((len(passages), len(query_terms)), dtype=np.float64)
+        if pairs:
+            rows, columns = np.array(pairs, dtype=np.int64).T
+            np.add.at(term_frequencies, (rows, columns), 1.0)
+
+        passage_count = len(passages)
+        document_frequencies = np.count_nonzero(term_frequencies, axis=0)
+        idf = np.log(1.0 + (passage_count - document_frequencies + 0.5) / (document_frequencies + 0.5))
+
+        average_length = lengths.mean() if lengths.mean() > 0 else 1.0
+        length_norm = self.k1 * (1.0 - self.b + self.b * lengths / average_length)
+        saturated = term_frequencies * (self.k1 + 1.0) / (term_frequencies + length_norm[:, None])
+        return (saturated @ idf).tolist()
+
+    def select(self, text: str, stage: str) -> str:
+        """
+        Keeps the passages of a text most relevant to a stage, up to top_k passages and token_budget tokens.
+        Text that already fits the budget is returned unchanged.
+
+        Args:
+            text (str): The scraped text.
+            stage (str): The stage the text is for (a key of QUERIES).
+
+        Returns:
+            str: The selected passages in their original order, separated by blank lines.
+        """
+        if not text or self.estimate_tokens(text) <= self.token_budget:
+            return text
+
+        passages = self.chunk(text)
+        scores = self.rank(passages, self.QUERIES[stage])
+
+        # Most relevant first. Passages without any query term are only used if nothing else matched.
+        order = sorted(range(len(passages)), key=lambda i: scores[i], reverse=True)
+        if scores[order[0]] > 0:
+            order = [i for i in order if scores[i] > 0]
+
+        selected = []
+        used_tokens = 0
+        for i in order:
+            if len(selected) >= self.top_k:
+                break
+            passage_tokens = self.estimate_tokens(passages[i])
+            if used_tokens + passage_tokens > self.token_budget:
+                # A shorter passage further down may still fit
+                continue
+            selected.append(i)
+            used_tokens += passage_tokens
+
+        logging.info(f"Selected {len(selected)} of {len(passages)} '{stage}' passages ({used_tokens} of ~{self.estimate_tokens(text)} tokens).")
+        return "\n\n".join(passages[i] for i in sorted(selected))
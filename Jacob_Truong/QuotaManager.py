@@ -0,0 +1,290 @@
+from Metrics import metrics
+from Deadline import *
+from contextlib import contextmanager
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+class QuotaManager():
+    """
+    A class holding token buckets for the per-project rate limits of the Gemini and Google Maps APIs (requests and tokens per
+    minute per Gemini model, queries per second per Maps API) in a local SQLite database, so that every process on the machine
+    draws from the same budget. Each bucket holds up to one window of its limit and refills continuously.
+    Taking from several buckets at once (e.g. one Gemini request and its prompt tokens) happens in one locked transaction.
+    NOTE: The database is only used when the ARCS_QUOTA_DB environment variable points to it (see shared()), as a single process
+    is already kept in check by the adaptive limiter and the client libraries.
+    """
+
+    # Gemini limits per model, in requests per minute and input tokens per minute (Tier 1 of the paid tier)
+    GEMINI_LIMITS = {
+        "gemini-2.5-pro": {"rpm": 150, "tpm": 2000000},
+        "gemini-2.5-flash": {"rpm": 1000, "tpm": 1000000},
+        "gemini-2.5-flash-lite": {"rpm": 4000, "tpm": 4000000},
+        "default": {"rpm": 1000, "tpm": 1000000}
+    }
+
+    # Google Maps limits per API, in queries per second
+    MAPS_LIMITS = {"geocode": 50, "static_map": 500}
+
+    # How long a single wait is at most, before the buckets are checked again
+    MAX_SLEEP_S = 1.0
+
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, db_path: str, limits: dict | None = None):
+        """
+        Initialise the quota manager, creating the database if needed.
+
+        Args:
+            db_path (str): The path of the SQLite database shared by every process.
+            limits (dict | None): Limits to merge over the defaults, as {"gemini": {model: {"rpm", "tpm"}}, "maps": {operation: qps}}.
+                If not provided, the JSON file in ARCS_QUOTA_LIMITS is used, if any.
+        """
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+
+        self.gemini_limits = {model: dict(limit) for model, limit in self.GEMINI_LIMITS.items()}
+        self.maps_limits = dict(self.MAPS_LIMITS)
+        if limits is None and os.getenv("ARCS_QUOTA_LIMITS"):
+            with open(os.getenv("ARCS_QUOTA_LIMITS"), encoding="utf-8") as f:
+                limits = json.load(f)
+        for model, limit in (limits or {}).get("gemini", {}).items():
+            self.gemini_limits.setdefault(model, dict(self.gemini_limits["default"])).update(limit)
+        self.maps_limits.update((limits or {}).get("maps", {}))
+
+        # Each thread gets its own connection, as sqlite3 connections should not be shared between threads
+        self._local = threading.local()
+        self._configured = set()
+        with self._transaction() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, capacity REAL NOT NULL, "
+                               "refill_per_s REAL NOT NULL, tokens REAL NOT NULL, updated_at REAL NOT NULL)")
+
+    @classmethod
+    def shared(cls) -> "QuotaManager | None":
+        """
+        Returns the quota manager of the database in ARCS_QUOTA_DB, shared by every client in this process.
+
+        Returns:
+            QuotaManager | None: The quota manager, or None if ARCS_QUOTA_DB is not set.
+        """
+        db_path = os.getenv("ARCS_QUOTA_DB")
+        if not db_path:
+            return None
+        with cls._shared_lock:
+            if db_path not in cls._shared:
+                cls._shared[db_path] = cls(db_path)
+            return cls._shared[db_path]
+
+    def _connection(self) -> sqlite3.Connection:
+        """Returns the connection of the current thread, opening it on first use."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # NOTE: Autocommit mode, so that transactions are started explicitly with BEGIN IMMEDIATE (see _transaction).
+            connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Runs the block in a transaction holding the database write lock, so that no other process reads the buckets in between.
+
+        Yields:
+            sqlite3.Connection: The connection of the current thread.
+        """
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def _configure(self, connection: sqlite3.Connection, name: str, capacity: float, refill_per_s: float) -> None:
+        """Creates a bucket (full) or updates its limit, keeping its current level. Must be called inside a transaction."""
+        if name in self._configured:
+            return
+        connection.execute("INSERT INTO buckets (name, capacity, refill_per_s, tokens, updated_at) VALUES (?, ?, ?, ?, ?) "
+                           "ON CONFLICT(name) DO UPDATE SET capacity = excluded.capacity, refill_per_s = excluded.refill_per_s",
+                           (name, capacity, refill_per_s, capacity, time.time()))
+        self._configured.add(name)
+
+    def _bucket_limits(self, name: str) -> tuple[float, float]:
+        """
+        Returns the capacity and refill rate of a bucket from its name.
+
+        Args:
+            name (str): The bucket, e.g. "gemini/gemini-2.5-flash/requests", "gemini/gemini-2.5-flash/tokens" or "maps/geocode".
+
+        Returns:
+            tuple[float, float]: The capacity (one window of the limit) and the refill rate per second.
+        """
+        service, _, rest = name.partition("/")
+        if service == "maps":
+            qps = float(self.maps_limits.get(rest, 50))
+            return qps, qps
+
+        model, _, kind = rest.rpartition("/")
+        limit = self.gemini_limits.get(model, self.gemini_limits["default"])
+        per_minute = float(limit["rpm"] if kind == "requests" else limit["tpm"])
+        return per_minute, per_minute / 60.0
+
+    def try_acquire(self, costs: dict[str, float]) -> float:
+        """
+        Takes the costs from their buckets if every bucket can cover them, or nothing at all.
+        NOTE: A cost larger than the capacity of its bucket only needs a full bucket, and leaves the bucket in debt, so that it can still go through.
+
+        Args:
+            costs (dict[str, float]): The amount to take per bucket, e.g. {"gemini/gemini-2.5-flash/requests": 1, "gemini/gemini-2.5-flash/tokens": 1200}.
+
+        Returns:
+            float: 0 if the costs were taken, otherwise how long to wait in seconds until they can be covered.
+        """
+        wait_s = 0.0
+        levels = {}
+        with self._transaction() as connection:
+            # The time is taken inside the lock, so that the buckets are only ever moved forward in time
+            now = time.time()
+            for name in costs:
+                self._configure(connection, name, *self._bucket_limits(name))
+                capacity, refill_per_s, tokens, updated_at = connection.execute(
+                    "SELECT capacity, refill_per_s, tokens, updated_at FROM buckets WHERE name = ?", (name,)).fetchone()
+                levels[name] = min(capacity, tokens + max(now - updated_at, 0.0) * refill_per_s)
+                shortfall = min(costs[name], capacity) - levels[name]
+                if shortfall > 0:
+                    wait_s = max(wait_s, shortfall / refill_per_s)
+
+            if wait_s:
+                return wait_s
+
+            for name, cost in costs.items():
+                connection.execute("UPDATE buckets SET tokens = ?, updated_at = ? WHERE name = ?", (levels[name] - cost, now, name))
+
+        for name, level in levels.items():
+            metrics.set_gauge("quota_remaining", round(level - costs[name], 1), "Remaining headroom in a shared rate limit bucket.", bucket=name)
+        return 0.0
+
+    def acquire(self, costs: dict[str, float], timeout_s: float | None = None) -> float:
+        """
+        Takes the costs from their buckets, waiting until every bucket can cover them.
+
+        Args:
+            costs (dict[str, float]): The amount to take per bucket, see try_acquire().
+            timeout_s (float | None): The longest to wait in seconds. If not provided, waits for as long as needed.
+
+        Returns:
+            float: How long the call waited in seconds.
+
+        Raises:
+            TimeoutError: If the costs could not be covered within timeout_s.
+        """
+        start = time.monotonic()
+        while True:
+            wait_s = self.try_acquire(costs)
+            if not wait_s:
+                return time.monotonic() - start
+            if timeout_s is not None and time.monotonic() - start + wait_s > timeout_s:
+                raise TimeoutError(f"Rate limit quota not available within {timeout_s}s: {', '.join(costs)}")
+            time.sleep(min(wait_s, self.MAX_SLEEP_S))
+
+    def acquire_within_deadline(self, costs: dict[str, float], what: str) -> float:
+        """
+        Takes the costs from their buckets, waiting at most until the time budget of the current context runs out (see Deadline).
+
+        Args:
+            costs (dict[str, float]): The amount to take per bucket, see try_acquire().
+            what (str): The call the costs are taken for, recorded if it is not made (e.g. "geocode").
+
+        Returns:
+            float: How long the call waited in seconds.
+
+        Raises:
+            DeadlineExceeded: If the costs could not be covered with enough time left to make the call.
+        """
+        deadline = Deadline.current()
+        if deadline is None:
+            return self.acquire(costs)
+        try:
+            return self.acquire(costs, timeout_s=max(deadline.remaining() - Deadline.MIN_CALL_S, 0.0))
+        except TimeoutError:
+            deadline.truncate(what)
+            raise DeadlineExceeded(f"time budget exhausted waiting for the rate limit quota of {what}")
+
+    def adjust(self, name: str, amount: float) -> None:
+        """
+        Takes more from a bucket (positive amount) or gives back to it (negative amount), e.g. once the actual number of
+        tokens of a call is known. The bucket can go into debt, which delays the next calls.
+
+        Args:
+            name (str): The bucket.
+            amount (float): The amount to take, or to give back if negative.
+        """
+        if not amount:
+            return
+        with self._transaction() as connection:
+            self._configure(connection, name, *self._bucket_limits(name))
+            connection.execute("UPDATE buckets SET tokens = MIN(capacity, tokens - ?) WHERE name = ?", (amount, name))
+
+    def acquire_gemini(self, model: str, estimated_tokens: int) -> float:
+        """
+        Takes one request and the estimated input tokens of a Gemini call from the budget of its model.
+
+        Args:
+            model (str): The Gemini model.
+            estimated_tokens (int): The estimated input tokens of the call. Correct it with settle_gemini() once the call returns.
+
+        Returns:
+            float: How long the call waited in seconds.
+
+        Raises:
+            DeadlineExceeded: If the budget could not cover the call within the time budget of the current context.
+        """
+        return self.acquire_within_deadline({f"gemini/{model}/requests": 1, f"gemini/{model}/tokens": estimated_tokens}, f"{model} generate_content")
+
+    def settle_gemini(self, model: str, estimated_tokens: int, actual_tokens: int) -> None:
+        """
+        Corrects the tokens taken for a Gemini call with the actual input tokens reported by the API.
+
+        Args:
+            model (str): The Gemini model.
+            estimated_tokens (int): The tokens taken by acquire_gemini().
+            actual_tokens (int): The input tokens reported by the API.
+        """
+        self.adjust(f"gemini/{model}/tokens", actual_tokens - estimated_tokens)
+
+    def acquire_maps(self, operation: str) -> float:
+        """
+        Takes one query of a Google Maps API from its budget.
+
+        Args:
+            operation (str): The Maps API (geocode or static_map).
+
+        Returns:
+            float: How long the call waited in seconds.
+
+        Raises:
+            DeadlineExceeded: If the budget could not cover the call within the time budget of the current context.
+        """
+        return self.acquire_within_deadline({f"maps/{operation}": 1}, operation)
+
+    def headroom(self) -> list[dict]:
+        """
+        Lists the remaining headroom of every bucket.
+
+        Returns:
+            list[dict]: The name, remaining amount, capacity and share remaining of each bucket.
+        """
+        now = time.time()
+        rows = self._connection().execute("SELECT name, capacity, refill_per_s, tokens, updated_at FROM buckets ORDER BY name").fetchall()
+
+        headroom = []
+        for name, capacity, refill_per_s, tokens, updated_at in rows:
+            remaining = min(capacity, tokens + max(now - updated_at, 0.0) * refill_per_s)
+            headroom.append({"bucket": name, "remaining": round(remaining, 1), "capacity": capacity, "remaining_share": round(remaining / capacity, 3)})
+        return headroom
@@ -1,16 +1,18 @@
 from GeminiAPI import *
+from ClientRegistry import clients
 import logging
 from pathlib import Path
-from datetime import datetime
-
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 class ReportGeneratorAgent():
     """
     An agent responsible for generating reports based on the collected data.
     """
 
-    def __init__(self, company_name: str, address: str, location_info: dict, background: str, products: str, satellite_analysis: dict, assumptions: str = "It is assumed that the LLM correctly identified the property and its boundaries."):
+    # Bump this whenever the report formatting prompt (or the sections added to it) changes, so that incremental refreshes regenerate the report.
+    PROMPT_VERSION = 2
+
+    def __init__(self, company_name: str, address: str, location_info: dict, background: str, products: str, satellite_analysis: dict, assumptions: str = "It is assumed that the LLM correctly identified the property and its boundaries.",
+                 other_locations: list[dict] | None = None, llm: GeminiAPI | None = None):
         """
         Initialise the report generator agent with the necessary information.
 
@@ -22,6 +24,8 @@ class ReportGeneratorAgent():
             products (str): Information about the company's products and services.
             satellite_analysis (dict): Results from the satellite analysis.
             assumptions (str): Any assumptions made during the analysis.
+            other_locations (list[dict] | None): The company's other sites, each with an "address", "location_info", "image_path" and "analysis_text".
+            llm (GeminiAPI | None): A Gemini API client to reuse. If not provided, the shared one of the client registry is used.
         """
 
         self.company_name = company_name
@@ -32,6 +36,7 @@ class ReportGeneratorAgent():
         self.image_path = satellite_analysis.get("image_path", "")
         self.analysis_text = satellite_analysis.get("analysis_text", "")
         self.assumptions = assumptions
+        self.other_locations = other_locations if other_locations else []
 
         if not self.company_name or not self.address:
             raise ValueError("Company name and address are required.")
@@ -42,14 +47,71 @@ class ReportGeneratorAgent():
         if not self.products:
             raise ValueError("Product information is required.")
 
-        if not self.image_path or not self.analysis_text:
+        # NOTE: A site without a satellite image is still reported, with the analysis text saying why it was not analysed.
+        if not self.analysis_text:
             raise ValueError("Satellite analysis results are required.")
 
         # Initialise Gemini API client
-        self.llm = GeminiAPI()
+        self.llm = llm if llm else clients.gemini()
 
         logging.info("ReportGeneratorAgent initialised successfully.")
 
+    def format_other_locations(self) -> str:
+        """
+        Formats the findings of the company's other sites as a Markdown section.
+        NOTE: This section is built without the LLM, as passing every site's analysis through the formatting prompt would multiply
+        its cost and give the model more room to alter the findings.
+
+        Returns:
+            str: The Markdown section, or an empty string if the company has a single site.
+        """
+        if not self.other_locations:
+            return ""
+
+        lines = ["## 5. Other Locations:", f"The company has {len(self.other_locations) + 1} sites. The primary site is covered in section 3."]
+        for index, location in enumerate(self.other_locations, start=2):
+            location_info = location.get("location_info") or {}
+            lines.append("")
+            lines.append(f"### Site {index}: {location['address']} - City: {location_info.get('city') or 'Unknown'} - "
+                         f"State: {location_info.get('state') or 'Unknown'} - Country: {location_info.get('country') or 'Unknown'}")
+            if location.get("image_path"):
+                lines.append(f"![Satellite Image]({location['image_path']})")
+            lines.append("")
+            lines.append(f"**Findings:** {location.get('analysis_text') or 'Not analysed.'}")
+
+        return "\n".join(lines)
+
+    def compile_report(self) -> str:
+        """
+        Lays the given data out in the structure of the report without the LLM, e.g. when there is no time left for the report call.
+        NOTE: The content is the same as in the generated report, but the products are not split into a list and the formatting is plainer.
+
+        Returns:
+            str: The report text in Markdown format.
+        """
+        current_datetime = clients.now()
+        location_info = self.location_info
+        sections = [
+            f"# Title: {self.company_name} - Nature of Operations Report",
+            f"Date: {current_datetime.strftime('%d-%m-%Y')} - Time: {current_datetime.strftime('%H:%M:%S')}",
+            "## 1. Background:",
+            self.background,
+            "## 2. Products & Services:",
+            self.products,
+            "## 3. Location Details:",
+            f"### a. Address: {self.address} - City: {location_info.get('city') or 'Unknown'} - State: {location_info.get('state') or 'Unknown'} - "
+            f"Country: {location_info.get('country') or 'Unknown'}",
+            "### b. Satellite image:",
+            f"![Satellite Image]({self.image_path})" if self.image_path else "Not available",
+            "### c. Findings:",
+            self.analysis_text,
+            "## 4. Assumptions:",
+            self.assumptions
+        ]
+        report = "\n\n".join(sections)
+        other_locations = self.format_other_locations()
+        return f"{report}\n\n{other_locations}" if other_locations else report
+
     def generate_report(self) -> str:
         """
         Use LLM to format the given data into a Markdown-formatted report.
@@ -59,7 +121,7 @@ class ReportGeneratorAgent():
         """
         logging.info("Generating report...")
 
-        current_datetime = datetime.now()
+        current_datetime = clients.now()
         
         prompt = f"""Format the given information into a structured report in markdown format. Do not make any changes to the provided content.
         Do not include explicit ```markdown``` or any other code block indicators. Ensure that the markdown report is formatted properly 
@@ -84,15 +146,17 @@ class ReportGeneratorAgent():
         Location: (CITY: {self.location_info.get("city", "Unknown")} - STATE: {self.location_info.get("state", "Unknown")} - COUNTRY: {self.location_info.get("country", "Unknown")})
         Background: {self.background}
         Products & Services: {self.products}
-        Satellite Image: ![Satellite Image]({self.image_path})
+        Satellite Image: {f"![Satellite Image]({self.image_path})" if self.image_path else "Not available"}
         Findings: {self.analysis_text}
         Assumptions: {self.assumptions}
         """
 
         try:
-            response = self.llm.generate_content(prompt)
+            response = self.llm.generate_content(prompt, stage="report")
             logging.info("Report generated successfully.")
-            return str(response.text).strip().replace("�", "")
+            report = str(response.text).strip().replace("�", "")
+            other_locations = self.format_other_locations()
+            return f"{report}\n\n{other_locations}" if other_locations else report
         except Exception as e:
             logging.error(f"LLM report generation failed: {e}")
 
@@ -0,0 +1,437 @@
+from ResearchPipeline import *
+from ClientRegistry import clients
+from Metrics import metrics
+from PageParser import page_parser
+import json
+import queue
+import threading
+import uuid
+import logging
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class ReportJob():
+    """
+    A research job submitted to the report service, tracking its status and the finished report.
+    """
+
+    def __init__(self, company_name: str, company_url: str, resume: bool = False, refresh: bool = False):
+        """
+        Initialise a queued job.
+
+        Args:
+            company_name (str): The name of the company to research.
+            company_url (str): The URL of the company's website.
+            resume (bool): Whether to reuse valid checkpoints from a previous run.
+            refresh (bool): Whether to only recompute the stages whose inputs changed.
+        """
+        self.job_id = uuid.uuid4().hex
+        self.company_name = company_name
+        self.company_url = company_url
+        self.resume = resume
+        self.refresh = refresh
+
+        self.status = "queued"
+        self.stage_status = {}
+        self.report = None
+        self.report_path = None
+        self.error = None
+        self.created_at = datetime.now()
+        self.started_at = None
+        self.finished_at = None
+
+        # Every status change is appended as an event, which is what the /events stream sends to callers
+        self.events = []
+        self._changed = threading.Condition()
+        self._add_event("queued")
+
+    @property
+    def finished(self) -> bool:
+        """Whether the job has finished, successfully or not."""
+        return self.status in ("done", "failed")
+
+    def _add_event(self, event: str, **fields) -> None:
+        """
+        Records a status change and wakes up anyone streaming the job events.
+
+        Args:
+            event (str): The kind of event (e.g. queued, running, stage, done, failed).
+            **fields: Any additional fields to include in the event.
+        """
+        with self._changed:
+            self.events.append({"event": event, "time": datetime.now().isoformat(timespec="seconds"), **fields})
+            self._changed.notify_all()
+
+    def set_status(self, status: str, **fields) -> None:
+        """
+        Updates the job status.
+
+        Args:
+            status (str): The new status (running, done or failed).
+            **fields: Any additional fields to include in the event.
+        """
+        # NOTE: The status and its event are updated together, so an event stream never sees a finished job without its last event.
+        with self._changed:
+            self.status = status
+            if status == "running":
+                self.started_at = datetime.now()
+            if status in ("done", "failed"):
+                self.finished_at = datetime.now()
+            self._add_event(status, **fields)
+
+    def on_stage(self, stage: str, status: str) -> None:
+        """
+        Stage callback of the pipeline, recording the progress of the job.
+
+        Args:
+            stage (str): The name of the pipeline stage.
+            status (str): What happened to the stage.
+        """
+        self.stage_status[stage] = status
+        self._add_event("stage", stage=stage, status=status)
+
+    def wait_for_events(self, seen: int, timeout: float) -> list[dict]:
+        """
+        Waits until there are events the caller has not seen yet.
+
+        Args:
+            seen (int): The number of events the caller has already received.
+            timeout (float): The maximum time to wait in seconds.
+
+        Returns:
+            list[dict]: The new events, or an empty list if the timeout expired.
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: len(self.events) > seen, timeout=timeout)
+            return self.events[seen:]
+
+    def to_dict(self) -> dict:
+        """
+        Returns the job status as a JSON-serialisable dictionary (without the report itself).
+
+        Returns:
+            dict: The job status.
+        """
+        return {
+            "job_id": self.job_id,
+            "company_name": self.company_name,
+            "company_url": self.company_url,
+            "status": self.status,
+            "stages": self.stage_status,
+            "report_path": self.report_path,
+            "error": self.error,
+            "created_at": self.created_at.isoformat(timespec="seconds"),
+            "started_at": self.started_at.isoformat(timespec="seconds") if self.started_at else None,
+            "finished_at": self.finished_at.isoformat(timespec="seconds") if self.finished_at else None
+        }
+
+
+class ReportService():
+    """
+    A long-running report service. Research jobs are queued and run by a pool of worker threads, which all share one warm
+    set of API clients and one checkpoint store, so no job pays for creating clients or importing the API libraries again.
+    The service is exposed as a local HTTP API by serve(), see the README for the endpoints.
+    """
+
+    def __init__(self, workers: int = 2, queue_depth: int = 16, checkpoint_dir: str = "checkpoints", max_finished_jobs: int = 1000,
+                 report_db: str | None = None):
+        """
+        Initialise the service and its shared clients. The workers are started with start().
+
+        Args:
+            workers (int): The number of jobs run at the same time.
+            queue_depth (int): The maximum number of jobs waiting to run. Submissions beyond it are rejected.
+            checkpoint_dir (str): Directory to store stage checkpoints in.
+            max_finished_jobs (int): The number of finished jobs (and their reports) to keep in memory for polling.
+            report_db (str | None): SQLite file indexing every written report for search. If not provided, reports are only written as files.
+        """
+        if workers < 1 or queue_depth < 1:
+            raise ValueError("The service needs at least one worker and a queue depth of at least one.")
+
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.max_finished_jobs = max_finished_jobs
+
+        # Warm clients and caches shared by every job
+        self.llm = clients.gemini()
+        self.maps_client = clients.maps()
+        self.checkpoint_store = CheckpointStore(checkpoint_dir)
+        self.location_index = LocationIndex(self.maps_client)
+        self.report_store = ReportStore(report_db) if report_db else None
+
+        self.jobs = {}
+        self._finished_job_ids = []
+        self._jobs_lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=queue_depth)
+        self._threads = []
+
+    def start(self) -> None:
+        """
+        Starts the worker threads.
+        """
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"report-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logging.info(f"Report service started with {self.workers} workers and a queue depth of {self.queue_depth}.")
+
+    def stop(self) -> None:
+        """
+        Stops the worker threads once they have finished their current job.
+        """
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        page_parser.shutdown()
+
+    def submit(self, company_name: str, company_url: str, resume: bool = False, refresh: bool = False) -> ReportJob:
+        """
+        Queues a research job.
+
+        Args:
+            company_name (str): The name of the company to research.
+            company_url (str): The URL of the company's website.
+            resume (bool): Whether to reuse valid checkpoints from a previous run.
+            refresh (bool): Whether to only recompute the stages whose inputs changed.
+
+        Returns:
+            ReportJob: The queued job.
+
+        Raises:
+            queue.Full: If the queue is already at its maximum depth.
+        """
+        job = ReportJob(company_name, company_url, resume=resume, refresh=refresh)
+        with self._jobs_lock:
+            self._queue.put_nowait(job)
+            self.jobs[job.job_id] = job
+        logging.info(f"Queued job {job.job_id} for {company_name}.")
+        return job
+
+    def get_job(self, job_id: str) -> ReportJob | None:
+        """
+        Looks up a job by its ID.
+
+        Args:
+            job_id (str): The ID of the job.
+
+        Returns:
+            ReportJob | None: The job, or None if it does not exist (or was evicted).
+        """
+        with self._jobs_lock:
+            return self.jobs.get(job_id)
+
+    def stats(self) -> dict:
+        """
+        Returns the current state of the service.
+
+        Returns:
+            dict: The number of workers, queued jobs, jobs per status, locations in the shared location index, the
+            remaining rate limit headroom (if a shared quota is used) and the connection reuse of each shared client.
+        """
+        with self._jobs_lock:
+            statuses = [job.status for job in self.jobs.values()]
+        quota = QuotaManager.shared()
+        return {
+            "workers": self.workers,
+            "queue_depth": self.queue_depth,
+            "queued": self._queue.qsize(),
+            "jobs": {status: statuses.count(status) for status in ("queued", "running", "done", "failed")},
+            "locations": self.location_index.stats(),
+            "quota": quota.headroom() if quota else None,
+            "connections": clients.connection_stats()
+        }
+
+    def _finish(self, job: ReportJob) -> None:
+        """
+        Keeps track of finished jobs, evicting the oldest ones beyond max_finished_jobs so memory stays bounded.
+
+        Args:
+            job (ReportJob): The job that just finished.
+        """
+        with self._jobs_lock:
+            self._finished_job_ids.append(job.job_id)
+            while len(self._finished_job_ids) > self.max_finished_jobs:
+                self.jobs.pop(self._finished_job_ids.pop(0), None)
+
+    def _worker(self) -> None:
+        """
+        Runs queued jobs until stop() is called.
+        """
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+
+            job.set_status("running")
+            try:
+                pipeline = ResearchPipeline(job.company_name, job.company_url, self.checkpoint_store,
+                                            resume=job.resume, refresh=job.refresh,
+                                            llm=self.llm, maps_client=self.maps_client, stage_callback=job.on_stage,
+                                            location_index=self.location_index, report_store=self.report_store)
+                job.report = pipeline.run()
+                job.report_path = pipeline.write_report(job.report)
+                job.set_status("done")
+            except Exception as e:
+                logging.error(f"Job {job.job_id} for {job.company_name} failed: {e}")
+                job.error = str(e)
+                job.set_status("failed", error=str(e))
+            finally:
+                self._finish(job)
+
+    def serve(self, host: str = "127.0.0.1", port: int = 8080) -> None:
+        """
+        Starts the workers and serves the HTTP API until interrupted.
+
+        Args:
+            host (str): The interface to listen on.
+            port (int): The port to listen on.
+        """
+        server = ThreadingHTTPServer((host, port), _make_request_handler(self))
+        server.daemon_threads = True
+        self.start()
+        logging.info(f"Report service listening on http://{host}:{server.server_address[1]}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stop()
+
+
+def _make_request_handler(service: ReportService) -> type:
+    """
+    Builds the HTTP request handler class bound to a service.
+
+    Args:
+        service (ReportService): The service to expose.
+
+    Returns:
+        type: A BaseHTTPRequestHandler subclass.
+    """
+
+    class ReportRequestHandler(BaseHTTPRequestHandler):
+        """
+        Endpoints:
+            POST /jobs                  Queue a job, body: {"company_name": ..., "company_url": ..., "resume": false, "refresh": false}
+            GET  /jobs                  List the known jobs
+            GET  /jobs/<id>             Poll the status of a job
+            GET  /jobs/<id>/report      Fetch the finished Markdown report
+            GET  /jobs/<id>/events      Stream the job status changes as server-sent events until the job finishes
+            GET  /health                Service status and queue depth
+            GET  /metrics               Call metrics in the Prometheus text format
+        """
+
+        # Lets polling clients reuse their connection. The event stream closes its connection once the job has finished.
+        protocol_version = "HTTP/1.1"
+
+        def _send(self, status: int, body: str, content_type: str = "application/json", headers: dict | None = None) -> None:
+            """Sends a complete response with the given body."""
+            data = body.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _send_json(self, status: int, payload: dict, headers: dict | None = None) -> None:
+            """Sends a JSON response."""
+            self._send(status, json.dumps(payload, ensure_ascii=False), headers=headers)
+
+        def _get_job_or_404(self, job_id: str) -> ReportJob | None:
+            """Looks up a job, sending a 404 response if it does not exist."""
+            job = service.get_job(job_id)
+            if not job:
+                self._send_json(404, {"error": f"Unknown job {job_id}."})
+            return job
+
+        def do_POST(self):
+            """Queues a job."""
+            if self.path.rstrip("/") != "/jobs":
+                self._send_json(404, {"error": "Not found."})
+                return
+
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                company_name = str(body["company_name"]).strip()
+                company_url = str(body["company_url"]).strip()
+                if not company_name or not company_url:
+                    raise ValueError("company_name and company_url must not be empty.")
+            except (ValueError, KeyError, TypeError) as e:
+                self._send_json(400, {"error": f"Invalid job: {e}"})
+                return
+
+            try:
+                job = service.submit(company_name, company_url, resume=bool(body.get("resume")), refresh=bool(body.get("refresh")))
+            except queue.Full:
+                self._send_json(429, {"error": "The job queue is full. Try again later."}, headers={"Retry-After": "30"})
+                return
+
+            self._send_json(202, job.to_dict(), headers={"Location": f"/jobs/{job.job_id}"})
+
+        def do_GET(self):
+            """Serves the status, report, events, health and metrics endpoints."""
+            parts = [part for part in self.path.split("?", 1)[0].split("/") if part]
+
+            if parts == ["health"]:
+                self._send_json(200, {"status": "ok", **service.stats()})
+            elif parts == ["metrics"]:
+                clients.export_metrics()
+                self._send(200, metrics.to_prometheus(), content_type="text/plain; version=0.0.4")
+            elif parts == ["jobs"]:
+                with service._jobs_lock:
+                    jobs = [job.to_dict() for job in service.jobs.values()]
+                self._send_json(200, {"jobs": jobs})
+            elif len(parts) == 2 and parts[0] == "jobs":
+                job = self._get_job_or_404(parts[1])
+                if job:
+                    self._send_json(200, job.to_dict())
+            elif len(parts) == 3 and parts[0] == "jobs" and parts[2] == "report":
+                job = self._get_job_or_404(parts[1])
+                if not job:
+                    return
+                if job.status != "done":
+                    self._send_json(409, {"error": f"The job is {job.status}.", **job.to_dict()})
+                    return
+                self._send(200, job.report, content_type="text/markdown")
+            elif len(parts) == 3 and parts[0] == "jobs" and parts[2] == "events":
+                job = self._get_job_or_404(parts[1])
+                if job:
+                    self._stream_events(job)
+            else:
+                self._send_json(404, {"error": "Not found."})
+
+        def _stream_events(self, job: ReportJob) -> None:
+            """Streams the job events as server-sent events until the job has finished."""
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+
+            seen = 0
+            try:
+                while True:
+                    events = job.wait_for_events(seen, timeout=15)
+                    seen += len(events)
+                    if not events:
+                        # Keep-alive comment, so proxies do not drop an idle stream
+                        self.wfile.write(b": keep-alive\n\n")
+                    for event in events:
+                        self.wfile.write(f"event: {event['event']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+                    if job.finished and seen >= len(job.events):
+                        break
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def log_message(self, format, *args):
+            logging.info("%s - " + format, self.address_string(), *args)
+
+    return ReportRequestHandler
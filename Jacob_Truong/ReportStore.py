@@ -0,0 +1,260 @@
+from contextlib import contextmanager
+import glob
+import hashlib
+import re
+import sqlite3
+import threading
+import logging
+from datetime import datetime
+from pathlib import Path
+
+class ReportStore():
+    """
+    A class that keeps every generated report in a local SQLite database, split into sections (background, products, findings
+    per site, ...) and indexed with FTS5, so that questions across the whole book (e.g. every insured with timber construction
+    or near water) are answered with one indexed search instead of grepping thousands of Markdown files.
+    Every run of a company is kept. Searches look at the latest report of each company unless asked otherwise.
+    NOTE: The Markdown files are still written as before. The store indexes them, it does not replace them.
+    """
+
+    # e.g. "# Title: Texwin - Nature of Operations Report"
+    _TITLE = re.compile(r"^#\s*Title:\s*(.+?)\s*-\s*Nature of Operations Report\s*$", re.MULTILINE)
+    # e.g. "Date: 16-08-2025 - Time: 03:26:07" or "Date: 16-08-2025"
+    _DATE = re.compile(r"^\s*Date:\s*(\d{2}-\d{2}-\d{4})(?:\s*-\s*Time:\s*(\d{2}:\d{2}:\d{2}))?", re.MULTILINE)
+    # e.g. "## 1. Background:" or "### c. Findings:" or "### Site 2: 100 N Loop 323, Tyler, TX 75000 - City: Tyler - ..."
+    _HEADING = re.compile(r"^(#{2,3})\s*(?:\d+\.|[a-z]\.)?\s*(.+?)\s*$", re.MULTILINE)
+    # e.g. "1501 Goodnight Blvd, Wills Point, TX 75169 - City: Wills Point - State: Texas - Country: United States"
+    _ADDRESS = re.compile(r"^(?P<address>.+?)\s*-\s*City:\s*(?P<city>.*?)\s*-\s*State:\s*(?P<state>.*?)\s*-\s*Country:\s*(?P<country>.*?)\s*$")
+
+    def __init__(self, db_path: str = "reports.db"):
+        """
+        Initialise the store, creating the database if needed.
+
+        Args:
+            db_path (str): The path of the SQLite database.
+        """
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Each thread gets its own connection, as sqlite3 connections should not be shared between threads
+        self._local = threading.local()
+        # NOTE: executescript() commits on its own, so the schema is created outside of _transaction().
+        self._connection().executescript("""
+            CREATE TABLE IF NOT EXISTS reports (
+                id INTEGER PRIMARY KEY, company TEXT NOT NULL, company_slug TEXT NOT NULL, run_date TEXT NOT NULL,
+                path TEXT, content TEXT NOT NULL, content_sha256 TEXT NOT NULL, indexed_at TEXT NOT NULL,
+                UNIQUE (company_slug, content_sha256));
+            CREATE INDEX IF NOT EXISTS reports_by_company ON reports (company_slug, run_date);
+            CREATE TABLE IF NOT EXISTS sections (
+                id INTEGER PRIMARY KEY, report_id INTEGER NOT NULL REFERENCES reports (id) ON DELETE CASCADE,
+                section TEXT NOT NULL, site INTEGER, address TEXT, city TEXT, state TEXT, country TEXT, body TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS sections_by_report ON sections (report_id);
+            CREATE VIRTUAL TABLE IF NOT EXISTS sections_fts USING fts5 (
+                section, address, city, state, country, body, content='sections', content_rowid='id', tokenize='porter unicode61');
+        """)
+
+    def _connection(self) -> sqlite3.Connection:
+        """Returns the connection of the current thread, opening it on first use."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # NOTE: Autocommit mode, so that transactions are started explicitly (see _transaction).
+            connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA foreign_keys=ON")
+            self._local.connection = connection
+        return connection
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Runs the block in a write transaction.
+
+        Yields:
+            sqlite3.Connection: The connection of the current thread.
+        """
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    @staticmethod
+    def _slug(company: str) -> str:
+        """Returns the slug of a company, as used in the report file names (e.g. openstream_ai)."""
+        return company.strip().lower().replace(' ', '_')
+
+    @classmethod
+    def parse_report(cls, report: str) -> dict:
+        """
+        Splits a Markdown report into its company, run date, sites and sections.
+        Reports that do not follow the usual layout are kept as one "Report" section, so that they can still be searched.
+
+        Args:
+            report (str): The Markdown report.
+
+        Returns:
+            dict: The "company", "run_date" (ISO format, or None if the report has no date) and "sections", each with its
+            "section" name, "site" number, "address", "city", "state", "country" and "body".
+        """
+        title = cls._TITLE.search(report)
+        date = cls._DATE.search(report)
+        run_date = None
+        if date:
+            run_date = datetime.strptime(f"{date.group(1)} {date.group(2) or '00:00:00'}", "%d-%m-%Y %H:%M:%S").isoformat()
+
+        sections = []
+        site = {"site": None, "address": None, "city": None, "state": None, "country": None}
+        headings = list(cls._HEADING.finditer(report))
+        for i, heading in enumerate(headings):
+            level, name = heading.group(1), heading.group(2).rstrip(":").strip()
+            body = report[heading.end():headings[i + 1].start() if i + 1 < len(headings) else len(report)].strip()
+
+            # The location of the primary site, and each other site, set the site that the sections after them describe
+            if name.startswith("Address:") or name.startswith("Site "):
+                label, _, location = name.partition(":")
+                match = cls._ADDRESS.match(location.strip())
+                fields = match.groupdict() if match else {"address": location.strip(), "city": None, "state": None, "country": None}
+                site = {"site": int(label.split()[1]) if label.startswith("Site ") else 1,
+                        **{key: (value if value not in ("", "None") else None) for key, value in fields.items()}}
+                # Other sites carry their findings under the site heading itself
+                name = "Findings" if name.startswith("Site ") else "Location Details"
+                # A site without findings is still indexed by its location
+                body = body.replace("**Findings:**", "").strip() or location.strip()
+            elif level == "##":
+                site = {"site": None, "address": None, "city": None, "state": None, "country": None}
+
+            if body:
+                sections.append({"section": name, **site, "body": body})
+
+        if not sections:
+            sections.append({"section": "Report", "site": None, "address": None, "city": None, "state": None, "country": None, "body": report.strip()})
+
+        return {"company": title.group(1).strip() if title else None, "run_date": run_date, "sections": sections}
+
+    def add(self, report: str, company: str | None = None, path: str | None = None, run_date: str | None = None) -> int:
+        """
+        Stores and indexes a report. Storing the same report of the same company again does nothing.
+
+        Args:
+            report (str): The Markdown report.
+            company (str | None): The company name. If not provided, it is read from the report title (or the file name).
+            path (str | None): The path of the Markdown file, if any.
+            run_date (str | None): When the report was generated, in ISO format. If not provided, it is read from the report, or set to now.
+
+        Returns:
+            int: The id of the report.
+        """
+        parsed = self.parse_report(report)
+        company = company or parsed["company"] or (Path(path).stem.removeprefix("nop_") if path else "Unknown")
+        company_slug = self._slug(company)
+        run_date = run_date or parsed["run_date"] or datetime.now().isoformat(timespec="seconds")
+        content_sha256 = hashlib.sha256(report.encode("utf-8")).hexdigest()
+
+        with self._transaction() as connection:
+            existing = connection.execute("SELECT id FROM reports WHERE company_slug = ? AND content_sha256 = ?", (company_slug, content_sha256)).fetchone()
+            if existing:
+                return existing["id"]
+
+            report_id = connection.execute(
+                "INSERT INTO reports (company, company_slug, run_date, path, content, content_sha256, indexed_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (company, company_slug, run_date, path, report, content_sha256, datetime.now().isoformat(timespec="seconds"))).lastrowid
+            for section in parsed["sections"]:
+                section_id = connection.execute(
+                    "INSERT INTO sections (report_id, section, site, address, city, state, country, body) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (report_id, section["section"], section["site"], section["address"], section["city"], section["state"], section["country"], section["body"])).lastrowid
+                connection.execute("INSERT INTO sections_fts (rowid, section, address, city, state, country, body) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                   (section_id, section["section"], section["address"] or "", section["city"] or "", section["state"] or "",
+                                    section["country"] or "", section["body"]))
+
+        logging.info(f"Indexed the report of {company} ({len(parsed['sections'])} sections).")
+        return report_id
+
+    def import_files(self, patterns: list[str] | None = None) -> int:
+        """
+        Stores and indexes existing Markdown reports. Reports without a date are dated by the modification time of their file.
+
+        Args:
+            patterns (list[str] | None): File paths or glob patterns. If not provided, every nop_*.md file in the working directory.
+
+        Returns:
+            int: The number of files read.
+        """
+        paths = sorted({path for pattern in (patterns or ["nop_*.md"]) for path in (glob.glob(pattern) or [pattern]) if Path(path).is_file()})
+        for path in paths:
+            report = Path(path).read_text(encoding="utf-8", errors="replace")
+            run_date = None if self._DATE.search(report) else datetime.fromtimestamp(Path(path).stat().st_mtime).isoformat(timespec="seconds")
+            self.add(report, path=path, run_date=run_date)
+        return len(paths)
+
+    def search(self, query: str, section: str | None = None, company: str | None = None, all_runs: bool = False, limit: int = 20) -> list[dict]:
+        """
+        Searches the sections of the stored reports, best matches first.
+
+        Args:
+            query (str): An FTS5 query, e.g. 'timber', '"flood risk" NEAR river' or 'timber OR flood'. Words are matched on their stem
+                (e.g. "flooding" matches "flood"), and columns can be searched on their own (e.g. 'city:Tyler').
+            section (str | None): Only search this section (e.g. "Findings", "Products & Services"), case-insensitive.
+            company (str | None): Only search the reports of this company.
+            all_runs (bool): Whether to search every run of each company instead of only its latest report.
+            limit (int): The maximum number of results.
+
+        Returns:
+            list[dict]: The company, run date, section, site and its location fields, and a snippet of each matching section.
+
+        Raises:
+            ValueError: If the query is not valid FTS5 syntax.
+        """
+        conditions = ["sections_fts MATCH ?"]
+        parameters = [query]
+        if section:
+            conditions.append("s.section = ? COLLATE NOCASE")
+            parameters.append(section)
+        if company:
+            conditions.append("r.company_slug = ?")
+            parameters.append(self._slug(company))
+        if not all_runs:
+            conditions.append("r.id = (SELECT latest.id FROM reports latest WHERE latest.company_slug = r.company_slug "
+                              "ORDER BY latest.run_date DESC, latest.id DESC LIMIT 1)")
+
+        sql = ("SELECT r.id AS report_id, r.company, r.run_date, r.path, s.section, s.site, s.address, s.city, s.state, s.country, "
+               "snippet(sections_fts, 5, '[', ']', ' … ', 16) AS snippet "
+               "FROM sections_fts JOIN sections s ON s.id = sections_fts.rowid JOIN reports r ON r.id = s.report_id "
+               f"WHERE {' AND '.join(conditions)} ORDER BY bm25(sections_fts) LIMIT ?")
+        try:
+            rows = self._connection().execute(sql, (*parameters, limit)).fetchall()
+        except sqlite3.OperationalError as e:
+            raise ValueError(f"Invalid search query '{query}': {e}") from e
+        return [dict(row) for row in rows]
+
+    def get(self, company: str | None = None, report_id: int | None = None) -> str | None:
+        """
+        Retrieves a stored report.
+
+        Args:
+            company (str | None): The company, whose latest report is returned.
+            report_id (int | None): The id of a specific report (e.g. from search()). Takes precedence over company.
+
+        Returns:
+            str | None: The Markdown report, or None if there is none.
+        """
+        if report_id is not None:
+            row = self._connection().execute("SELECT content FROM reports WHERE id = ?", (report_id,)).fetchone()
+        else:
+            row = self._connection().execute("SELECT content FROM reports WHERE company_slug = ? ORDER BY run_date DESC, id DESC LIMIT 1",
+                                             (self._slug(company or ""),)).fetchone()
+        return row["content"] if row else None
+
+    def companies(self) -> list[dict]:
+        """
+        Lists the companies with stored reports.
+
+        Returns:
+            list[dict]: The company, number of stored runs and date of the latest run of each company, sorted by name.
+        """
+        rows = self._connection().execute("SELECT company_slug, MAX(company) AS company, COUNT(*) AS runs, MAX(run_date) AS latest_run_date "
+                                          "FROM reports GROUP BY company_slug ORDER BY company_slug").fetchall()
+        return [{"company": row["company"], "runs": row["runs"], "latest_run_date": row["latest_run_date"]} for row in rows]
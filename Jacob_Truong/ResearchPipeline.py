@@ -0,0 +1,745 @@
+from CompanyResearchAgent import *
+from SummaryAgent import *
+from SatelliteAnalysisAgent import *
+from ReportGeneratorAgent import *
+from CheckpointStore import *
+from LocationIndex import *
+from PassageRanker import *
+from ReportStore import *
+from StageResult import *
+from Deadline import *
+from StagedExecutor import StagedExecutor
+from Metrics import metrics
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+import contextvars
+import os
+import threading
+import logging
+from pathlib import Path
+
+class ResearchPipeline():
+    """
+    A class that runs the full research pipeline for one company (research, summarisation, satellite analysis
+    and report generation), checkpointing the output of each stage as it goes.
+    Each checkpoint records a fingerprint (content hash) of the inputs it was computed from, which allows two ways of reusing them:
+    - Resume: every stage whose checkpoint is valid and whose inputs are unchanged is skipped, including the scraping and image download.
+    - Refresh: the website is re-scraped and the satellite image re-downloaded, and only the stages whose input fingerprints
+      changed (e.g. new products text, a moved address or new imagery) are recomputed.
+    Every site address found on the website is geocoded, and each site gets its own satellite image and analysis.
+    Geocoding and imaging go through a LocationIndex, which can be shared by several pipelines so that a location
+    referenced by several companies is only geocoded and imaged once.
+    A run can be given a time budget (see Deadline), which bounds every external call made for the company. Once the budget is
+    down to the part held back for the report, the stages still to run are skipped, and the report says what was cut short.
+    """
+
+    STAGES = ("scrape", "addresses", "locations", "background", "products", "satellite_image", "satellite_analysis", "report")
+
+    # Stages that run once per site. Their checkpoints are stored per site under <stage>/<site_id>.
+    SITE_STAGES = ("satellite_image", "satellite_analysis")
+
+    # Stages that fetch data from the outside world. Their fingerprint only identifies what is fetched, not its content,
+    # so a refresh always re-runs them and lets the fingerprints of the stages after them decide what is reused.
+    SOURCE_STAGES = ("scrape", "satellite_image")
+
+    # The steps of a run, in order, with the resource each is bound by, so that a StagedExecutor can run the steps of many
+    # companies on one bounded pool per resource. Each step runs one or more of the stages above.
+    # NOTE: HTML parsing is CPU-bound, but it already runs in the PageParser process pool, so it is not a resource of its own here.
+    STEPS = (("scrape", "http"), ("addresses", "gemini"), ("locations", "maps"), ("summaries", "gemini"),
+             ("satellite_images", "maps"), ("satellite_analysis", "gemini"), ("report", "gemini"))
+
+    # Stages that still run once the time budget is down to its reserve. Every other stage is optional, and skipped.
+    REQUIRED_STAGES = ("scrape", "report")
+
+    # The part of the time budget held back for the report, in seconds, at most a quarter of the budget
+    REPORT_RESERVE_S = 20.0
+
+    # The reason given for the stages skipped because the time budget ran out
+    TIME_BUDGET_REASON = "time budget exhausted"
+
+    def __init__(self, company_name: str, company_url: str, checkpoint_store: CheckpointStore | None = None, resume: bool = False, refresh: bool = False,
+                 llm: GeminiAPI | None = None, maps_client: GoogleMapsAPI | None = None, stage_callback=None, site_workers: int = 4, max_sites: int | None = None,
+                 location_index: LocationIndex | None = None, passage_ranker: PassageRanker | None = None,
+                 context_caching: bool = False, report_store: ReportStore | None = None, deadline_s: float | None = None):
+        """
+        Initialise the pipeline for a company.
+
+        Args:
+            company_name (str): The name of the company to research.
+            company_url (str): The URL of the company's website.
+            checkpoint_store (CheckpointStore | None): Where to persist stage outputs. If not provided, a default store is used.
+            resume (bool): Whether to reuse valid checkpoints from a previous run instead of re-running those stages.
+            refresh (bool): Whether to re-fetch the website and imagery and only recompute the stages whose inputs changed.
+            llm (GeminiAPI | None): A Gemini API client shared by every agent. If not provided, the shared one of the client registry is used.
+            maps_client (GoogleMapsAPI | None): A Google Maps API client shared by every agent. If not provided, the shared one of the client registry is used.
+            stage_callback (Callable[[str, str], None] | None): Called with the stage name and its status after each stage, e.g. to report progress.
+            site_workers (int): The maximum number of sites whose geocoding, satellite image and analysis run at once. When the
+                steps are run by a StagedExecutor, the sites are run by the pool of the step instead, see _for_each_site().
+            max_sites (int | None): The maximum number of sites to analyse. Sites beyond it are still geocoded and listed in the report.
+            location_index (LocationIndex | None): A location index shared across the portfolio. If not provided, the pipeline uses its own.
+            passage_ranker (PassageRanker | None): Selects the scraped passages sent to the summarisation stages. If not provided, a default ranker is used.
+            context_caching (bool): Whether to hold the company's corpus in a Gemini context cache shared by the background and products stages.
+            report_store (ReportStore | None): Where written reports are indexed for search. If not provided, reports are only written as files.
+            deadline_s (float | None): The time budget of a run in seconds, counted from its first step. If not provided, runs are not bounded.
+        """
+        self.company_name = company_name
+        self.company_url = company_url
+        self.company_slug = company_name.lower().replace(' ', '_')
+        self.checkpoint_store = checkpoint_store if checkpoint_store else CheckpointStore()
+        self.resume = resume
+        self.refresh = refresh
+        self.llm = llm
+        self.maps_client = maps_client
+        self.stage_callback = stage_callback
+        self.site_workers = max(1, site_workers)
+        self.max_sites = max_sites
+        self.location_index = location_index if location_index else LocationIndex(maps_client)
+        self.passage_ranker = passage_ranker if passage_ranker else PassageRanker()
+        self.context_caching = context_caching
+        self.report_store = report_store
+        self.deadline_s = deadline_s
+
+        # What happened to each stage in the last run (e.g. "reused", "recomputed (inputs changed)")
+        self.stage_status = {}
+
+        # Agents are only built if one of their stages actually runs
+        self._company_research_agent = None
+        self._summary_agent = None
+        self._satellite_analysis_agents = {}
+        self._state = {}
+
+        # The result of each stage in the last run, keyed like the stage status, and the calls skipped because of invalid inputs
+        self.results = {}
+        self.avoided_calls = {}
+        self._avoided_lock = threading.Lock()
+
+        # The time budget of the last run, created by its first step
+        self.deadline = None
+
+    @staticmethod
+    def _dedupe_addresses(addresses: list[str]) -> list[str]:
+        """
+        Removes addresses that are spellings of the same location (see AddressNormaliser), keeping the first spelling of each.
+
+        Args:
+            addresses (list[str]): The extracted addresses.
+
+        Returns:
+            list[str]: The distinct addresses, in their original order.
+        """
+        distinct = {}
+        for address in addresses:
+            distinct.setdefault(AddressNormaliser.normalise(address), address)
+        return list(distinct.values())
+
+    @staticmethod
+    def _site_id(address: str) -> str:
+        """
+        Builds a stable identifier for a site, used to name its checkpoints and satellite image.
+
+        Args:
+            address (str): The address of the site.
+
+        Returns:
+            str: A short hash of the normalised address.
+        """
+        return CheckpointStore.fingerprint(AddressNormaliser.normalise(address))[:12]
+
+    def _validate(self, stage: str, data) -> StageResult:
+        """
+        Checks whether the output of a stage is usable by the stages after it, and complete enough to be checkpointed and reused.
+
+        Args:
+            stage (str): The name of the pipeline stage.
+            data: The output of the stage.
+
+        Returns:
+            StageResult: The output of the stage, with whether it succeeded and how confident the pipeline is in it.
+        """
+        if stage in ("background", "products"):
+            return StageResult.of_text(data, min_chars=StageResult.MIN_SUMMARY_CHARS)
+        if stage in ("satellite_analysis", "report"):
+            return StageResult.of_text(data)
+        if not data:
+            return StageResult.failure("no output", data)
+
+        if stage == "scrape":
+            if not any(text.strip() for text in data.values()):
+                return StageResult.failure("no text found on the website", data)
+            return StageResult.success(data, 1.0 if data.get("contact_text", "").strip() else 0.6)
+        if stage == "addresses":
+            results = [StageResult.of_address(address) for address in data]
+            if not any(results):
+                return StageResult.failure("no address extracted", data)
+            return StageResult.success(data, max(result.confidence for result in results))
+        if stage == "locations":
+            results = [StageResult.of_location(location["location_info"]) for location in data]
+            if not any(results):
+                return StageResult.failure("no address could be geocoded", data)
+            return StageResult.success(data, max(result.confidence for result in results))
+        if stage == "satellite_image":
+            image_path = data.get("image_path")
+            if not image_path or not Path(image_path).exists():
+                return StageResult.failure("no satellite image retrieved", data)
+            return StageResult.success(data)
+
+        return StageResult.failure(f"unknown stage {stage}", data)
+
+    def _is_valid(self, stage: str, data) -> bool:
+        """Checks whether the output of a stage can be checkpointed and reused by a later run, see _validate()."""
+        return self._validate(stage, data).ok
+
+    def _avoid(self, stage: str, kind: str, operation: str, reason: str, count: int = 1) -> None:
+        """Counts calls of a stage that are not made because their input is invalid, for this company's summary and the metrics."""
+        if count <= 0:
+            return
+        logging.info(f"Skipping {count} {kind} {operation} call(s) of {stage} for {self.company_name}: {reason}.")
+        with metrics.tags(stage=stage):
+            metrics.record_avoided_call(kind, operation, reason, count)
+        with self._avoided_lock:
+            key = (kind, operation)
+            self.avoided_calls[key] = self.avoided_calls.get(key, 0) + count
+
+    def _load_checkpoint(self, stage: str, checkpoint_key: str) -> dict | None:
+        """
+        Loads the checkpoint of a stage, if checkpoints are reused in this run and the checkpoint is valid.
+
+        Args:
+            stage (str): The name of the pipeline stage.
+            checkpoint_key (str): The stage name, or <stage>/<site_id> for the stages that run once per site.
+
+        Returns:
+            dict | None: The checkpoint, or None.
+        """
+        if not (self.resume or self.refresh):
+            return None
+
+        checkpoint = self.checkpoint_store.load(self.company_slug, checkpoint_key)
+        if checkpoint and not self._is_valid(stage, checkpoint.get("data")):
+            return None
+        return checkpoint
+
+    def _will_reuse(self, stage: str, fingerprint: str) -> bool:
+        """
+        Checks whether a stage is going to reuse its checkpoint instead of running, see _run_stage().
+
+        Args:
+            stage (str): The name of the pipeline stage.
+            fingerprint (str): The fingerprint of the inputs of the stage.
+
+        Returns:
+            bool: True if the stage will be skipped.
+        """
+        checkpoint = self._load_checkpoint(stage, stage)
+        return bool(checkpoint) and checkpoint.get("fingerprint") == fingerprint and not (self.refresh and stage in self.SOURCE_STAGES)
+
+    def _run_stage(self, stage: str, fingerprint: str, stage_func, site_id: str | None = None, skipped_value=None):
+        """
+        Runs a single stage, or reuses its checkpoint when its inputs are unchanged.
+        An optional stage that would have to run is skipped once the time budget is down to its reserve, and a stage that
+        was cut short by the time budget is not checkpointed.
+
+        Args:
+            stage (str): The name of the pipeline stage.
+            fingerprint (str): The fingerprint of the inputs of the stage.
+            stage_func (Callable): A function that computes the output of the stage.
+            site_id (str | None): The site the stage runs for, for the stages that run once per site.
+            skipped_value: The output the later stages get if the stage is skipped for lack of time.
+
+        Returns:
+            StageResult: The output of the stage, with whether it succeeded.
+        """
+        checkpoint_key = f"{stage}/{site_id}" if site_id else stage
+        checkpoint = self._load_checkpoint(stage, checkpoint_key)
+
+        with metrics.tags(stage=stage):
+            if checkpoint and checkpoint.get("fingerprint") == fingerprint:
+                if not (self.refresh and stage in self.SOURCE_STAGES):
+                    logging.info("Reusing '%s' checkpoint for %s.", checkpoint_key, self.company_name)
+                    metrics.record_cache_hit("checkpoint", stage)
+                    self._set_stage_status(checkpoint_key, "reused")
+                    result = self._validate(stage, checkpoint["data"])
+                    self.results[checkpoint_key] = result
+                    return result
+
+            if stage not in self.REQUIRED_STAGES and self._out_of_time():
+                return self._skip_stage(checkpoint_key, self.TIME_BUDGET_REASON, skipped_value)
+
+            truncations = len(self.deadline.truncations) if self.deadline else 0
+            with metrics.track("stage", stage):
+                data = stage_func()
+            # NOTE: The truncations are counted per company, so a site stage can also be held back by another site that was
+            # cut short at the same time. That only costs recomputing it on the next run.
+            truncated = self.deadline is not None and len(self.deadline.truncations) > truncations
+
+        if not checkpoint:
+            status = "computed"
+        elif stage in self.SOURCE_STAGES and checkpoint.get("fingerprint") == fingerprint:
+            changed = CheckpointStore.fingerprint(checkpoint["data"]) != CheckpointStore.fingerprint(data)
+            status = "refetched (changed)" if changed else "refetched (unchanged)"
+        else:
+            status = "recomputed (inputs changed)"
+
+        result = self._validate(stage, data)
+        if result.ok and truncated:
+            # A stage cut short is used for this report, but recomputed by the next run rather than reused
+            logging.info("Stage '%s' of %s was cut short by the time budget. It will not be checkpointed.", checkpoint_key, self.company_name)
+            status += f", cut short ({self.TIME_BUDGET_REASON})"
+        elif result.ok:
+            self.checkpoint_store.save(self.company_slug, checkpoint_key, data, fingerprint)
+        else:
+            logging.warning(f"Stage '{checkpoint_key}' did not produce a usable result for {self.company_name} ({result.reason}). It will not be checkpointed.")
+            status += ", failed"
+
+        self.results[checkpoint_key] = result
+        self._set_stage_status(checkpoint_key, status)
+        return result
+
+    def _set_stage_status(self, stage: str, status: str) -> None:
+        """
+        Records what happened to a stage and reports it to the stage callback, if any.
+
+        Args:
+            stage (str): The name of the pipeline stage, or <stage>/<site_id> for the stages that run once per site.
+            status (str): What happened to the stage (e.g. "reused").
+        """
+        self.stage_status[stage] = status
+        if self.stage_callback:
+            self.stage_callback(stage, status)
+
+    def _get_company_research_agent(self) -> CompanyResearchAgent:
+        """Builds the company research agent on first use."""
+        if self._company_research_agent is None:
+            self._company_research_agent = CompanyResearchAgent(self.company_name, self.company_url, llm=self.llm, maps_client=self.maps_client)
+        return self._company_research_agent
+
+    def _get_summary_agent(self) -> SummaryAgent:
+        """Builds the summary agent on first use."""
+        if self._summary_agent is None:
+            self._summary_agent = SummaryAgent(self.company_name, llm=self.llm)
+        return self._summary_agent
+
+    def _get_satellite_analysis_agent(self, address: str) -> SatelliteAnalysisAgent:
+        """Builds the satellite analysis agent of a site on first use."""
+        # NOTE: Sites are analysed from several threads, but each thread only builds the agent of its own site.
+        agent = self._satellite_analysis_agents.get(address)
+        if agent is None:
+            agent = SatelliteAnalysisAgent(self.company_name, address, llm=self.llm, maps_client=self.maps_client)
+            self._satellite_analysis_agents[address] = agent
+        return agent
+
+    def _locations(self, addresses: list[str]) -> list[dict]:
+        """Geocodes every site address in bulk, through the location index."""
+        if StagedExecutor.current_pool():
+            location_infos = self._for_each_site(lambda address: self.location_index.geocode(address, self.company_slug), addresses)
+        else:
+            location_infos = self.location_index.geocode_many(addresses, company=self.company_slug, max_workers=self.site_workers)
+        return [{"address": address, "location_info": location_info} for address, location_info in zip(addresses, location_infos)]
+
+    def _satellite_image(self, address: str) -> dict:
+        """Downloads a satellite image of a site address through the location index and records the hash of its bytes."""
+        image_path = self.location_index.satellite_image(address, SatelliteAnalysisAgent.ZOOM_FACTOR, company=self.company_slug)
+        if not image_path:
+            return {"image_path": None, "image_sha256": None}
+
+        image_bytes = Path(image_path).read_bytes()
+        return {"image_path": image_path, "image_sha256": CheckpointStore.fingerprint(image_bytes)}
+
+    def _satellite_analysis(self, address: str, image_path: str) -> str:
+        """Analyses the downloaded satellite image with the vision model."""
+        return self._get_satellite_analysis_agent(address).analyze_visuals_with_llm(image_path)
+
+    def _skip_stage(self, checkpoint_key: str, reason: str, value=None, avoided: tuple = ()) -> StageResult:
+        """
+        Records a stage that is not run because its input is invalid, and counts the calls it would have made.
+        A stage skipped for lack of time (TIME_BUDGET_REASON) is recorded as cut short by the time budget instead.
+
+        Args:
+            checkpoint_key (str): The stage name, or <stage>/<site_id> for the stages that run once per site.
+            reason (str): Why the input is invalid.
+            value: The output the later stages get instead.
+            avoided (tuple): The (kind, operation) of every call the stage would have made.
+
+        Returns:
+            StageResult: The failed result of the stage.
+        """
+        if reason == self.TIME_BUDGET_REASON:
+            # NOTE: These calls are not counted as avoided, as their inputs were valid. The report notes them instead.
+            self.deadline.truncate(checkpoint_key)
+        else:
+            for kind, operation in avoided:
+                self._avoid(checkpoint_key.split("/")[0], kind, operation, reason)
+        result = StageResult.failure(reason, value)
+        self.results[checkpoint_key] = result
+        self._set_stage_status(checkpoint_key, f"skipped ({reason})")
+        return result
+
+    def _out_of_time(self) -> bool:
+        """Whether the time budget of the run, if any, is down to the part held back for the report."""
+        return self.deadline is not None and not self.deadline.has_time()
+
+    def _site_image(self, location: dict) -> StageResult:
+        """
+        Runs the satellite image stage for one site, unless its address could not be geocoded.
+
+        Args:
+            location (dict): The site, with its "address" and "location_info".
+
+        Returns:
+            StageResult: The "image_path" and "image_sha256" of the site's satellite image.
+        """
+        address = location["address"]
+        no_image = {"image_path": None, "image_sha256": None}
+        location_result = StageResult.of_location(location["location_info"])
+        if not location_result:
+            # NOTE: The Static API would centre the image on its own reading of the same address, which is likely just as wrong.
+            # Once out of time, the site would not have been imaged anyway (e.g. as geocoding was skipped), which takes precedence.
+            reason = self.TIME_BUDGET_REASON if self._out_of_time() else location_result.reason
+            return self._skip_stage(f"satellite_image/{self._site_id(address)}", reason, no_image, avoided=(("maps", "static_map"),))
+        return self._run_stage("satellite_image", CheckpointStore.fingerprint(AddressNormaliser.normalise(address), SatelliteAnalysisAgent.ZOOM_FACTOR),
+                               lambda: self._satellite_image(address), self._site_id(address), skipped_value=no_image)
+
+    def _site_analysis(self, location: dict, image_result: StageResult, route: dict) -> dict:
+        """
+        Runs the satellite analysis stage for one site, unless it has no satellite image.
+
+        Args:
+            location (dict): The site, with its "address" and "location_info".
+            image_result (StageResult): The result of the site's satellite image stage.
+            route (dict): The Gemini model and generation config used for the analysis.
+
+        Returns:
+            dict: The site with its "image_path" and "analysis_text" added. A site that was not analysed says why in its "analysis_text".
+        """
+        address = location["address"]
+        site_id = self._site_id(address)
+        if not image_result:
+            result = self._skip_stage(f"satellite_analysis/{site_id}", image_result.reason, avoided=(("gemini", "generate_content"),))
+            return {**location, "image_path": None, "analysis_text": f"Not analysed ({result.reason})."}
+
+        satellite_image = image_result.value
+        image_path = satellite_image["image_path"]
+        result = self._run_stage("satellite_analysis", CheckpointStore.fingerprint(self.company_name, address, satellite_image.get("image_sha256"), route, SatelliteAnalysisAgent.PROMPT_VERSION),
+                                 lambda: self._satellite_analysis(address, image_path), site_id)
+        return {**location, "image_path": image_path, "analysis_text": result.value if result else f"Not analysed ({result.reason})."}
+
+    def _for_each_site(self, site_func, *site_args: list) -> list:
+        """
+        Calls a function for every site, with at most site_workers sites in flight at once.
+        NOTE: When the step is run by a StagedExecutor, every site is handed to the pool of the step as an item of its own
+        instead, as threads of its own in every worker of the pool would multiply the calls in flight to the service.
+
+        Args:
+            site_func (Callable): The function, called with the n-th item of each of site_args.
+            *site_args (list): One list per argument, with one item per site.
+
+        Returns:
+            list: The result for each site, in the same order.
+        """
+        if not site_args or not site_args[0]:
+            return []
+        pool = StagedExecutor.current_pool()
+        if pool:
+            executor, resource = pool
+            return executor.map(resource, site_func, *site_args)
+        with ThreadPoolExecutor(max_workers=min(self.site_workers, len(site_args[0]))) as executor:
+            # Each site runs in a copy of the caller's context, so its metrics keep the company tag
+            futures = [executor.submit(contextvars.copy_context().run, site_func, *args) for args in zip(*site_args)]
+            return [future.result() for future in futures]
+
+    def _is_analysed(self, site: dict) -> bool:
+        """Whether the satellite image of a site was analysed in this run, rather than skipped as unusable by the triage."""
+        result = self.results.get(f"satellite_analysis/{self._site_id(site['address'])}")
+        return bool(site["image_path"]) and bool(result) and not str(result.value).startswith(SatelliteAnalysisAgent.NOT_ANALYSED)
+
+    def _report(self, sites: list[dict], summaries: dict, use_llm: bool = True) -> str:
+        """
+        Compiles the outputs of the previous stages into a Markdown report, with the first analysed site as the primary site.
+        Without the LLM, the report is laid out directly from the outputs (see ReportGeneratorAgent.compile_report()).
+        """
+        primary = next((site for site in sites if self._is_analysed(site)), sites[0] if sites else None)
+        if primary is None:
+            primary = {"address": "Not available", "location_info": {}, "image_path": None, "analysis_text": "Not analysed (no site found)."}
+        satellite_analysis = {"image_path": primary["image_path"], "analysis_text": primary["analysis_text"]}
+        report_generator_agent = ReportGeneratorAgent(self.company_name, primary["address"], primary["location_info"], summaries["background"], summaries["products"], satellite_analysis,
+                                                      other_locations=[site for site in sites if site is not primary], llm=self.llm)
+        return report_generator_agent.generate_report() if use_llm else report_generator_agent.compile_report()
+
+    def _truncation_note(self) -> str:
+        """
+        Notes what the time budget of the run cut short, for the end of the report.
+
+        Returns:
+            str: The note, or an empty string if nothing was cut short.
+        """
+        if not self.deadline or not self.deadline.truncations:
+            return ""
+        # Sites and pages cut short are listed per stage or call, e.g. "satellite_analysis" rather than one entry per site
+        cut_short = dict.fromkeys(what.split("/")[0] for what in self.deadline.truncations)
+        return (f"\n\n---\n**Note:** This report is incomplete, as the time budget of {self.deadline.budget_s:g}s for the research ran out. "
+                f"Cut short: {', '.join(cut_short)}.")
+
+    def start(self) -> None:
+        """
+        Resets the pipeline for a new run. Called by run(), or before the first run_step() when the steps are run one by one.
+        """
+        self.stage_status = {}
+        self.results = {}
+        self.avoided_calls = {}
+        self._company_research_agent = self._summary_agent = None
+        self._satellite_analysis_agents = {}
+        # The outputs of the steps so far, which the later steps read
+        self._state = {}
+        self.deadline = None
+        # NOTE: Each fingerprint includes the model and generation config the stage is routed to, so retuning a route regenerates the stage.
+        self._router = self.llm.router if self.llm else ModelRouter()
+
+    def run_step(self, step: str) -> None:
+        """
+        Runs one step of the pipeline (see STEPS). The steps must be run in order, after start().
+
+        Args:
+            step (str): The name of the step.
+        """
+        # NOTE: The budget starts with the first step rather than when the run is started, so that the time a batch run keeps
+        # a company waiting to be admitted does not count against it. The time it waits between its steps does.
+        if self.deadline is None and self.deadline_s:
+            self.deadline = Deadline(self.deadline_s, reserve_s=min(self.REPORT_RESERVE_S, self.deadline_s / 4))
+        with metrics.tags(company=self.company_slug), self.deadline.activate() if self.deadline else nullcontext():
+            getattr(self, f"_step_{step}")()
+
+    def run(self) -> str:
+        """
+        Runs every step of the pipeline in order.
+
+        Returns:
+            str: The generated Markdown report.
+        """
+        self.start()
+        for step, _ in self.STEPS:
+            self.run_step(step)
+        return self.report
+
+    @property
+    def report(self) -> str | None:
+        """The report generated by the last run, or None if it has not got to the report step yet."""
+        return self._state.get("report")
+
+    def state_size(self) -> int:
+        """
+        Estimates the memory held between steps by the outputs of the steps so far, counting one byte per character of their text.
+
+        Returns:
+            int: The estimated number of bytes held.
+        """
+        def size(value) -> int:
+            if isinstance(value, str):
+                return len(value)
+            if isinstance(value, StageResult):
+                return size(value.value)
+            if isinstance(value, dict):
+                return sum(size(item) for item in value.values())
+            if isinstance(value, (list, tuple)):
+                return sum(size(item) for item in value)
+            return 0
+
+        return size(getattr(self, "_state", {}))
+
+    def _step_scrape(self) -> None:
+        """Step 1: Company Research."""
+        result = self._run_stage("scrape", CheckpointStore.fingerprint(self.company_url),
+                                 lambda: self._get_company_research_agent().collect_page_texts())
+        self._state["page_texts"] = result.value or {}
+
+    def _step_addresses(self) -> None:
+        """Step 1: Extraction of every site address from the contact pages. Extracted text that is not an address is dropped."""
+        contact_text = self._state["page_texts"].get("contact_text") or ""
+        if not contact_text.strip():
+            self._skip_stage("addresses", "no contact text scraped", [], avoided=(("gemini", "generate_content"),))
+            self._state["addresses"] = []
+            return
+
+        result = self._run_stage("addresses", CheckpointStore.fingerprint(contact_text, self._router.route("addresses"), CompanyResearchAgent.PROMPT_VERSION),
+                                 lambda: self._dedupe_addresses(self._get_company_research_agent().extract_all_address_blocks_llm(contact_text)))
+        addresses = []
+        for address in result.value or []:
+            address_result = StageResult.of_address(address)
+            if address_result:
+                addresses.append(address)
+                continue
+            # NOTE: Each of these would have been geocoded, imaged and analysed as a site of its own.
+            logging.warning(f"Dropping extracted address of {self.company_name} ({address_result.reason}): {address!r}")
+            for stage, kind, operation in (("locations", "maps", "geocode"), ("satellite_image", "maps", "static_map"),
+                                           ("satellite_analysis", "gemini", "generate_content")):
+                self._avoid(stage, kind, operation, address_result.reason)
+        self._state["addresses"] = addresses
+
+    def _step_locations(self) -> None:
+        """Step 1: Geocoding of every site address."""
+        addresses = self._state["addresses"]
+        if not addresses:
+            self._skip_stage("locations", self.TIME_BUDGET_REASON if self._out_of_time() else "no address extracted", [])
+            self._state["locations"] = []
+            return
+
+        # Sites that are not geocoded for lack of time are still listed in the report, with their address only
+        result = self._run_stage("locations", CheckpointStore.fingerprint([AddressNormaliser.normalise(address) for address in addresses]),
+                                 lambda: self._locations(addresses), skipped_value=[{"address": address, "location_info": {}} for address in addresses])
+        self._state["locations"] = result.value or []
+
+    def _step_summaries(self) -> None:
+        """Step 2: Background Summarisation and Product Listing. A stage without any scraped text is not sent to the model."""
+        # The scraped text is not needed after this step, so it is not held any longer than that
+        page_texts = self._state.pop("page_texts")
+
+        # NOTE: Only the passages most relevant to each stage are sent to the model. The fingerprints are taken over the selected
+        # passages, so changes to the rest of the scraped text do not trigger a new summary.
+        background_text = self.passage_ranker.select(page_texts.get("background_text") or "", "background")
+        products_text = self.passage_ranker.select(page_texts.get("products_text") or "", "products")
+        del page_texts
+        background_fingerprint = CheckpointStore.fingerprint(self.company_name, background_text, self._router.route("background"), SummaryAgent.PROMPT_VERSION)
+        products_fingerprint = CheckpointStore.fingerprint(self.company_name, products_text, self._router.route("products"), SummaryAgent.PROMPT_VERSION)
+        has_background, has_products = bool(background_text.strip()), bool(products_text.strip())
+
+        # NOTE: The corpus is only cached when both stages run, as a cache referenced by a single call costs more than it saves.
+        corpus_cache = None
+        if self.context_caching and has_background and has_products and not self._out_of_time() \
+                and not self._will_reuse("background", background_fingerprint) and not self._will_reuse("products", products_fingerprint):
+            with metrics.tags(stage="corpus_cache"):
+                corpus_cache = self._get_summary_agent().create_corpus_cache(background_text, products_text)
+        try:
+            if has_background:
+                background = self._run_stage("background", background_fingerprint,
+                                             lambda: self._get_summary_agent().summarise_background(background_text, cached_content=corpus_cache))
+            else:
+                background = self._skip_stage("background", "no background text scraped", avoided=(("gemini", "generate_content"),))
+            if has_products:
+                products = self._run_stage("products", products_fingerprint,
+                                           lambda: self._get_summary_agent().list_products_services(products_text, cached_content=corpus_cache))
+            else:
+                products = self._skip_stage("products", "no products text scraped", avoided=(("gemini", "generate_content"),))
+        finally:
+            if corpus_cache:
+                with metrics.tags(stage="corpus_cache"):
+                    self._get_summary_agent().llm.delete_cache(corpus_cache)
+
+        # Failed summaries are reported as missing, rather than passing their error message on to the report
+        self._state["summaries"] = {stage: result.value if result else f"Not available ({result.reason})."
+                                    for stage, result in (("background", background), ("products", products))}
+
+    def _step_satellite_images(self) -> None:
+        """Step 3: Satellite Image of every site, up to max_sites. Sites that could not be geocoded are not imaged."""
+        locations = self._state["locations"]
+        analysed = locations[:self.max_sites] if self.max_sites is not None else locations
+        self._state["site_images"] = self._for_each_site(self._site_image, analysed)
+
+    def _step_satellite_analysis(self) -> None:
+        """Step 3: Satellite Image Analysis of every site with an image. Sites beyond max_sites are listed without an image or analysis."""
+        locations = self._state["locations"]
+        site_images = self._state.pop("site_images")
+        route = [self._router.route("satellite_analysis")] * len(site_images)
+        skipped = [{**location, "image_path": None, "analysis_text": "Not analysed (site limit reached)."} for location in locations[len(site_images):]]
+        self._state["sites"] = self._for_each_site(self._site_analysis, locations[:len(site_images)], site_images, route) + skipped
+
+    def _step_report(self) -> None:
+        """
+        Step 4: Report Generation. The report is not generated when none of the stages before it produced anything to report,
+        unless the time budget cut them short. When the time budget leaves no time for the report call (or runs out during it), the report is compiled without the model.
+        Whatever the time budget cut short is noted at the end of the report, and everything but the report is released (see _release()).
+        """
+        sites, summaries = self._state["sites"], self._state["summaries"]
+        truncated = bool(self.deadline and self.deadline.truncations)
+        usable = self.results.get("background") or self.results.get("products") or any(self._is_analysed(site) for site in sites)
+        if not usable and not truncated:
+            result = self._skip_stage("report", "no stage produced usable results", avoided=(("gemini", "generate_content"),))
+            self._state["report"] = f"Error: Could not generate the report ({result.reason})."
+            self._release()
+            return
+
+        # NOTE: When the time budget cut the stages short, whatever they got to (e.g. the site addresses) is still reported,
+        # compiled without the model if none of it is worth a report call.
+        result = None
+        if usable and not (self.deadline and self.deadline.expired):
+            report_fingerprint = CheckpointStore.fingerprint(self.company_name, sites, summaries, self._router.route("report"), ReportGeneratorAgent.PROMPT_VERSION)
+            result = self._run_stage("report", report_fingerprint, lambda: self._report(sites, summaries))
+        if result is None or (not result and self.deadline and self.deadline.expired):
+            if result is None and usable:
+                self.deadline.truncate("report")
+            # The compiled report is not checkpointed, so that the next run with time to spare formats it with the model
+            result = StageResult.success(self._report(sites, summaries, use_llm=False), confidence=0.5)
+            self.results["report"] = result
+            self._set_stage_status("report", f"compiled without the model ({self.TIME_BUDGET_REASON})")
+        note = self._truncation_note()
+        self._state["report"] = f"{result.value}{note}" if note else result.value
+        self._release()
+
+    def _release(self) -> None:
+        """
+        Drops what a finished run no longer needs once its report is generated: the outputs of the steps, the values of the
+        stage results (only their status, confidence and reason are kept for summary()) and the agents.
+        NOTE: A batch run keeps every pipeline until the whole portfolio is done, so without this each finished company would
+        hold its page texts, summaries and analyses (and a long batch its whole research) until the end.
+        """
+        self._state = {"report": self._state.get("report")}
+        self.results = {key: StageResult(ok=result.ok, confidence=result.confidence, reason=result.reason) for key, result in self.results.items()}
+        self._company_research_agent = self._summary_agent = None
+        self._satellite_analysis_agents = {}
+
+    def summary(self) -> str:
+        """
+        Summarises what was changed and what was reused in the last run.
+
+        Returns:
+            str: One line per stage, e.g. "  - background: reused". The stages that run once per site count each status,
+            e.g. "  - satellite_analysis (3 sites): 2 reused, 1 computed". The calls skipped because of invalid inputs and the
+            work cut short by the time budget are counted last.
+        """
+        lines = [f"{self.company_name}:"]
+        for stage in self.STAGES:
+            if stage not in self.SITE_STAGES:
+                result = self.results.get(stage)
+                confidence = f" (confidence {result.confidence:.1f})" if result and result.confidence < 1 else ""
+                lines.append(f"  - {stage}: {self.stage_status.get(stage, 'not run')}{confidence}")
+                continue
+
+            counts = {}
+            for key, status in self.stage_status.items():
+                if key.startswith(f"{stage}/"):
+                    counts[status] = counts.get(status, 0) + 1
+            if not counts:
+                lines.append(f"  - {stage}: not run")
+                continue
+            site_count = sum(counts.values())
+            lines.append(f"  - {stage} ({site_count} site{'s' if site_count != 1 else ''}): " + ", ".join(f"{count} {status}" for status, count in counts.items()))
+
+        if self.avoided_calls:
+            lines.append("  - calls avoided (invalid inputs): " + ", ".join(f"{count} {kind} {operation}" for (kind, operation), count in self.avoided_calls.items()))
+        if self.deadline and self.deadline.truncations:
+            lines.append(f"  - cut short by the time budget of {self.deadline.budget_s:g}s: {len(self.deadline.truncations)} stage(s) or call(s)")
+        return "\n".join(lines)
+
+    def write_report(self, report: str) -> str:
+        """
+        Writes the report to a Markdown file named after the company, and indexes it in the report store, if any.
+
+        Args:
+            report (str): The generated Markdown report.
+
+        Returns:
+            str: The path of the written file.
+        """
+        report_path = f"nop_{self.company_slug}.md"
+        # NOTE: Written to a temporary file first, as two jobs of the report service may write the same company's report at once.
+        tmp_path = f"{report_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(report)
+        os.replace(tmp_path, report_path)
+
+        if self.report_store:
+            # NOTE: The file is already written, so a failure to index it is logged rather than failing the run.
+            # It can be indexed later by importing the file (see search_reports.py).
+            try:
+                self.report_store.add(report, company=self.company_name, path=report_path)
+            except Exception as e:
+                logging.error(f"Could not index the report of {self.company_name}: {e}")
+        return report_path
@@ -1,16 +1,31 @@
 from GeminiAPI import *
 from GoogleMapsAPI import *
+from ClientRegistry import clients
+from ImageTriage import *
+from StageResult import StageResult
 import logging
 from pathlib import Path
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-
 class SatelliteAnalysisAgent():
     """
     An agent dedicated to analysing satellite imagery for risk assessment.
     """
 
-    def __init__(self, company_name: str, company_address: str, output_dir: str = "satellite_images"):
+    # Bump this whenever the vision analysis prompt changes, so that incremental refreshes re-analyse the image.
+    PROMPT_VERSION = 2
+
+    # Start of the text returned instead of an analysis for an image that was not sent to the LLM.
+    NOT_ANALYSED = "Satellite image not analysed"
+
+    # Zoom level used for the satellite image, chosen to frame a typical commercial site.
+    ZOOM_FACTOR = 18.85
+
+    # Ground size of a pixel of the satellite image at the equator (Web Mercator). It shrinks with the cosine of the latitude,
+    # which is not known here, so distances measured with it are upper bounds.
+    METRES_PER_PIXEL = 156543.03392 / 2 ** ZOOM_FACTOR
+
+    def __init__(self, company_name: str, company_address: str, output_dir: str = "satellite_images", llm: GeminiAPI | None = None, maps_client: GoogleMapsAPI | None = None,
+                 image_triage: ImageTriage | None = None):
         """
         Initialises the agent, API key, and the vision model.
 
@@ -18,6 +33,9 @@ class SatelliteAnalysisAgent():
             company_name (str): The name of the company to analyse.
             company_address (str): The address of the company to analyse.
             output_dir (str): Directory to save downloaded satellite images.
+            llm (GeminiAPI | None): A Gemini API client to reuse. If not provided, the shared one of the client registry is used.
+            maps_client (GoogleMapsAPI | None): A Google Maps API client to reuse. If not provided, the shared one of the client registry is used.
+            image_triage (ImageTriage | None): Measures the image before it is sent to the vision model. If not provided, a default one is used.
         """
 
         self.company_name = company_name
@@ -28,10 +46,12 @@ class SatelliteAnalysisAgent():
         self.output_path.mkdir(parents=True, exist_ok=True)
 
         # Initialise Google Maps API client
-        self.maps_client = GoogleMapsAPI()
+        self.maps_client = maps_client if maps_client else clients.maps()
 
         # Initialise Gemini API client
-        self.llm = GeminiAPI()
+        self.llm = llm if llm else clients.gemini()
+
+        self.image_triage = image_triage if image_triage else ImageTriage()
 
     def get_satellite_image(self, filename_prefix: str) -> str | None:
         """
@@ -47,10 +67,10 @@ class SatelliteAnalysisAgent():
             logging.error("Cannot get satellite image: No address provided.")
             return None
 
-        logging.info(f"Retrieving satellite image for address: {self.company_address}")
+        logging.info("Retrieving satellite image for address: %s", self.company_address)
         
         try:
-            image_data = self.maps_client.get_satellite_image_bytes(self.company_address, zoom_factor=18.85)
+            image_data = self.maps_client.get_satellite_image_bytes(self.company_address, zoom_factor=self.ZOOM_FACTOR)
             image_filepath = self.output_path / f"{filename_prefix}_satellite.png"
             with open(image_filepath, 'wb') as f:
                 f.write(image_data)
@@ -61,17 +81,58 @@ class SatelliteAnalysisAgent():
             logging.error(f"Failed to retrieve satellite image: {e}")
             return None
 
+    def triage_image(self, image_bytes: bytes) -> dict | None:
+        """
+        Measures the satellite image locally (see ImageTriage).
+
+        Args:
+            image_bytes (bytes): The satellite image bytes.
+
+        Returns:
+            dict | None: The measurements, or None if the image could not be decoded (it is then sent to the model without them).
+        """
+        try:
+            return self.image_triage.analyse(image_bytes, metres_per_pixel=self.METRES_PER_PIXEL)
+        except Exception as e:
+            logging.warning(f"Could not measure the satellite image of {self.company_address}: {e}")
+            return None
+
     def analyze_visuals_with_llm(self, image_path: str) -> str:
         """
         Uses a multimodal LLM to analyse the satellite image for insurance risks.
+        Images without usable imagery (a placeholder, or clouded over the site as well as most of the image) are not sent to the LLM.
+        Partly clouded images are still sent, and the model is asked to caveat its findings.
 
         Args:
             image_path (str): The file path to the satellite image.
 
         Returns:
-            str: The analysis report generated by the LLM.
+            str: The analysis report generated by the LLM, or why the image was not analysed.
         """
-        logging.info(f"Sending satellite image at {image_path} to Vision LLM for analysis...")
+        try:
+            with open(image_path, 'rb') as f:
+                image_bytes = f.read()
+        except OSError as e:
+            logging.error(f"Could not read the satellite image at {image_path}: {e}")
+            return "Error: Could not analyse satellite image."
+
+        features = self.triage_image(image_bytes)
+        if features and not features["usable"]:
+            logging.info(f"Not sending the satellite image at {image_path} to the Vision LLM: {features['reason']}.")
+            metrics.record_avoided_call("gemini", "generate_content", f"image {features['reason']}")
+            return f"{self.NOT_ANALYSED}: {features['reason']}. The site should be assessed from other imagery or a survey."
+
+        # NOTE: The measurements come from colour heuristics, so the model is asked to use them as support rather than as findings.
+        measurements = ""
+        if features:
+            measurements = "\n        ".join(["--- IMAGE MEASUREMENTS ---",
+                                                "Measured automatically from the image colours (approximate, and distances are upper bounds). "
+                                                "Use them to support what you see, and do not report them where the image disagrees.",
+                                                *ImageTriage.describe(features).splitlines()])
+            if features["caveat"]:
+                measurements += ("\n        Caveat: " + features["caveat"] + ". Say so in your analysis, and do not assess what the cloud hides.")
+
+        logging.info("Sending satellite image at %s to Vision LLM for analysis...", image_path)
         
         prompt = f"""
         You are a professional insurance underwriter tasked with analysing a satellite image of a commercial property. 
@@ -98,15 +159,11 @@ class SatelliteAnalysisAgent():
 
         --- ADDRESS ---
         {self.company_address}
-
+        {measurements}
         """
         
         try:
-
-            with open(image_path, 'rb') as f:
-                image_bytes = f.read()
-
-            response = self.llm.generate_content(prompt, image_bytes=image_bytes)
+            response = self.llm.generate_content(prompt, image_bytes=image_bytes, stage="satellite_analysis")
             logging.info("Successfully received visual analysis from LLM.")
             return str(response.text).strip().replace("�", "")
         
@@ -125,6 +182,13 @@ class SatelliteAnalysisAgent():
         Returns:
             A dictionary containing the image path and the analysis text.
         """
+        # An address that could not be extracted is neither imaged nor analysed
+        address_result = StageResult.of_address(self.company_address)
+        if not address_result:
+            metrics.record_avoided_call("maps", "static_map", address_result.reason)
+            metrics.record_avoided_call("gemini", "generate_content", address_result.reason)
+            return {"image_path": None, "analysis_text": f"Not analysed ({address_result.reason})."}
+
         # Fetch the image
         filename_prefix = self.company_name.lower().replace(' ', '_')
         image_path = self.get_satellite_image(filename_prefix)
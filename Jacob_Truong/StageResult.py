@@ -0,0 +1,115 @@
+import re
+
+class StageResult():
+    """
+    A class holding the outcome of a pipeline stage: whether it succeeded, its value, how confident the pipeline is in the value
+    and, for a failure, why it failed. The agents report failures as "Error: ..." strings (or empty values), which the checks
+    below turn into failed results, so that the pipeline can skip the calls that would only work on a failed input
+    (e.g. geocoding an error message) instead of passing the error on.
+    """
+
+    # Addresses longer than this are model commentary rather than an address
+    MAX_ADDRESS_CHARS = 200
+
+    # Summaries shorter than this are kept, but with a lower confidence
+    MIN_SUMMARY_CHARS = 200
+
+    def __init__(self, value=None, ok: bool = True, confidence: float = 1.0, reason: str | None = None):
+        """
+        Initialise the result. Use success() or failure() instead.
+
+        Args:
+            value: The output of the stage. A failed stage may still carry its raw output.
+            ok (bool): Whether the stage succeeded.
+            confidence (float): How much the value can be relied on, from 0 to 1. Always 0 for a failure.
+            reason (str | None): Why the stage failed.
+        """
+        self.value = value
+        self.ok = ok
+        self.confidence = confidence if ok else 0.0
+        self.reason = reason
+
+    @classmethod
+    def success(cls, value, confidence: float = 1.0) -> "StageResult":
+        """Builds a successful result."""
+        return cls(value, ok=True, confidence=confidence)
+
+    @classmethod
+    def failure(cls, reason: str, value=None) -> "StageResult":
+        """Builds a failed result."""
+        return cls(value, ok=False, reason=reason)
+
+    def __bool__(self) -> bool:
+        return self.ok
+
+    def __repr__(self) -> str:
+        if self.ok:
+            return f"StageResult(ok, confidence={self.confidence:.2f})"
+        return f"StageResult(failed: {self.reason})"
+
+    @staticmethod
+    def is_error(text) -> bool:
+        """
+        Checks whether an agent returned one of its error strings instead of a result.
+
+        Args:
+            text: The agent output to check.
+
+        Returns:
+            bool: True if the output is missing or an error message.
+        """
+        return not text or str(text).startswith("Error:")
+
+    @classmethod
+    def of_text(cls, text: str | None, min_chars: int = 0) -> "StageResult":
+        """
+        Checks the text output of a Gemini stage (a summary, an image analysis or the report).
+
+        Args:
+            text (str | None): The output of the stage.
+            min_chars (int): Outputs shorter than this are kept with a lower confidence.
+
+        Returns:
+            StageResult: A failure for an empty output or an error string.
+        """
+        if cls.is_error(text):
+            return cls.failure(str(text).removeprefix("Error:").strip().rstrip(".") if text else "empty output", text)
+        return cls.success(text, 1.0 if len(text) >= min_chars else 0.5)
+
+    @classmethod
+    def of_address(cls, address: str | None) -> "StageResult":
+        """
+        Checks an extracted address before it is geocoded.
+
+        Args:
+            address (str | None): The address returned by the extraction.
+
+        Returns:
+            StageResult: A failure for an error string or text that cannot be an address (e.g. "No address found."). Addresses
+            with both a number and a comma are fully trusted, addresses with only one of them get a lower confidence.
+        """
+        if cls.is_error(address) or not address.strip():
+            return cls.failure("no address extracted", address)
+        if len(address) > cls.MAX_ADDRESS_CHARS:
+            return cls.failure("too long to be an address", address)
+
+        has_number = bool(re.search(r"\d", address))
+        has_parts = "," in address or "\n" in address
+        if not has_number and not has_parts:
+            return cls.failure("not an address", address)
+        return cls.success(address, 1.0 if has_number and has_parts else 0.6)
+
+    @classmethod
+    def of_location(cls, location_info: dict | None) -> "StageResult":
+        """
+        Checks the geocoding result of an address before its satellite image is fetched.
+
+        Args:
+            location_info (dict | None): The city, state and country of the address.
+
+        Returns:
+            StageResult: A failure if the address could not be geocoded. Locations without a city or country get a lower confidence.
+        """
+        if not location_info:
+            return cls.failure("address could not be geocoded", location_info)
+        return cls.success(location_info, 1.0 if location_info.get("city") and location_info.get("country") else 0.6)
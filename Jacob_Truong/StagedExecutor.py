@@ -0,0 +1,320 @@
+import contextvars
+import threading
+import time
+import logging
+from collections import deque
+from concurrent.futures import Future
+
+from Metrics import metrics
+
+class StagedExecutor():
+    """
+    A class that runs items (e.g. the pipelines of a portfolio of companies) through a sequence of stages, with a queue in front
+    of every stage and one bounded pool of worker threads per resource class (e.g. "http", "gemini", "maps"), so that each
+    resource works through the stages bound by it while the other resources work on other items.
+    New items are only admitted while the number of items in flight, the number of items waiting in the stage queues and the
+    memory held by the items in flight are below their limits (backpressure), and the time every stage is busy and the time
+    items wait in front of it are recorded.
+    A stage can hand parts of its work (e.g. the sites of a company) to the idle workers of its pool with map(), so that the
+    pool size stays the most calls in flight to its resource.
+    NOTE: Workers take the item of the latest stage first, so that admitted items finish (and free their memory) before new ones
+    are started, and as every stage queue is unbounded behind the admission limits, a pool never blocks on another pool.
+    Parts handed out with map() are taken before any stage.
+    """
+
+    # The executor, resource and stage of the stage running in the current context, see current_pool()
+    _current = contextvars.ContextVar("staged_executor_current", default=None)
+
+    def __init__(self, stages: tuple, run_stage, workers: dict[str, int], max_in_flight: int = 8, max_queued: int | None = None,
+                 max_in_flight_bytes: int | None = None, size=None, name: str = "batch"):
+        """
+        Initialise the executor and start its worker threads.
+
+        Args:
+            stages (tuple): The (stage, resource) pairs every item runs through, in order.
+            run_stage (Callable): Called with an item and a stage to run the stage of the item.
+            workers (dict[str, int]): The number of worker threads of each resource. Resources left out get one worker.
+            max_in_flight (int): The most items admitted and not yet finished at once.
+            max_queued (int | None): The most items waiting in the stage queues at once, or None for no limit besides max_in_flight.
+            max_in_flight_bytes (int | None): The most memory held by the items in flight at once, as measured by size, or None for no limit.
+                At least one item is always admitted, however large.
+            size (Callable | None): Called with an item after each of its stages to measure the memory it holds in bytes.
+            name (str): The name of the executor, for logging and metrics.
+        """
+        self.stages = [stage for stage, _ in stages]
+        self.resources = {stage: resource for stage, resource in stages}
+        self.run_stage = run_stage
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_queued = max_queued
+        self.max_in_flight_bytes = max_in_flight_bytes
+        self.size = size
+        self.name = name
+
+        self._condition = threading.Condition()
+        self._queues = {stage: deque() for stage in self.stages}
+        # The parts of stages handed out with map(), per resource
+        self._parts = {resource: deque() for resource in self.resources.values()}
+        self._in_flight = 0
+        self._in_flight_bytes = {}
+        self._closed = False
+        self._started_at = time.monotonic()
+        self._stage_stats = {stage: {"resource": self.resources[stage], "items": 0, "failed": 0, "busy_s": 0.0, "queue_wait_s": 0.0,
+                                     "max_queue_wait_s": 0.0, "max_queue_depth": 0} for stage in self.stages}
+        self._admission_wait_s = 0.0
+        self._max_in_flight_bytes_seen = 0
+
+        # Each pool takes from the queues of its own stages, latest stage first
+        self.workers = {resource: max(1, workers.get(resource, 1)) for resource in dict.fromkeys(self.resources.values())}
+        self._threads = []
+        for resource, count in self.workers.items():
+            resource_stages = [stage for stage in reversed(self.stages) if self.resources[stage] == resource]
+            for i in range(count):
+                thread = threading.Thread(target=self._work, args=(resource, resource_stages), name=f"{name}-{resource}-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+    def _queued(self) -> int:
+        """The number of items waiting in the stage queues. Must be called with the condition held."""
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _has_room(self) -> bool:
+        """Whether another item can be admitted. Must be called with the condition held."""
+        if self._in_flight == 0:
+            return True
+        if self._in_flight >= self.max_in_flight:
+            return False
+        if self.max_queued is not None and self._queued() >= self.max_queued:
+            return False
+        return self.max_in_flight_bytes is None or sum(self._in_flight_bytes.values()) < self.max_in_flight_bytes
+
+    def _enqueue(self, stage: str, entry: list) -> None:
+        """Puts an item in front of a stage. Must be called with the condition held."""
+        entry[2] = time.monotonic()
+        self._queues[stage].append(entry)
+        stage_stats = self._stage_stats[stage]
+        stage_stats["max_queue_depth"] = max(stage_stats["max_queue_depth"], len(self._queues[stage]))
+        self._condition.notify_all()
+
+    def submit(self, item) -> Future:
+        """
+        Admits an item into the first stage, waiting while the executor is at one of its limits.
+
+        Args:
+            item: The item, passed to run_stage with each stage.
+
+        Returns:
+            Future: Resolves to the item once its last stage has run, or to the exception of the stage that failed.
+        """
+        future = Future()
+        start = time.monotonic()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError(f"Executor {self.name} is shut down")
+            while not self._has_room():
+                self._condition.wait()
+            self._admission_wait_s += time.monotonic() - start
+            self._in_flight += 1
+            self._in_flight_bytes[id(item)] = 0
+            future.set_running_or_notify_cancel()
+            # An entry is [item, future, time queued, index of its stage]
+            self._enqueue(self.stages[0], [item, future, 0.0, 0])
+        return future
+
+    @classmethod
+    def current_pool(cls) -> tuple["StagedExecutor", str] | None:
+        """
+        The executor and resource whose pool runs the current stage, for the stage to hand parts of its work to the pool with map().
+
+        Returns:
+            tuple[StagedExecutor, str] | None: The executor and resource, or None outside of a stage run by an executor.
+        """
+        current = cls._current.get()
+        return current[:2] if current else None
+
+    def map(self, resource: str, func, *iterables) -> list:
+        """
+        Runs a function over the parts of a stage on the workers of its pool, e.g. once per site of a company, as items of their own.
+        The calling worker runs parts as well rather than holding its place in the pool while it waits, so the parts never wait
+        for a worker that is itself waiting. Each part runs in a copy of the caller's context (e.g. its metrics tags).
+
+        Args:
+            resource (str): The resource of the calling stage, see current_pool().
+            func (Callable): The function, called with the n-th item of each of iterables.
+            *iterables (list): One list per argument, with one item per part.
+
+        Returns:
+            list: The result of each part, in the same order.
+
+        Raises:
+            Exception: The exception of the first part that failed, once every part has run.
+        """
+        stage = self._current.get()[2]
+        futures = []
+        with self._condition:
+            for args in zip(*iterables):
+                future = Future()
+                # A part is [function, arguments, future, context, stage]
+                self._parts[resource].append([func, args, future, contextvars.copy_context(), stage])
+                futures.append(future)
+            self._condition.notify_all()
+
+        while True:
+            with self._condition:
+                part = self._parts[resource].popleft() if self._parts[resource] else None
+            if part is None:
+                break
+            self._run_part(part)
+        return [future.result() for future in futures]
+
+    def _run_part(self, part: list) -> None:
+        """Runs a part handed out with map(), counting its time as busy time of the stage it belongs to."""
+        func, args, future, context, stage = part
+        if not future.set_running_or_notify_cancel():
+            return
+        start = time.monotonic()
+        try:
+            future.set_result(context.run(func, *args))
+        except Exception as e:
+            future.set_exception(e)
+        with self._condition:
+            self._stage_stats[stage]["busy_s"] += time.monotonic() - start
+
+    def _take(self, resource: str, resource_stages: list[str]) -> tuple[str | None, list] | None:
+        """
+        Waits for the next item or part of a pool, or returns None once the executor is shut down and every queue is empty.
+        A part handed out with map() is returned with None as its stage.
+        """
+        with self._condition:
+            while True:
+                if self._parts[resource]:
+                    return None, self._parts[resource].popleft()
+                for stage in resource_stages:
+                    if self._queues[stage]:
+                        entry = self._queues[stage].popleft()
+                        queue_wait_s = time.monotonic() - entry[2]
+                        stage_stats = self._stage_stats[stage]
+                        stage_stats["queue_wait_s"] += queue_wait_s
+                        stage_stats["max_queue_wait_s"] = max(stage_stats["max_queue_wait_s"], queue_wait_s)
+                        return stage, entry
+                if self._closed and self._in_flight == 0:
+                    return None
+                self._condition.wait()
+
+    def _work(self, resource: str, resource_stages: list[str]) -> None:
+        """The loop of a worker thread, running the stages of its resource (and their parts) until the executor is shut down."""
+        while True:
+            taken = self._take(resource, resource_stages)
+            if taken is None:
+                return
+            stage, entry = taken
+            if stage is None:
+                self._run_part(entry)
+                continue
+            item, future = entry[0], entry[1]
+
+            start = time.monotonic()
+            error = None
+            token = self._current.set((self, resource, stage))
+            try:
+                self.run_stage(item, stage)
+                size = self.size(item) if self.size else 0
+            except Exception as e:
+                error = e
+            finally:
+                self._current.reset(token)
+            busy_s = time.monotonic() - start
+
+            with self._condition:
+                stage_stats = self._stage_stats[stage]
+                stage_stats["items"] += 1
+                stage_stats["busy_s"] += busy_s
+                entry[3] += 1
+                if error is None and entry[3] < len(self.stages):
+                    self._in_flight_bytes[id(item)] = size
+                    self._max_in_flight_bytes_seen = max(self._max_in_flight_bytes_seen, sum(self._in_flight_bytes.values()))
+                    self._enqueue(self.stages[entry[3]], entry)
+                    continue
+
+                if error is not None:
+                    stage_stats["failed"] += 1
+                self._in_flight -= 1
+                del self._in_flight_bytes[id(item)]
+                self._condition.notify_all()
+
+            if error is None:
+                future.set_result(item)
+            else:
+                logging.error(f"Stage {stage} failed: {error}")
+                future.set_exception(error)
+
+    def shutdown(self) -> None:
+        """
+        Waits for every admitted item to finish, stops the worker threads and exports the stats as metrics.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self.export_metrics()
+
+    def stats(self) -> dict:
+        """
+        Summarises how busy each stage and resource pool was and how long items waited for them.
+
+        Returns:
+            dict: The wall time, the time submit() waited for room, the peak memory of the items in flight, and for every stage
+            ("stages") its items, busy time, queue wait and peak queue depth, and for every resource ("resources") its workers,
+            busy time and utilisation (the share of the wall time its workers were busy).
+        """
+        with self._condition:
+            wall_s = time.monotonic() - self._started_at
+            stages = {}
+            for stage, stage_stats in self._stage_stats.items():
+                items = stage_stats["items"]
+                stages[stage] = {**stage_stats, "busy_s": round(stage_stats["busy_s"], 3), "queue_wait_s": round(stage_stats["queue_wait_s"], 3),
+                                 "mean_queue_wait_s": round(stage_stats["queue_wait_s"] / items, 3) if items else 0.0,
+                                 "max_queue_wait_s": round(stage_stats["max_queue_wait_s"], 3), "queue_depth": len(self._queues[stage])}
+            resources = {}
+            for resource, count in self.workers.items():
+                busy_s = sum(stage_stats["busy_s"] for stage_stats in self._stage_stats.values() if stage_stats["resource"] == resource)
+                resources[resource] = {"workers": count, "busy_s": round(busy_s, 3), "utilisation": round(busy_s / (count * wall_s), 3) if wall_s else 0.0}
+            return {"wall_s": round(wall_s, 3), "admission_wait_s": round(self._admission_wait_s, 3),
+                    "max_in_flight_bytes": self._max_in_flight_bytes_seen, "stages": stages, "resources": resources}
+
+    def export_metrics(self) -> None:
+        """
+        Exports the utilisation of every resource pool and the queue wait of every stage as gauges of the process-wide metrics.
+        """
+        stats = self.stats()
+        for resource, resource_stats in stats["resources"].items():
+            metrics.set_gauge("pool_utilisation", resource_stats["utilisation"], "Share of the wall time the worker pool of a resource was busy",
+                              executor=self.name, resource=resource)
+        for stage, stage_stats in stats["stages"].items():
+            metrics.set_gauge("stage_queue_wait_seconds", stage_stats["mean_queue_wait_s"], "Mean time items waited in front of a stage",
+                              executor=self.name, stage=stage)
+            metrics.set_gauge("stage_max_queue_depth", stage_stats["max_queue_depth"], "Most items waiting in front of a stage at once",
+                              executor=self.name, stage=stage)
+
+    def format_stats(self) -> str:
+        """
+        Formats the stats as a table, one line per stage.
+
+        Returns:
+            str: The table.
+        """
+        stats = self.stats()
+        lines = [f"{'stage':<20} {'pool':<8} {'items':>5} {'busy s':>8} {'mean wait s':>11} {'max depth':>9}"]
+        for stage, stage_stats in stats["stages"].items():
+            lines.append(f"{stage:<20} {stage_stats['resource']:<8} {stage_stats['items']:>5} {stage_stats['busy_s']:>8.2f} "
+                         f"{stage_stats['mean_queue_wait_s']:>11.2f} {stage_stats['max_queue_depth']:>9}")
+        lines.append("Pool utilisation: " + ", ".join(f"{resource} {resource_stats['utilisation']:.0%} of {resource_stats['workers']} workers"
+                                                      for resource, resource_stats in stats["resources"].items()))
+        lines.append(f"Wall time {stats['wall_s']:.2f}s, of which {stats['admission_wait_s']:.2f}s waiting for room to admit companies")
+        return "\n".join(lines)
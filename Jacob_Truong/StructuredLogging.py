@@ -0,0 +1,256 @@
+import atexit
+import json
+import logging
+import queue
+import sys
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from Metrics import metrics
+
+class LogSampler(logging.Filter):
+    """
+    A logging filter that samples high-volume messages. The first records of each message template (the message before its
+    arguments are filled in, e.g. "Found '%s' page link: %s") are all kept, after which only a share of them is kept per level.
+    Warnings and errors are never sampled.
+    NOTE: Messages logged as f-strings have a template of their own per call, so only the messages logged with lazy %-style
+    arguments (the hot paths) are grouped and sampled.
+    """
+
+    # The most message templates counted at once. Every f-string message is a template of its own, so the counts are reset
+    # once this many are held rather than growing with the length of the run.
+    MAX_TEMPLATES = 10000
+
+    def __init__(self, rates: dict[str, float] | None = None, burst: int = 50):
+        """
+        Initialise the sampler.
+
+        Args:
+            rates (dict[str, float] | None): The share of records kept per level name (e.g. {"INFO": 0.1}) once a template is past its burst.
+                Levels left out are not sampled.
+            burst (int): The number of records of each template kept before sampling starts.
+        """
+        super().__init__()
+        self.rates = {logging.getLevelName(level.upper()): rate for level, rate in (rates or {}).items()}
+        self.burst = burst
+        self._counts = {}
+        self._dropped = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = self.rates.get(record.levelno)
+        if rate is None or record.levelno >= logging.WARNING:
+            return True
+
+        key = (record.levelno, str(record.msg))
+        with self._lock:
+            if key not in self._counts and len(self._counts) >= self.MAX_TEMPLATES:
+                self._counts = {template: self._counts[template] for template in self._dropped}
+            count = self._counts.get(key, 0) + 1
+            self._counts[key] = count
+            # Keep every n-th record past the burst, so that the kept records are spread over the run
+            keep = count <= self.burst or (rate > 0 and (count - self.burst) % max(1, round(1 / rate)) == 0)
+            if not keep:
+                self._dropped[key] = self._dropped.get(key, 0) + 1
+        return keep
+
+    def dropped(self) -> list[dict]:
+        """
+        Lists the records dropped by sampling so far.
+
+        Returns:
+            list[dict]: One entry per level and message template with the number of records seen and dropped, most dropped first.
+        """
+        with self._lock:
+            return sorted(({"level": logging.getLevelName(level), "template": template, "seen": self._counts[(level, template)], "dropped": dropped}
+                           for (level, template), dropped in self._dropped.items()), key=lambda entry: -entry["dropped"])
+
+
+class LogContextFilter(logging.Filter):
+    """
+    A logging filter that tags every record with the company and stage it was logged for (see Metrics.tags()) and the run id.
+    It runs in the thread that logs the record, where these are set.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        tags = metrics.current_tags()
+        record.company = tags["company"]
+        record.stage = tags["stage"]
+        record.run_id = metrics.run_id
+        return True
+
+
+class JsonLogFormatter(logging.Formatter):
+    """
+    A logging formatter writing each record as one JSON object per line, with its time, level, message, logger, thread,
+    company, stage and run id, and the traceback of an exception, if any.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "message": record.getMessage(),
+            "logger": record.name,
+            "thread": record.threadName,
+            "company": getattr(record, "company", None),
+            "stage": getattr(record, "stage", None),
+            "run_id": getattr(record, "run_id", None)
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """
+    A queue handler that leaves the formatting of the message to the writer thread. The standard QueueHandler formats every
+    record in the thread that logs it (so that it can be pickled for a process queue), which is the work that lazy %-style
+    arguments are meant to avoid. The queue here never leaves the process, so the record is passed on as it is.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class StructuredLogging():
+    """
+    A class that sets up the logging of the whole process: every record is tagged with its company, stage and run id,
+    sampled (see LogSampler) and put on a queue by the thread that logs it, and a background thread formats the records
+    (as JSON lines, or as plain text) and writes them out. Threads that log never wait on the output stream or on each
+    other's writes, and the lines of concurrent companies are never interleaved mid-line.
+    NOTE: A single process-wide instance (structured_logging) is configured once by each runner (cli.py, batch_run.py,
+    service.py, direct_run.py), see the bottom of this file. Modules only log to the root logger.
+    """
+
+    TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+    # The share of records kept per level once a message template is past its burst
+    DEFAULT_SAMPLE_RATES = {"DEBUG": 0.01, "INFO": 0.1}
+
+    def __init__(self):
+        """
+        Initialise the logging setup. Nothing is configured until configure() is called.
+        """
+        self.sampler = None
+        self._listener = None
+        self._handler = None
+        self._lock = threading.Lock()
+
+    def configure(self, level: str = "INFO", log_format: str = "json", log_file: str | None = None,
+                  sample_rates: dict[str, float] | None = None, burst: int = 50) -> None:
+        """
+        Sets up the queue-based logging of the process, replacing any handlers of the root logger.
+
+        Args:
+            level (str): The lowest level logged (e.g. INFO).
+            log_format (str): "json" for JSON lines, or "text" for the plain text format.
+            log_file (str | None): A file the records are appended to. If not provided, they are written to stderr.
+            sample_rates (dict[str, float] | None): The share of records kept per level, see LogSampler. If not provided, DEFAULT_SAMPLE_RATES are used.
+            burst (int): The number of records of each message template kept before sampling starts.
+        """
+        with self._lock:
+            self._stop()
+
+            output = logging.FileHandler(log_file, encoding="utf-8") if log_file else logging.StreamHandler(sys.stderr)
+            output.setFormatter(JsonLogFormatter() if log_format == "json" else logging.Formatter(self.TEXT_FORMAT))
+
+            self.sampler = LogSampler(self.DEFAULT_SAMPLE_RATES if sample_rates is None else sample_rates, burst=burst)
+            # NOTE: The queue is unbounded, so logging never blocks. The writer keeps up with any realistic log volume once sampled.
+            log_queue = queue.SimpleQueue()
+            self._handler = _DeferredQueueHandler(log_queue)
+            # Records are sampled first, so that the dropped ones are not tagged
+            self._handler.addFilter(self.sampler)
+            self._handler.addFilter(LogContextFilter())
+
+            root = logging.getLogger()
+            for handler in list(root.handlers):
+                root.removeHandler(handler)
+            root.addHandler(self._handler)
+            root.setLevel(level.upper())
+
+            self._listener = QueueListener(log_queue, output, respect_handler_level=True)
+            self._listener.start()
+
+    def _stop(self) -> None:
+        """Writes out the queued records and stops the writer thread. Must be called with the lock held."""
+        if self._listener is None:
+            return
+        self._listener.stop()
+        for handler in self._listener.handlers:
+            handler.close()
+        logging.getLogger().removeHandler(self._handler)
+        self._listener = self._handler = None
+
+    def shutdown(self) -> None:
+        """
+        Logs how many records were dropped by sampling, writes out every queued record and stops the writer thread.
+        Called when the process exits.
+        """
+        if self.sampler and self._listener:
+            for entry in self.sampler.dropped()[:10]:
+                logging.warning(f"Sampled out {entry['dropped']} of {entry['seen']} {entry['level']} records of {entry['template']!r}.")
+        with self._lock:
+            self._stop()
+
+    @staticmethod
+    def parse_sample_rates(sample_rates: list[str]) -> dict[str, float]:
+        """
+        Parses the sample rates given on the command line.
+
+        Args:
+            sample_rates (list[str]): Rates as LEVEL=share, e.g. ["INFO=0.1", "DEBUG=0"].
+
+        Returns:
+            dict[str, float]: The share of records kept per level name.
+
+        Raises:
+            ValueError: If a rate is not a known level with a share between 0 and 1.
+        """
+        rates = {}
+        for sample_rate in sample_rates:
+            level, _, share = sample_rate.partition("=")
+            try:
+                rate = float(share)
+            except ValueError:
+                rate = -1.0
+            if level.upper() not in ("DEBUG", "INFO") or not 0 <= rate <= 1:
+                raise ValueError(f"Invalid sample rate {sample_rate!r}, expected DEBUG or INFO = a share between 0 and 1")
+            rates[level.upper()] = rate
+        return rates
+
+    @staticmethod
+    def add_arguments(parser) -> None:
+        """
+        Adds the logging options shared by the runners to an argument parser.
+
+        Args:
+            parser (argparse.ArgumentParser): The parser of a runner.
+        """
+        parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                           help='Lowest level logged (default: INFO)')
+        parser.add_argument('--log-format', default='json', choices=['json', 'text'],
+                           help='Log records as JSON lines tagged with the company, stage and run id, or as plain text (default: json)')
+        parser.add_argument('--log-file', default=None, metavar='PATH',
+                           help='Append the log to this file instead of writing it to stderr')
+        parser.add_argument('--log-sample', nargs='+', default=None, metavar='LEVEL=SHARE',
+                           help='Share of repeated DEBUG/INFO messages kept once past the first 50 of each (default: DEBUG=0.01 INFO=0.1)')
+
+    def configure_from_args(self, args, parser) -> None:
+        """
+        Sets up the logging from the options added by add_arguments().
+
+        Args:
+            args (argparse.Namespace): The parsed arguments.
+            parser (argparse.ArgumentParser): The parser, to report an invalid option.
+        """
+        try:
+            sample_rates = self.parse_sample_rates(args.log_sample) if args.log_sample else None
+        except ValueError as e:
+            parser.error(str(e))
+        self.configure(args.log_level, args.log_format, args.log_file, sample_rates)
+
+
+structured_logging = StructuredLogging()
+atexit.register(structured_logging.shutdown)
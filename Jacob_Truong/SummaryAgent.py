@@ -1,33 +1,82 @@
 from GeminiAPI import *
+from ClientRegistry import clients
 import logging
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-
 class SummaryAgent():
     """
     An agent that uses Google APIs to analyse and process data gathered by
     the CompanyResearchAgent.
     """
 
-    def __init__(self, company_name: str):
+    # Bump this whenever the summarisation or product listing prompts change, so that incremental refreshes regenerate them.
+    PROMPT_VERSION = 2
+
+    # Instructions shared by every call of this agent. They are sent as system instructions, or held in the company's context cache.
+    SYSTEM_INSTRUCTION = """You are a professional insurance underwriter writing a Nature of Operations report on a company.
+    You are given data scraped from the company's website. Note that the data may contain noise and/or scraping artifacts,
+    so use your best judgment to analyse the data and extract the most relevant information. Do not make up any information.
+    Do not include a header, title, or any other introductory text.
+    Use British English spelling and terminology throughout the analysis."""
+
+    def __init__(self, company_name: str, llm: GeminiAPI | None = None):
         """
         Initialises the agent and configures the Gemini API.
 
         Args:
             company_name (str): The name of the company to analyse.
+            llm (GeminiAPI | None): A Gemini API client to reuse. If not provided, the shared one of the client registry is used.
         """
 
         self.company_name = company_name
 
         # Initialise Gemini API client
-        self.llm = GeminiAPI()
+        self.llm = llm if llm else clients.gemini()
+
+    @staticmethod
+    def build_corpus(background_text: str, products_text: str) -> str:
+        """
+        Combines the background and products text of a company into one corpus, to be held in a context cache.
+
+        Args:
+            background_text (str): The pre-cleaned background text from the company's website.
+            products_text (str): The pre-cleaned text from the company's products/services pages.
+
+        Returns:
+            str: The corpus, with each text in its own labelled section.
+        """
+        return (f"--- BACKGROUND TEXT ---\n{background_text if background_text else 'No background text available.'}\n--- END BACKGROUND TEXT ---\n\n"
+                f"--- PRODUCTS TEXT ---\n{products_text if products_text else 'No product text available.'}\n--- END PRODUCTS TEXT ---")
+
+    def create_corpus_cache(self, background_text: str, products_text: str, ttl_s: int = 600) -> str | None:
+        """
+        Caches the system instructions together with the company's corpus, so that the background and products calls
+        can both reference it instead of each sending their text.
+
+        Args:
+            background_text (str): The pre-cleaned background text from the company's website.
+            products_text (str): The pre-cleaned text from the company's products/services pages.
+            ttl_s (int): How long the cache lives, in seconds, unless it is deleted earlier.
 
-    def summarise_background(self, text: str) -> str:
+        Returns:
+            str | None: The name of the cache, or None if the corpus is too small to be cached, the two calls are routed to
+                different models, or caching failed.
+        """
+        # NOTE: A cache can only be referenced by calls to the model it was created for.
+        model = self.llm.router.route("background")["model"]
+        if self.llm.router.route("products")["model"] != model:
+            logging.info("Not caching the corpus, as the background and products calls are routed to different models.")
+            return None
+
+        return self.llm.create_cache(self.SYSTEM_INSTRUCTION, self.build_corpus(background_text, products_text), ttl_s=ttl_s,
+                                     display_name=self.company_name, model=model)
+
+    def summarise_background(self, text: str, cached_content: str | None = None) -> str:
         """
         Uses the LLM to summarise the company's background, focusing on key facts.
 
         Args:
             text (str): The pre-cleaned background text from the company's website.
+            cached_content (str | None): A context cache created with create_corpus_cache. If given, the text is read from the cache instead of being sent.
 
         Returns:
             str: A summary of the company's history and milestones.
@@ -35,21 +84,21 @@ class SummaryAgent():
 
         logging.info("Sending background text to LLM for summarisation...")
 
-        prompt = f"""You are a professional insurance underwriter writing a report on the company {self.company_name}.
-        Given the following scraped data, write a detailed report on the company. Note that the data may be contain noises and/or scraping artifacts,
-        so use your best judgment to analyse the data and extract the most relevant information. Do not make up any information.
+        prompt = f"""Write a detailed report on the company {self.company_name}.
         The output should be in 2 to 5 paragraphs, suitable to be included for a Nature of Operations report. Make sure to include
         information on its history, when it was founded, its key milestones, and its current operations. The tone should be factual and professional.
-        Do not include a header, title, or any other introductory text.
-        Use British English spelling and terminology throughout the analysis.
-
+        """
+        if cached_content:
+            prompt += "Base the report on the BACKGROUND TEXT section of the scraped data provided in the context.\n"
+        else:
+            prompt += f"""
         --- TEXT ---
 
         {text if text else 'No background text available.'}
         --- END TEXT ---
         """
         try:
-            response = self.llm.generate_content(prompt)
+            response = self.llm.generate_content(prompt, system_instruction=self.SYSTEM_INSTRUCTION, cached_content=cached_content, stage="background")
             logging.info("Successfully received summary from LLM.")
             return str(response.text).strip().replace("�", "")
         except Exception as e:
@@ -60,12 +109,13 @@ class SummaryAgent():
             
             return "Error: Could not summarise the background text."
 
-    def list_products_services(self, text: str) -> str:
+    def list_products_services(self, text: str, cached_content: str | None = None) -> str:
         """
         Uses the LLM to identify and list the company's main products or services.
 
         Args:
             text (str): The pre-cleaned text from the company's products/services page.
+            cached_content (str | None): A context cache created with create_corpus_cache. If given, the text is read from the cache instead of being sent.
 
         Returns:
             str: A string containing a bulleted list of the company's main products or services.
@@ -73,13 +123,13 @@ class SummaryAgent():
 
         logging.info("Sending products text to LLM for extraction...")
 
-        prompt = f"""You are a professional insurance underwriter writing a report on the company {self.company_name}.
-        Given the following scraped data, identify and list the main products or services offered. Note that the data may be contain noises and/or scraping artifacts,
-        so use your best judgment to analyse the data and extract the most relevant information. Ensure all core products and services are included. Do not make up any information.
+        prompt = f"""Identify and list the main products or services offered by the company {self.company_name}. Ensure all core products and services are included.
         For each item, provide a single, one-line description and any relevant risk notes on the same line. Return the output as a bulleted-formatted text, with each item starting with a '-'.
-        Do not include a header, title, or any other introductory text.
-        Use British English spelling and terminology throughout the analysis.
-
+        """
+        if cached_content:
+            prompt += "Base the list on the PRODUCTS TEXT section of the scraped data provided in the context.\n"
+        else:
+            prompt += f"""
         --- TEXT ---
 
         {text if text else 'No product text available.'}
@@ -87,7 +137,7 @@ class SummaryAgent():
         """
     
         try:
-            response = self.llm.generate_content(prompt)
+            response = self.llm.generate_content(prompt, system_instruction=self.SYSTEM_INSTRUCTION, cached_content=cached_content, stage="products")
             # Split the response into a list and clean it up
             products = [line.strip('* ').strip() for line in str(response.text).strip().split('\n') if line.strip()]
             logging.info(f"Successfully extracted {len(products)} products/services.")
@@ -0,0 +1,174 @@
+import argparse
+import csv
+import os
+import logging
+from dotenv import load_dotenv
+from StructuredLogging import StructuredLogging, structured_logging
+from Cassette import Cassette
+
+# NOTE: This runs the pipeline for every company of a portfolio file. The companies run through the steps of the pipeline together,
+# with one pool of workers each for the website, Gemini and Maps steps (see StagedExecutor), so that every service is kept busy.
+# The portfolio file is a CSV file with a "company_name" and a "company_url" column, for example:
+#   company_name,company_url
+#   OpenStream AI,https://www.openstream.ai/
+#   Texwin,https://www.texwin.com/
+
+def load_portfolio(portfolio_path: str) -> list[dict]:
+    """
+    Loads the companies of a portfolio file.
+
+    Args:
+        portfolio_path (str): The path to the portfolio CSV file.
+
+    Returns:
+        list[dict]: A list of dictionaries with the company name and URL.
+    """
+    with open(portfolio_path, newline="", encoding="utf-8") as f:
+        return [row for row in csv.DictReader(f) if row.get("company_name") and row.get("company_url")]
+
+def parse_pools(pools: list[str]) -> dict[str, int]:
+    """
+    Parses the worker pool sizes given on the command line.
+
+    Args:
+        pools (list[str]): Pool sizes as resource=workers, e.g. ["http=4", "gemini=8"].
+
+    Returns:
+        dict[str, int]: The number of workers of each resource.
+    """
+    workers = {}
+    for pool in pools:
+        resource, _, count = pool.partition("=")
+        if resource not in DEFAULT_POOLS or not count.isdigit() or int(count) < 1:
+            raise argparse.ArgumentTypeError(f"Invalid pool {pool!r}, expected one of {', '.join(DEFAULT_POOLS)} = a number of workers")
+        workers[resource] = int(count)
+    return workers
+
+# The default number of workers of each resource pool
+DEFAULT_POOLS = {"http": 4, "gemini": 8, "maps": 4}
+
+def main():
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description='Generate company research reports for a portfolio of companies')
+    parser.add_argument('portfolio', help='CSV file with company_name and company_url columns')
+    parser.add_argument('--resume', action='store_true',
+                       help='Skip stages that already have a valid checkpoint from a previous run')
+    parser.add_argument('--refresh', action='store_true',
+                       help='Re-scrape the websites and re-download imagery, but only recompute the stages whose inputs changed')
+    parser.add_argument('--checkpoint-dir', default='checkpoints',
+                       help='Directory to store stage checkpoints in (default: checkpoints)')
+    parser.add_argument('--max-sites', type=int, default=None,
+                       help='Only analyse the satellite images of the first N sites; the rest are still listed in the report (default: all)')
+    parser.add_argument('--pool', nargs='+', default=[], metavar='RESOURCE=N',
+                       help=f'Workers of a resource pool, e.g. --pool http=8 gemini=4 (default: {" ".join(f"{k}={v}" for k, v in DEFAULT_POOLS.items())})')
+    parser.add_argument('--max-in-flight', type=int, default=8,
+                       help='Companies in the pipeline at once; further companies wait to be admitted (default: 8)')
+    parser.add_argument('--max-queued', type=int, default=None,
+                       help='Stop admitting companies while this many wait in front of a step (default: no limit besides --max-in-flight)')
+    parser.add_argument('--max-in-flight-mb', type=float, default=256,
+                       help='Stop admitting companies while the text held by the companies in the pipeline exceeds this many MB (default: 256)')
+    parser.add_argument('--deadline', type=float, default=None, metavar='SECONDS',
+                       help='Time budget of each company, e.g. 90. Once it runs out, the optional work left is skipped and the report notes what was cut short (default: no limit)')
+    parser.add_argument('--context-cache', action='store_true',
+                       help='Hold each company\'s scraped corpus in a Gemini context cache shared by the background and products calls')
+    parser.add_argument('--quota-db', default=None, metavar='PATH',
+                       help='SQLite file holding the Gemini and Maps rate limit budget shared by every process using it (default: ARCS_QUOTA_DB, if set)')
+    parser.add_argument('--report-db', default='reports.db', metavar='PATH',
+                       help='SQLite file indexing every written report for search_reports.py, or "" to not index (default: reports.db)')
+    parser.add_argument('--metrics', nargs='?', const='metrics', default=None, metavar='DIR',
+                       help='Write a JSON run report and a Prometheus textfile with call metrics to DIR (default: metrics)')
+    StructuredLogging.add_arguments(parser)
+    Cassette.add_arguments(parser)
+
+    args = parser.parse_args()
+    structured_logging.configure_from_args(args, parser)
+    cassette = Cassette.from_args(args, parser)
+    try:
+        pools = {**DEFAULT_POOLS, **parse_pools(args.pool)}
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+    if args.quota_db:
+        # NOTE: The API clients pick the shared quota up from the environment, as every agent creates its own clients.
+        os.environ["ARCS_QUOTA_DB"] = args.quota_db
+
+    # NOTE: Imported after the arguments are parsed, so that --help does not wait for the API client libraries to load.
+    from ResearchPipeline import ResearchPipeline
+    from CheckpointStore import CheckpointStore
+    from ClientRegistry import clients
+    from LocationIndex import LocationIndex
+    from Metrics import metrics
+    from QuotaManager import QuotaManager
+    from ReportStore import ReportStore
+    from StagedExecutor import StagedExecutor
+
+    # NOTE: Every worker gets a connection of its own, so that no call waits for one, and the connections to the website of every
+    # company in flight are kept open. The sites of a company are run by the pool of their step (see StagedExecutor.map()), so the
+    # pools bound the calls in flight.
+    clients.configure({"http": max(pools["http"], args.max_in_flight), "maps": pools["maps"], "gemini": pools["gemini"]})
+    clients.use_cassette(cassette)
+
+    checkpoint_store = CheckpointStore(args.checkpoint_dir)
+    # NOTE: Shared by every company, so that a location referenced by several companies is only geocoded and imaged once.
+    location_index = LocationIndex()
+    report_store = ReportStore(args.report_db) if args.report_db else None
+    companies = load_portfolio(args.portfolio)
+    pipelines = [ResearchPipeline(company["company_name"], company["company_url"], checkpoint_store, resume=args.resume, refresh=args.refresh,
+                                  max_sites=args.max_sites, context_caching=args.context_cache, deadline_s=args.deadline, location_index=location_index,
+                                  report_store=report_store) for company in companies]
+
+    def write_report(company: dict, future) -> None:
+        # NOTE: Called by the worker that finished the company, so that each report is written as soon as it is ready.
+        try:
+            pipeline = future.result()
+            pipeline.write_report(pipeline.report)
+            print(f"Finished research for: {company['company_name']}")
+        except Exception as e:
+            # NOTE: One failing company should not stop the rest of the portfolio. Its completed stages are checkpointed,
+            # so it can be picked up again with --resume.
+            logging.error(f"Research for {company['company_name']} failed: {e}")
+
+    with StagedExecutor(ResearchPipeline.STEPS, ResearchPipeline.run_step, pools, max_in_flight=args.max_in_flight, max_queued=args.max_queued,
+                        max_in_flight_bytes=int(args.max_in_flight_mb * 1024 * 1024), size=ResearchPipeline.state_size) as executor:
+        for company, pipeline in zip(companies, pipelines):
+            print(f"Starting research for: {company['company_name']}")
+            print(f"Company URL: {company['company_url']}")
+            pipeline.start()
+            executor.submit(pipeline).add_done_callback(lambda future, company=company: write_report(company, future))
+
+    summaries = [pipeline.summary() for pipeline in pipelines]
+
+    print("\n----- What changed / what was reused -----")
+    print("\n".join(summaries))
+
+    print("\n----- Step utilisation and queue wait -----")
+    print(executor.format_stats())
+
+    print("\n----- Connection reuse -----")
+    print(clients.format_stats())
+
+    if cassette:
+        cassette.save()
+        print("\n----- Cassette -----")
+        print(cassette.format_summary())
+
+    location_stats = location_index.stats()
+    print(f"\n{location_stats['locations']} distinct locations referenced {location_stats['references']} times, "
+          f"{location_stats['shared_locations']} of them by more than one company:")
+    for location in location_index.shared_locations():
+        print(f"  - {location['address']}: {', '.join(location['companies'])}")
+
+    quota = QuotaManager.shared()
+    if quota:
+        print("\nRemaining rate limit headroom (shared by every process using the quota database):")
+        for bucket in quota.headroom():
+            print(f"  - {bucket['bucket']}: {bucket['remaining']:g} of {bucket['capacity']:g} ({bucket['remaining_share']:.0%})")
+
+    if args.metrics:
+        clients.export_metrics()
+        json_path, prometheus_path = metrics.write_reports(args.metrics)
+        print(f"Metrics written to {json_path} and {prometheus_path}")
+        print(metrics.format_stage_costs())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# The pipeline modules live in the parent directory
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("GOOGLE_GEMINI_API_KEY", "benchmark")
+
+from fakes import FakeGenaiClient, FaultProfile, fake_clients
+from GeminiAPI import *
+
+# NOTE: This benchmark fires many Gemini calls from many threads at a fake model that serves a limited number of calls at once
+# and rejects the rest with 429, like the real API once the quota is used up. It compares fixed concurrency limits against the
+# adaptive limiter, reporting the throughput, the 429s received, the time spent queueing and the limit the adaptive limiter settled on.
+
+
+def measure(limiter_settings: dict, calls: int, threads: int) -> dict:
+    """
+    Makes the given number of calls with one limiter setting.
+
+    Args:
+        limiter_settings (dict): The settings of the limiter (see AdaptiveLimiter).
+        calls (int): The number of calls to make.
+        threads (int): The number of threads making calls at once.
+
+    Returns:
+        dict: The throughput of successful calls, 429s, retries, queue wait and final limit for this setting.
+    """
+    GeminiAPI.LIMITER_SETTINGS = limiter_settings
+    GeminiAPI._limiters = {}
+    FakeGenaiClient.rejected = 0
+    llm = GeminiAPI("gemini-2.5-flash")
+    first_call = metrics.calls_recorded
+
+    def call(i: int) -> None:
+        # Calls still rejected after every retry are counted as failed rather than stopping the benchmark
+        try:
+            llm.generate_content(f"Benchmark prompt {i}")
+        except Exception:
+            pass
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(call, range(calls)))
+    duration = time.perf_counter() - start
+
+    recorded = metrics.calls_since(first_call)
+    return {
+        "successful_calls_per_s": round(sum(1 for call in recorded if not call["error"]) / duration, 2),
+        "rejected_429": FakeGenaiClient.rejected,
+        "failed": sum(1 for call in recorded if call["error"]),
+        "retries": sum(call["retries"] for call in recorded),
+        "median_queue_wait_s": round(statistics.median(call["queue_wait_s"] for call in recorded), 4),
+        "final_limit": GeminiAPI.limiter("gemini-2.5-flash").limit
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of fixed against adaptive Gemini concurrency under a quota')
+    parser.add_argument('--capacity', type=int, default=8, help='Calls the fake model serves at once, beyond which it returns 429 (default: 8)')
+    parser.add_argument('--calls', type=int, default=400, help='Calls per setting (default: 400)')
+    parser.add_argument('--threads', type=int, default=32, help='Threads making calls at once (default: 32)')
+    parser.add_argument('--fixed', type=int, nargs='*', default=[2, 8, 32], help='Fixed concurrency limits to compare (default: 2 8 32)')
+    parser.add_argument('--gemini-latency', type=float, default=0.05, help='Median latency of a Gemini call in seconds (default: 0.05)')
+    args = parser.parse_args()
+
+    # Keep the benchmark output readable, and back off on the scale of the fake latency rather than the real one
+    logging.getLogger().setLevel(logging.ERROR)
+    GeminiAPI.RETRY_BACKOFF_S = args.gemini_latency
+
+    settings = {f"fixed_{limit}": {"initial_limit": limit, "min_limit": limit, "max_limit": limit} for limit in args.fixed}
+    settings["adaptive"] = dict(GeminiAPI.LIMITER_SETTINGS)
+
+    with fake_clients(FaultProfile(args.gemini_latency, latency_sigma=0.1, seed=2)):
+        FakeGenaiClient.capacity = args.capacity
+        for name, limiter_settings in settings.items():
+            print(json.dumps({"setting": name, **measure(limiter_settings, args.calls, args.threads)}))
+
+
+if __name__ == "__main__":
+    main()
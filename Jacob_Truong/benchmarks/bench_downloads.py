@@ -0,0 +1,144 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+# The pipeline modules live in the parent directory
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("GOOGLE_GEMINI_API_KEY", "benchmark")
+os.environ.setdefault("GOOGLE_MAPS_API_KEY", "benchmark")
+# Parse in-thread, so that tracemalloc sees the memory of parsing as well
+os.environ["ARCS_PARSER_PROCESSES"] = "0"
+
+from CompanyResearchAgent import *
+
+# NOTE: This benchmark serves hostile pages from a local server (a large PDF behind an innocent-looking link, a huge HTML
+# page, a binary file without a Content-Type, a page that drips in slowly) next to two normal pages, and measures the latency
+# and peak memory of fetching each of them with a plain requests.get (before) and with the streaming download (after).
+
+MB = 1024 * 1024
+BLOCK = (b"<p>" + b"Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 16 + b"</p>\n") * 64
+
+# Path -> (Content-Type header or None, body size in bytes, seconds between chunks)
+PAGES = {
+    "/about": ("text/html; charset=utf-8", 64 * 1024, 0),
+    "/legacy": ("text/html", 64 * 1024, 0),
+    "/products/brochure": ("application/pdf", 40 * MB, 0),
+    "/products/catalogue.pdf": ("application/pdf", 40 * MB, 0),
+    "/products/all": ("text/html; charset=utf-8", 50 * MB, 0),
+    "/download": (None, 20 * MB, 0),
+    "/slow": ("text/html; charset=utf-8", 1 * MB, 0.25)
+}
+
+
+class _HostileHandler(BaseHTTPRequestHandler):
+    """
+    Generates the benchmark pages on the fly, so that no large files are needed.
+    """
+
+    def do_GET(self):
+        content_type, size, delay_s = PAGES.get(self.path, (None, 0, 0))
+        if not size:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        if content_type:
+            self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+
+        if self.path == "/legacy":
+            # Windows-1252 text declared only in a <meta> tag
+            body = ('<html><head><meta charset="windows-1252"></head><body>' + "Café Zürich — 20 Ål Street. " * 2000).encode("cp1252")
+            self.wfile.write(body[:size].ljust(size, b" "))
+            return
+
+        head = b"%PDF-1.7\n" if content_type == "application/pdf" else (b"<html><body>" if content_type else b"\x00\x01binary")
+        sent = 0
+        try:
+            while sent < size:
+                chunk = (head + BLOCK)[:min(len(BLOCK), size - sent)] if not sent else BLOCK[:min(len(BLOCK), size - sent)]
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                if delay_s:
+                    self.wfile.flush()
+                    time.sleep(delay_s)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up on the page
+            pass
+
+    def log_message(self, format, *args):
+        # Keep the benchmark output readable
+        pass
+
+
+def fetch_before(agent: CompanyResearchAgent, url: str) -> dict | None:
+    """Fetches a page the way it was done before: the whole body is buffered and then parsed."""
+    import requests
+
+    try:
+        response = requests.get(url, headers=agent.headers, timeout=10)
+        response.raise_for_status()
+        return page_parser.parse(response.content, agent._declared_charset(response.headers.get("Content-Type", "")))
+    except requests.RequestException:
+        return None
+
+
+def measure(fetch, url: str) -> dict:
+    """
+    Fetches one page and measures it.
+
+    Args:
+        fetch: The function fetching and parsing the page.
+        url (str): The URL of the page.
+
+    Returns:
+        dict: The latency, the peak memory, and the length of the text (with the number of replacement characters in it).
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    page = fetch(url)
+    latency = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    text = page["text"] if page else ""
+    return {"latency_s": round(latency, 3), "peak_memory_mb": round(peak / MB, 1), "text_chars": len(text), "replacement_chars": text.count("�")}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of page downloads against hostile pages')
+    parser.add_argument('--page-seconds', type=float, default=2.0,
+                        help='Longest time a page is downloaded for, in seconds (default: 2, shorter than in production to keep the run short)')
+    args = parser.parse_args()
+
+    # Keep the benchmark output readable
+    logging.getLogger().setLevel(logging.ERROR)
+    CompanyResearchAgent.MAX_PAGE_SECONDS = args.page_seconds
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _HostileHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    agent = CompanyResearchAgent("Benchmark", base_url)
+    try:
+        # Warm up, so that importing requests and bs4 is not part of the first measurement
+        fetch_before(agent, base_url + "/about")
+        for path in PAGES:
+            url = base_url + path
+            before = measure(lambda page_url: fetch_before(agent, page_url), url)
+            after = measure(agent._fetch_page_content, url)
+            print(json.dumps({"page": path, "before": before, "after": after}))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# The pipeline modules live in the parent directory
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fakes import SITES_DIR
+from PageParser import PageParser
+
+# NOTE: This benchmark parses the recorded pages in benchmarks/sites with a varying number of parser processes,
+# while several threads submit pages at once like the workers of a batch run do. It reports the parsing throughput
+# for each setting, so the speed-up from offloading parsing to worker processes can be measured on the target machine.
+
+
+def load_pages(copies: int) -> list[bytes]:
+    """
+    Loads every recorded page as raw bytes.
+
+    Args:
+        copies (int): How many times the set of pages is repeated, to get a workload large enough to time.
+
+    Returns:
+        list[bytes]: The raw HTML of the pages.
+    """
+    pages = [path.read_bytes() for path in sorted(SITES_DIR.glob("*/*.html"))]
+    return pages * copies
+
+
+def measure(pages: list[bytes], processes: int, threads: int) -> dict:
+    """
+    Parses every page with the given number of parser processes.
+
+    Args:
+        pages (list[bytes]): The raw HTML of the pages.
+        processes (int): The number of parser processes (0 parses in the submitting threads).
+        threads (int): The number of threads submitting pages at once.
+
+    Returns:
+        dict: The parsing throughput for this setting.
+    """
+    parser = PageParser(processes)
+    try:
+        # Warm up, so that starting the worker processes is not part of the measurement
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(parser.parse, pages[:max(processes, 1)]))
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(parser.parse, pages))
+        duration = time.perf_counter() - start
+    finally:
+        parser.shutdown()
+
+    return {
+        "processes": processes,
+        "pages": len(pages),
+        "duration_s": round(duration, 3),
+        "pages_per_s": round(len(pages) / duration, 1)
+    }
+
+
+def main():
+    cores = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description='Benchmark of the HTML parsing throughput with and without parser processes')
+    parser.add_argument('--processes', type=int, nargs='*', help=f'Parser process counts to compare (default: 0 up to {cores}, the number of cores)')
+    parser.add_argument('--threads', type=int, default=8, help='Threads submitting pages at once (default: 8)')
+    parser.add_argument('--copies', type=int, default=20, help='Times the set of recorded pages is parsed (default: 20)')
+    args = parser.parse_args()
+
+    process_counts = args.processes if args.processes else sorted({0, 1, *range(2, cores + 1, 2), cores})
+    pages = load_pages(args.copies)
+
+    results = [measure(pages, processes, args.threads) for processes in process_counts]
+    inline = next((result for result in results if result["processes"] == 0), None)
+    for result in results:
+        if inline:
+            result["speed_up"] = round(result["pages_per_s"] / inline["pages_per_s"], 2)
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# The pipeline modules live in the parent directory
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("GOOGLE_GEMINI_API_KEY", "benchmark")
+os.environ.setdefault("GOOGLE_MAPS_API_KEY", "benchmark")
+
+from fakes import FaultProfile, SiteServer, fake_clients
+from ResearchPipeline import *
+
+# NOTE: This benchmark runs the full pipeline offline against the recorded websites in benchmarks/sites and the fake
+# Google Maps and Gemini clients in benchmarks/fakes.py. It measures single-company latency, batch throughput and peak
+# memory, and fails (exit code 1) when any of them regresses against the stored baseline.
+
+BASELINE_PATH = Path(__file__).parent / "baseline.json"
+
+# Whether a higher value of a result is better, used when comparing against the baseline
+HIGHER_IS_BETTER = {
+    "single_company_latency_s": False,
+    "batch_throughput_companies_per_s": True,
+    "peak_memory_mb": False
+}
+
+
+def run_company(site_server: SiteServer, company_slug: str, checkpoint_store: CheckpointStore, copy_index: int = 0, context_caching: bool = False) -> str:
+    """
+    Runs the full pipeline for one recorded company website.
+
+    Args:
+        site_server (SiteServer): The server serving the recorded websites.
+        company_slug (str): The recorded website to research.
+        checkpoint_store (CheckpointStore): Where the pipeline writes its checkpoints.
+        copy_index (int): Distinguishes copies of the same company in a batch, so they do not share output files.
+        context_caching (bool): Whether the pipeline holds the company corpus in a context cache.
+
+    Returns:
+        str: The generated report.
+    """
+    company_name = company_slug.replace("_", " ") + (f" {copy_index}" if copy_index else "")
+    pipeline = ResearchPipeline(company_name, site_server.site_url(company_slug), checkpoint_store, context_caching=context_caching)
+    report = pipeline.run()
+    pipeline.write_report(report)
+    return report
+
+
+def measure(args: argparse.Namespace) -> dict:
+    """
+    Runs the benchmark scenarios.
+
+    Args:
+        args (argparse.Namespace): The parsed command-line arguments.
+
+    Returns:
+        dict: The benchmark results.
+    """
+    site_profile = FaultProfile(args.site_latency, error_rate=args.error_rate, seed=1)
+    gemini_profile = FaultProfile(args.gemini_latency, error_rate=args.error_rate, seed=2)
+    maps_profile = FaultProfile(args.maps_latency, error_rate=args.error_rate, seed=3)
+
+    with SiteServer(profile=site_profile) as site_server, fake_clients(gemini_profile, maps_profile):
+        companies = args.companies if args.companies else site_server.companies()
+        checkpoint_store = CheckpointStore("checkpoints")
+
+        # Scenario 1: Single-company latency, one company at a time
+        latencies = []
+        for _ in range(args.repeat):
+            for company_slug in companies:
+                start = time.perf_counter()
+                run_company(site_server, company_slug, checkpoint_store, context_caching=args.context_cache)
+                latencies.append(time.perf_counter() - start)
+
+        # Scenario 2: Batch throughput and peak memory, with several companies in flight at once
+        batch = [(company_slug, copy_index) for copy_index in range(1, args.batch_copies + 1) for company_slug in companies]
+        tracemalloc.start()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.batch_workers) as executor:
+            list(executor.map(lambda job: run_company(site_server, job[0], checkpoint_store, job[1], args.context_cache), batch))
+        batch_duration = time.perf_counter() - start
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {
+        "config": {
+            "companies": companies,
+            "repeat": args.repeat,
+            "batch_copies": args.batch_copies,
+            "batch_workers": args.batch_workers,
+            "site_latency_s": args.site_latency,
+            "gemini_latency_s": args.gemini_latency,
+            "maps_latency_s": args.maps_latency,
+            "error_rate": args.error_rate,
+            "context_cache": args.context_cache
+        },
+        "results": {
+            "single_company_latency_s": round(statistics.median(latencies), 4),
+            "batch_throughput_companies_per_s": round(len(batch) / batch_duration, 3),
+            "peak_memory_mb": round(peak_memory / 1024 / 1024, 2)
+        }
+    }
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Compares the benchmark results against the baseline.
+
+    Args:
+        current (dict): The results of this run.
+        baseline (dict): The stored baseline results.
+        tolerance (float): The allowed relative regression (e.g. 0.25 for 25%).
+
+    Returns:
+        list[str]: A description of every regression found.
+    """
+    if current["config"] != baseline.get("config"):
+        print("WARNING: The benchmark configuration differs from the baseline, so the comparison may not be meaningful.")
+
+    regressions = []
+    for name, higher_is_better in HIGHER_IS_BETTER.items():
+        value = current["results"][name]
+        reference = baseline.get("results", {}).get(name)
+        if not reference:
+            continue
+
+        change = (value - reference) / reference
+        regressed = change < -tolerance if higher_is_better else change > tolerance
+        print(f"{name}: {value} (baseline {reference}, {change:+.1%}){'  <-- REGRESSION' if regressed else ''}")
+        if regressed:
+            regressions.append(f"{name} regressed by {abs(change):.1%} (allowed {tolerance:.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline end-to-end benchmark of the research pipeline')
+    parser.add_argument('--companies', nargs='*', help='Recorded websites to use (default: all of benchmarks/sites)')
+    parser.add_argument('--repeat', type=int, default=3, help='Single-company runs per company (default: 3)')
+    parser.add_argument('--batch-copies', type=int, default=4, help='Copies of each company in the batch scenario (default: 4)')
+    parser.add_argument('--batch-workers', type=int, default=8, help='Companies in flight at once in the batch scenario (default: 8)')
+    parser.add_argument('--site-latency', type=float, default=0.005, help='Median latency of a page response in seconds (default: 0.005)')
+    parser.add_argument('--gemini-latency', type=float, default=0.05, help='Median latency of a Gemini call in seconds (default: 0.05)')
+    parser.add_argument('--maps-latency', type=float, default=0.01, help='Median latency of a Maps call in seconds (default: 0.01)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Probability of any fake call failing (default: 0)')
+    parser.add_argument('--context-cache', action='store_true', help='Run the pipeline with Gemini context caching against the fake cache service')
+    parser.add_argument('--baseline', default=str(BASELINE_PATH), help='Baseline file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed relative regression (default: 0.25)')
+    parser.add_argument('--update-baseline', action='store_true', help='Store the results of this run as the new baseline')
+    parser.add_argument('--output', help='Also write the results of this run to this JSON file')
+    args = parser.parse_args()
+
+    # Keep the benchmark output readable
+    logging.getLogger().setLevel(logging.WARNING)
+
+    # The pipeline writes its checkpoints, images and reports relative to the working directory
+    baseline_path = Path(args.baseline).resolve()
+    output_path = Path(args.output).resolve() if args.output else None
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir)
+        current = measure(args)
+
+    print(json.dumps(current["results"], indent=2))
+    if output_path:
+        output_path.write_text(json.dumps(current, indent=2), encoding="utf-8")
+
+    if args.update_baseline:
+        baseline_path.write_text(json.dumps(current, indent=2) + "\n", encoding="utf-8")
+        print(f"Baseline written to {baseline_path}")
+        return
+
+    if not baseline_path.exists():
+        print(f"No baseline found at {baseline_path}. Run with --update-baseline to create one.")
+        return
+
+    regressions = compare(current, json.loads(baseline_path.read_text(encoding="utf-8")), args.tolerance)
+    if regressions:
+        print("FAILED: " + "; ".join(regressions))
+        sys.exit(1)
+    print("OK: No regressions against the baseline.")
+
+
+if __name__ == "__main__":
+    main()
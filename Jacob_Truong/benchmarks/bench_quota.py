@@ -0,0 +1,91 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# The pipeline modules live in the parent directory
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("GOOGLE_MAPS_API_KEY", "benchmark")
+
+# NOTE: This benchmark starts several processes that each geocode addresses as fast as they can, like several batch runs on
+# one machine, and measures the combined query rate against the per-project limit: once with every process on its own,
+# and once with all of them drawing from a shared quota database. Geocoding is used as its limit is per second, so a short
+# run shows the steady rate rather than the burst of a per-minute bucket. The Gemini buckets work the same way.
+
+
+def worker(calls: int, quota_db: str | None, limits_path: str, results: "multiprocessing.Queue") -> None:
+    """
+    Makes the given number of geocoding calls in one process.
+
+    Args:
+        calls (int): The number of calls to make.
+        quota_db (str | None): The shared quota database, or None to run without one.
+        limits_path (str): The JSON file with the rate limits of the quota.
+        results (multiprocessing.Queue): Where to put the time of each call.
+    """
+    if quota_db:
+        os.environ["ARCS_QUOTA_DB"] = quota_db
+        os.environ["ARCS_QUOTA_LIMITS"] = limits_path
+
+    from fakes import FaultProfile, fake_clients
+    from GoogleMapsAPI import GoogleMapsAPI, logging
+    logging.getLogger().setLevel(logging.ERROR)
+
+    with fake_clients(maps_profile=FaultProfile(0.005, latency_sigma=0, seed=os.getpid())):
+        maps_client = GoogleMapsAPI()
+        for i in range(calls):
+            maps_client.extract_location_info_from_address(f"{i} Main Street, Tyler, TX 75701")
+            results.put(time.time())
+
+
+def measure(processes: int, calls: int, quota_db: str | None, limits_path: str) -> dict:
+    """
+    Runs the worker processes and measures the combined request rate.
+
+    Args:
+        processes (int): The number of processes.
+        calls (int): The number of calls per process.
+        quota_db (str | None): The shared quota database, or None to run without one.
+        limits_path (str): The JSON file with the rate limits of the quota.
+
+    Returns:
+        dict: The queries per second over the whole run and in the busiest second.
+    """
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    workers = [context.Process(target=worker, args=(calls, quota_db, limits_path, results)) for _ in range(processes)]
+    for process in workers:
+        process.start()
+    call_times = sorted(results.get() for _ in range(processes * calls))
+    for process in workers:
+        process.join()
+
+    duration = max(call_times[-1] - call_times[0], 1e-9)
+    busiest = max(sum(1 for other in call_times[i:] if other - call_time < 1) for i, call_time in enumerate(call_times))
+    return {"queries_per_s": round(len(call_times) / duration, 1), "busiest_second_queries": busiest}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of several processes sharing one Google Maps rate limit')
+    parser.add_argument('--processes', type=int, default=3, help='Processes making calls at once (default: 3)')
+    parser.add_argument('--calls', type=int, default=100, help='Calls per process (default: 100)')
+    parser.add_argument('--qps', type=int, default=20, help='Geocoding queries per second allowed for the project (default: 20)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        limits_path = str(Path(temp_dir) / "limits.json")
+        with open(limits_path, "w", encoding="utf-8") as f:
+            json.dump({"maps": {"geocode": args.qps}}, f)
+
+        print(f"Limit: {args.qps} geocoding queries per second")
+        for name, quota_db in (("independent", None), ("shared_quota", str(Path(temp_dir) / "quota.db"))):
+            result = measure(args.processes, args.calls, quota_db, limits_path)
+            print(json.dumps({"setting": name, **result}))
+
+
+if __name__ == "__main__":
+    main()
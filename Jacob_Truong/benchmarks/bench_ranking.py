@@ -0,0 +1,94 @@
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+# The pipeline modules live in the parent directory
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("GOOGLE_GEMINI_API_KEY", "benchmark")
+os.environ.setdefault("GOOGLE_MAPS_API_KEY", "benchmark")
+
+from fakes import FakeGenaiClient, FaultProfile, SiteServer, fake_clients
+from CompanyResearchAgent import *
+from SummaryAgent import *
+from PassageRanker import *
+
+# NOTE: This benchmark compares the background and products summarisation calls with all scraped text (before) against
+# only the passages selected by the PassageRanker (after), for a range of token budgets. It reports the prompt tokens and
+# the latency of each call, including the ranking itself. The fake Gemini client is slowed down per prompt token, like the real model.
+
+STAGES = {
+    "background": ("background_text", "summarise_background"),
+    "products": ("products_text", "list_products_services")
+}
+
+
+def measure_call(summary_agent: SummaryAgent, stage: str, text: str, ranker: PassageRanker | None, repeat: int) -> dict:
+    """
+    Runs one summarisation call several times, with or without passage selection.
+
+    Args:
+        summary_agent (SummaryAgent): The agent making the call.
+        stage (str): The stage (background or products).
+        text (str): All text scraped for the stage.
+        ranker (PassageRanker | None): The ranker selecting the passages, or None to send all text.
+        repeat (int): The number of runs.
+
+    Returns:
+        dict: The prompt tokens and median latency of the call.
+    """
+    method = getattr(summary_agent, STAGES[stage][1])
+    latencies = []
+    for _ in range(repeat):
+        first_call = metrics.calls_recorded
+        start = time.perf_counter()
+        method(ranker.select(text, stage) if ranker else text)
+        latencies.append(time.perf_counter() - start)
+
+    return {"prompt_tokens": metrics.calls_since(first_call)[0]["prompt_tokens"], "latency_s": round(statistics.median(latencies), 4)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the prompt tokens and latency saved by local passage ranking')
+    parser.add_argument('--companies', nargs='*', help='Recorded websites to use (default: all of benchmarks/sites)')
+    parser.add_argument('--budgets', type=int, nargs='*', default=[4000, 1000, 500], help='Token budgets to compare (default: 4000 1000 500)')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per call (default: 3)')
+    parser.add_argument('--gemini-latency', type=float, default=0.05, help='Median latency of a Gemini call in seconds (default: 0.05)')
+    parser.add_argument('--latency-per-1k-tokens', type=float, default=0.1, help='Extra Gemini latency per 1,000 prompt tokens in seconds (default: 0.1)')
+    args = parser.parse_args()
+
+    # Keep the benchmark output readable
+    logging.getLogger().setLevel(logging.WARNING)
+
+    with SiteServer() as site_server, fake_clients(FaultProfile(args.gemini_latency, latency_sigma=0, seed=2)):
+        FakeGenaiClient.latency_per_1k_prompt_tokens_s = args.latency_per_1k_tokens
+        companies = args.companies if args.companies else site_server.companies()
+
+        totals = {}
+        for company_slug in companies:
+            page_texts = CompanyResearchAgent(company_slug, site_server.site_url(company_slug)).collect_page_texts()
+            summary_agent = SummaryAgent(company_slug)
+
+            for stage, (text_key, _) in STAGES.items():
+                text = page_texts[text_key]
+                results = {"before": measure_call(summary_agent, stage, text, None, args.repeat)}
+                for budget in args.budgets:
+                    results[f"budget_{budget}"] = measure_call(summary_agent, stage, text, PassageRanker(token_budget=budget), args.repeat)
+                print(json.dumps({"company": company_slug, "stage": stage, **results}))
+
+                for name, result in results.items():
+                    total = totals.setdefault(name, {"prompt_tokens": 0, "latency_s": 0.0})
+                    total["prompt_tokens"] += result["prompt_tokens"]
+                    total["latency_s"] = round(total["latency_s"] + result["latency_s"], 4)
+
+    print("\nTotals over every company and stage:")
+    for name, total in totals.items():
+        saved = 1 - total["prompt_tokens"] / totals["before"]["prompt_tokens"]
+        print(f"  {name}: {total['prompt_tokens']} prompt tokens ({saved:.0%} saved), {total['latency_s']}s")
+
+
+if __name__ == "__main__":
+    main()
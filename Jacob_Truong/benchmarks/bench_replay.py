@@ -0,0 +1,131 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# The pipeline modules live in the parent directory
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("GOOGLE_GEMINI_API_KEY", "benchmark")
+os.environ.setdefault("GOOGLE_MAPS_API_KEY", "benchmark")
+
+from fakes import FaultProfile, SiteServer, fake_clients
+from Cassette import Cassette
+from ClientRegistry import clients
+from ResearchPipeline import *
+
+# NOTE: This benchmark records the full pipeline against the recorded websites in benchmarks/sites and the fake Google Maps
+# and Gemini clients into one cassette per company, then replays it with the website server stopped and the fakes removed.
+# It fails (exit code 1) when a replayed report differs from the recorded one, or when a request misses the cassettes.
+
+
+def run_companies(company_urls: dict[str, str], cassette: Cassette, checkpoint_dir: str, context_caching: bool) -> tuple[dict[str, str], float]:
+    """
+    Runs the full pipeline for every company, one at a time, with the API clients recording into or replaying from a cassette.
+
+    Args:
+        company_urls (dict[str, str]): The URL of each company, by company name.
+        cassette (Cassette): The cassette to record into or replay from.
+        checkpoint_dir (str): Where the pipeline writes its checkpoints, so that the recording and the replay do not share any.
+        context_caching (bool): Whether the pipeline holds the company corpus in a context cache.
+
+    Returns:
+        tuple[dict[str, str], float]: The report of each company, and the time taken in seconds.
+    """
+    clients.reset()
+    clients.use_cassette(cassette)
+    checkpoint_store = CheckpointStore(checkpoint_dir)
+    reports = {}
+    start = time.perf_counter()
+    for company_name, company_url in company_urls.items():
+        pipeline = ResearchPipeline(company_name, company_url, checkpoint_store, context_caching=context_caching)
+        reports[company_name] = pipeline.run()
+        pipeline.write_report(reports[company_name])
+    return reports, time.perf_counter() - start
+
+
+def measure(args: argparse.Namespace) -> dict:
+    """
+    Records the companies into cassettes and replays them.
+
+    Args:
+        args (argparse.Namespace): The parsed command-line arguments.
+
+    Returns:
+        dict: The benchmark results.
+    """
+    cassette_dir = Path(args.cassette_dir) if args.cassette_dir else Path("cassettes")
+    profiles = (FaultProfile(args.gemini_latency, seed=2), FaultProfile(args.maps_latency, seed=3))
+
+    with SiteServer(profile=FaultProfile(args.site_latency, seed=1)) as site_server, fake_clients(*profiles):
+        companies = args.companies if args.companies else site_server.companies()
+        # NOTE: The URLs are kept for the replay, as the pages are recorded under the port of this server
+        company_urls = {company_slug.replace("_", " "): site_server.site_url(company_slug) for company_slug in companies}
+        recorder = Cassette(str(cassette_dir), Cassette.RECORD)
+        recorded_reports, record_s = run_companies(company_urls, recorder, "record_checkpoints", args.context_cache)
+        recorder.save()
+
+    # Neither the website server nor the fake clients are running any more, so every request has to come from the cassettes
+    player = Cassette(str(cassette_dir), Cassette.REPLAY)
+    try:
+        replayed_reports, replay_s = run_companies(company_urls, player, "replay_checkpoints", args.context_cache)
+    finally:
+        clients.reset()
+        clients.use_cassette(None)
+
+    cassette_files = list(cassette_dir.glob("*.json.gz"))
+    return {
+        "config": {"companies": companies, "context_cache": args.context_cache, "site_latency_s": args.site_latency,
+                   "gemini_latency_s": args.gemini_latency, "maps_latency_s": args.maps_latency},
+        "results": {
+            "record_s": round(record_s, 3),
+            "replay_s": round(replay_s, 3),
+            "replay_speedup": round(record_s / replay_s, 1) if replay_s else None,
+            "cassettes": len(cassette_files),
+            "cassette_kb": round(sum(path.stat().st_size for path in cassette_files) / 1024, 1),
+            "requests_replayed": player.replayed,
+            "misses": len(player.misses),
+            "reports_identical": sum(recorded_reports[name] == replayed_reports.get(name) for name in recorded_reports),
+            "reports": len(recorded_reports)
+        },
+        "misses": player.misses
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Records the pipeline into cassettes and checks that replaying them reproduces every report offline')
+    parser.add_argument('--companies', nargs='*', help='Recorded websites to use (default: all of benchmarks/sites)')
+    parser.add_argument('--site-latency', type=float, default=0.005, help='Median latency of a page response in seconds (default: 0.005)')
+    parser.add_argument('--gemini-latency', type=float, default=0.05, help='Median latency of a Gemini call in seconds (default: 0.05)')
+    parser.add_argument('--maps-latency', type=float, default=0.01, help='Median latency of a Maps call in seconds (default: 0.01)')
+    parser.add_argument('--context-cache', action='store_true', help='Run the pipeline with Gemini context caching against the fake cache service')
+    parser.add_argument('--cassette-dir', default=None, help='Keep the recorded cassettes in this directory (default: a temporary directory)')
+    args = parser.parse_args()
+
+    # Keep the benchmark output readable
+    logging.getLogger().setLevel(logging.WARNING)
+
+    # The pipeline writes its checkpoints, images and reports relative to the working directory
+    if args.cassette_dir:
+        args.cassette_dir = str(Path(args.cassette_dir).resolve())
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir)
+        current = measure(args)
+
+    print(json.dumps(current["results"]))
+    for miss in current["misses"]:
+        print(json.dumps(miss))
+
+    results = current["results"]
+    if results["misses"] or results["reports_identical"] != results["reports"]:
+        print(f"FAILED: {results['reports'] - results['reports_identical']} replayed reports differ from the recording, "
+              f"{results['misses']} requests missed the cassettes")
+        sys.exit(1)
+    print("OK: Every report was reproduced from the cassettes.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# The pipeline modules live in the parent directory
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("GOOGLE_GEMINI_API_KEY", "benchmark")
+os.environ.setdefault("GOOGLE_MAPS_API_KEY", "benchmark")
+# Parse in-thread, so that tracemalloc sees the memory of parsing as well
+os.environ["ARCS_PARSER_PROCESSES"] = "0"
+
+from fakes import SiteServer
+from CompanyResearchAgent import *
+
+# NOTE: This benchmark collects the background, products and contact text of the recorded websites and of a generated large
+# website (many pages, each repeating a large navigation and footer), once the way it was done before (every page of every
+# category fetched and appended with +=) and once with the streaming collection. It reports the peak memory (tracemalloc)
+# per company and for several companies collected at once, with the pages fetched and the characters kept.
+
+MB = 1024 * 1024
+
+
+def write_large_site(site_dir: Path, pages: int, page_kb: int) -> None:
+    """
+    Writes a large website with the given number of pages per category.
+
+    Args:
+        site_dir (Path): The directory of the website.
+        pages (int): The number of pages per category.
+        page_kb (int): The approximate size of each page in KB.
+    """
+    site_dir.mkdir(parents=True, exist_ok=True)
+    names = [f"{category}-{i}" for category in ("about", "products", "locations") for i in range(pages)]
+    navigation = "".join(f'<li><a href="{name}">{name.replace("-", " ").title()}</a></li>' for name in names)
+    footer = "<footer>" + "<p>Large Benchmark Ltd, 1 Example Road, Tyler, TX 75701. All rights reserved.</p>" * 50 + "</footer>"
+    (site_dir / "index.html").write_text(f"<html><body><ul>{navigation}</ul><p>Welcome to Large Benchmark.</p>{footer}</body></html>", encoding="utf-8")
+
+    for name in names:
+        paragraphs = []
+        size = 0
+        i = 0
+        while size < page_kb * 1024:
+            paragraph = f"<p>{name} paragraph {i}: Large Benchmark designs, manufactures and installs industrial equipment since 19{i % 100:02d}.</p>"
+            paragraphs.append(paragraph)
+            size += len(paragraph)
+            i += 1
+        (site_dir / f"{name}.html").write_text(f"<html><body><ul>{navigation}</ul>{''.join(paragraphs)}{footer}</body></html>", encoding="utf-8")
+
+
+def collect_before(agent: CompanyResearchAgent) -> dict:
+    """Collects the page texts the way it was done before: every page of every category is fetched, and appended with +=."""
+    key_urls = agent.find_key_page_urls_many()
+    texts = {"background_text": "", "products_text": "", "contact_text": ""}
+    for category in ("background", "products", "contact"):
+        for url in key_urls.get(category, []):
+            texts[f"{category}_text"] += "\n" + agent.extract_text_from_url(url)
+    return texts
+
+
+def measure(collect, site_urls: list[str]) -> dict:
+    """
+    Collects the page texts of one or more companies at once and measures the peak memory.
+
+    Args:
+        collect: The function collecting the page texts of an agent.
+        site_urls (list[str]): The websites, collected at the same time.
+
+    Returns:
+        dict: The peak memory, duration, pages fetched and characters kept.
+    """
+    agents = [CompanyResearchAgent(f"Company {i}", site_url) for i, site_url in enumerate(site_urls)]
+    first_call = metrics.calls_recorded
+    tracemalloc.start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(agents)) as executor:
+        results = list(executor.map(collect, agents))
+    duration = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    fetches = sum(1 for call in metrics.calls_since(first_call) if call["kind"] == "http")
+    return {"peak_memory_mb": round(peak / MB, 1), "duration_s": round(duration, 2), "pages_fetched": fetches,
+            "chars_kept": sum(len(text) for result in results for text in result.values())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the peak memory of collecting the research text')
+    parser.add_argument('--pages', type=int, default=20, help='Pages per category of the generated large website (default: 20)')
+    parser.add_argument('--page-kb', type=int, default=300, help='Size of each page of the generated large website in KB (default: 300)')
+    parser.add_argument('--concurrency', type=int, default=4, help='Companies collected at once in the batch measurement (default: 4)')
+    args = parser.parse_args()
+
+    # Keep the benchmark output readable
+    logging.getLogger().setLevel(logging.ERROR)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        sites_dir = Path(temp_dir)
+        for site in (Path(__file__).resolve().parent / "sites").iterdir():
+            if site.is_dir():
+                (sites_dir / site.name).symlink_to(site, target_is_directory=True)
+        write_large_site(sites_dir / "large_benchmark", args.pages, args.page_kb)
+
+        with SiteServer(sites_dir) as site_server:
+            for company in site_server.companies():
+                site_urls = [site_server.site_url(company)]
+                print(json.dumps({"company": company, "before": measure(collect_before, site_urls),
+                                  "after": measure(CompanyResearchAgent.collect_page_texts, site_urls)}))
+
+            site_urls = [site_server.site_url("large_benchmark")] * args.concurrency
+            print(json.dumps({"company": f"large_benchmark x {args.concurrency} at once", "before": measure(collect_before, site_urls),
+                              "after": measure(CompanyResearchAgent.collect_page_texts, site_urls)}))
+
+
+if __name__ == "__main__":
+    main()
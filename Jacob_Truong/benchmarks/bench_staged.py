@@ -0,0 +1,107 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# The pipeline modules live in the parent directory
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("GOOGLE_GEMINI_API_KEY", "benchmark")
+os.environ.setdefault("GOOGLE_MAPS_API_KEY", "benchmark")
+
+from fakes import FaultProfile, SiteServer, fake_clients
+from ResearchPipeline import *
+from StagedExecutor import StagedExecutor
+
+# NOTE: This benchmark runs a batch of copies of the recorded companies against the fake services three ways: one company after
+# another (as batch_run.py did before), one whole company per thread, and through the StagedExecutor with one pool per resource.
+# It reports the throughput and peak memory of each, and the pool utilisation and queue wait of the staged run.
+
+
+def make_pipelines(site_server: SiteServer, companies: list[str], copies: int, checkpoint_dir: str) -> list[ResearchPipeline]:
+    """Builds one pipeline per copy of each company, each with its own empty checkpoint store so that nothing is reused."""
+    checkpoint_store = CheckpointStore(checkpoint_dir)
+    return [ResearchPipeline(f"{company_slug.replace('_', ' ')} {copy_index}", site_server.site_url(company_slug), checkpoint_store)
+            for copy_index in range(copies) for company_slug in companies]
+
+
+def measure(run_batch, pipelines: list[ResearchPipeline]) -> dict:
+    """
+    Runs a batch and measures its throughput and peak memory.
+
+    Args:
+        run_batch (Callable): Runs every pipeline of the batch.
+        pipelines (list[ResearchPipeline]): The pipelines of the batch.
+
+    Returns:
+        dict: The duration, throughput, peak memory and number of failed companies.
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    extra = run_batch(pipelines) or {}
+    duration = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"duration_s": round(duration, 2), "throughput_companies_per_s": round(len(pipelines) / duration, 3),
+            "peak_memory_mb": round(peak / 1024 / 1024, 1), "failed": sum(1 for pipeline in pipelines if pipeline.report is None), **extra}
+
+
+def run_pipeline(pipeline: ResearchPipeline) -> None:
+    """Runs one pipeline, leaving a failed company without a report."""
+    try:
+        pipeline.run()
+    except Exception:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of running a batch of companies through the staged executor')
+    parser.add_argument('--copies', type=int, default=4, help='Copies of each recorded company in the batch (default: 4)')
+    parser.add_argument('--workers', type=int, default=8, help='Threads of the company-per-thread run (default: 8)')
+    parser.add_argument('--pool', nargs='+', default=["http=4", "gemini=8", "maps=4"], metavar='RESOURCE=N',
+                        help='Workers of each pool of the staged run (default: http=4 gemini=8 maps=4)')
+    parser.add_argument('--max-in-flight', type=int, default=8, help='Companies in flight at once in the staged run (default: 8)')
+    parser.add_argument('--site-latency', type=float, default=0.05, help='Median latency of a page fetch in seconds (default: 0.05)')
+    parser.add_argument('--gemini-latency', type=float, default=0.3, help='Median latency of a Gemini call in seconds (default: 0.3)')
+    parser.add_argument('--maps-latency', type=float, default=0.05, help='Median latency of a Maps call in seconds (default: 0.05)')
+    args = parser.parse_args()
+
+    # Keep the benchmark output readable
+    logging.getLogger().setLevel(logging.ERROR)
+    pools = {resource: int(count) for resource, _, count in (pool.partition("=") for pool in args.pool)}
+
+    def sequential(pipelines):
+        for pipeline in pipelines:
+            run_pipeline(pipeline)
+
+    def company_per_thread(pipelines):
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            list(executor.map(run_pipeline, pipelines))
+
+    def staged(pipelines):
+        with StagedExecutor(ResearchPipeline.STEPS, ResearchPipeline.run_step, pools, max_in_flight=args.max_in_flight,
+                            size=ResearchPipeline.state_size) as executor:
+            for pipeline in pipelines:
+                pipeline.start()
+                executor.submit(pipeline)
+        stats = executor.stats()
+        return {"pool_utilisation": {resource: resource_stats["utilisation"] for resource, resource_stats in stats["resources"].items()},
+                "mean_queue_wait_s": {stage: stage_stats["mean_queue_wait_s"] for stage, stage_stats in stats["stages"].items()},
+                "admission_wait_s": stats["admission_wait_s"]}
+
+    site_profile = FaultProfile(args.site_latency, seed=1)
+    with SiteServer(profile=site_profile) as site_server, fake_clients(FaultProfile(args.gemini_latency, seed=2), FaultProfile(args.maps_latency, seed=3)):
+        companies = site_server.companies()
+        for name, run_batch in (("sequential", sequential), (f"company_per_thread x {args.workers}", company_per_thread),
+                                (f"staged {' '.join(args.pool)}", staged)):
+            with tempfile.TemporaryDirectory() as checkpoint_dir:
+                pipelines = make_pipelines(site_server, companies, args.copies, checkpoint_dir)
+                print(json.dumps({"mode": name, "companies": len(pipelines), **measure(run_batch, pipelines)}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import argparse
+import json
+import os
+import statistics
+import struct
+import sys
+import tempfile
+import time
+import zlib
+from pathlib import Path
+
+# The pipeline modules live in the parent directory
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("GOOGLE_GEMINI_API_KEY", "benchmark")
+os.environ.setdefault("GOOGLE_MAPS_API_KEY", "benchmark")
+
+from fakes import fake_clients
+from SatelliteAnalysisAgent import *
+
+# NOTE: This benchmark measures the local image triage on the satellite images in satellite_images/ and on unusable variants
+# of them (the grey "no imagery" placeholder, and a tile covered by cloud), reporting how long the triage takes per image and
+# what it measured, and then runs the vision analysis of each image against the stand-in Gemini client to count the calls made.
+
+
+def encode_png(rgb) -> bytes:
+    """
+    Encodes an RGB array as a PNG, with the Up filter on every other row so that the filtered decoding is measured as well.
+
+    Args:
+        rgb (numpy.ndarray): A (height, width, 3) array of uint8.
+
+    Returns:
+        bytes: The PNG file bytes.
+    """
+    import numpy as np
+
+    height, width, _ = rgb.shape
+    rows = rgb.reshape(height, -1)
+    filtered = rows.copy()
+    filtered[1::2] = rows[1::2] - rows[0:-1:2][:len(rows[1::2])]
+    filter_types = np.where(np.arange(height) % 2, 2, 0).astype(np.uint8)[:, None]
+    data = np.hstack([filter_types, filtered]).tobytes()
+
+    def chunk(chunk_type: bytes, body: bytes) -> bytes:
+        return struct.pack(">I", len(body)) + chunk_type + body + struct.pack(">I", zlib.crc32(chunk_type + body) & 0xFFFFFFFF)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(data)) + chunk(b"IEND", b"")
+
+
+def unusable_variants(image_bytes: bytes) -> dict[str, bytes]:
+    """
+    Builds the unusable variants of a satellite image.
+
+    Args:
+        image_bytes (bytes): A real satellite image.
+
+    Returns:
+        dict[str, bytes]: The placeholder and cloud-covered images, by name.
+    """
+    import numpy as np
+
+    rgb = ImageTriage.decode_png(image_bytes)
+    height, width, _ = rgb.shape
+
+    # The grey tile of the Static API where there is no imagery, with a line of darker "text" in the middle
+    placeholder = np.empty_like(rgb)
+    placeholder[:] = (228, 227, 223)
+    placeholder[height // 2 - 6:height // 2 + 6, width // 3:2 * width // 3:3] = (160, 160, 160)
+
+    # A smooth bank of cloud over the image, thinning out towards one corner
+    y, x = np.mgrid[0:height, 0:width]
+    opacity = np.clip(1.6 - (x + y) / (width + height) * 1.2, 0, 1)[:, :, None]
+    clouded = (rgb * (1 - opacity) + np.array([238, 238, 240]) * opacity).astype(np.uint8)
+
+    return {"placeholder": encode_png(placeholder), "cloud": encode_png(clouded)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the local satellite image triage')
+    parser.add_argument('--repeats', type=int, default=20, help='Times each image is measured, the median is reported (default: 20)')
+    parser.add_argument('--images', default=str(Path(__file__).resolve().parent.parent / "satellite_images"),
+                        help='Directory with satellite images (default: satellite_images)')
+    args = parser.parse_args()
+
+    # Keep the benchmark output readable
+    logging.getLogger().setLevel(logging.ERROR)
+
+    images = {path.stem: path.read_bytes() for path in sorted(Path(args.images).glob("*.png"))}
+    if not images:
+        sys.exit(f"No PNG images found in {args.images}")
+    images.update(unusable_variants(next(iter(images.values()))))
+
+    triage = ImageTriage()
+    with tempfile.TemporaryDirectory() as temp_dir, fake_clients():
+        agent = SatelliteAnalysisAgent("Benchmark", "1 Main Street", output_dir=temp_dir, image_triage=triage)
+        for name, image_bytes in images.items():
+            triage.analyse(image_bytes)
+            timings = []
+            for _ in range(args.repeats):
+                start = time.perf_counter()
+                features = triage.analyse(image_bytes, metres_per_pixel=SatelliteAnalysisAgent.METRES_PER_PIXEL)
+                timings.append(time.perf_counter() - start)
+
+            image_path = Path(temp_dir) / f"{name}.png"
+            image_path.write_bytes(image_bytes)
+            first_call = metrics.calls_recorded
+            agent.analyze_visuals_with_llm(str(image_path))
+            gemini_calls = sum(1 for call in metrics.calls_since(first_call) if call["kind"] == "gemini")
+
+            print(json.dumps({"image": name, "triage_median_ms": round(statistics.median(timings) * 1000, 1), "gemini_calls": gemini_calls,
+                              "skipped_because": features["reason"], **{key: features[key] for key in ("water_share", "distance_to_water_m", "vegetation_share",
+                                                                                                       "roof_brightness", "roof_texture", "cloud_share")}}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,411 @@
+import math
+import random
+import re
+import struct
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import googlemaps
+from google import genai
+from google.genai import errors, types
+
+from ClientRegistry import clients
+
+# NOTE: These are local stand-ins for the external services used by the pipeline (company websites, Google Maps and Gemini),
+# so that the whole pipeline can be run and measured offline without spending any API quota.
+
+SITES_DIR = Path(__file__).parent / "sites"
+
+# Matches the address formats used on the recorded websites (US, Australian and Singaporean), standing in for the model's extraction
+ADDRESS_PATTERN = re.compile(
+    r"\b\d{1,5}(?:/\d{1,5})?\s(?:[NSEW]\s)?"
+    r"(?:(?:US\s(?:Hwy\s)?|Hwy\s|Loop\s|FM\s|Interstate\s)\d+|(?:[A-Z][a-z]+\s){1,2}(?:Street|St|Dr|Drive|Blvd|Ave|Avenue|Road|Rd|Hwy|Expy|End\sBlvd|Loop\s\d+))"
+    r"\b[^|]{0,60}?(?:[A-Z]{2}\s\d{5}|[A-Z][a-z]+\s\d{4}\b|Singapore\s\(\d{6}\))"
+)
+
+
+class FaultProfile():
+    """
+    Configurable latency and error distribution of a fake service.
+    Latencies are drawn from a log-normal distribution around the given median, errors are raised with the given probability.
+    """
+
+    def __init__(self, median_latency_s: float = 0.0, latency_sigma: float = 0.25, error_rate: float = 0.0, seed: int | None = None):
+        """
+        Initialise the fault profile.
+
+        Args:
+            median_latency_s (float): The median latency of a call in seconds.
+            latency_sigma (float): The spread of the log-normal latency distribution (0 means a constant latency).
+            error_rate (float): The probability of a call failing, between 0 and 1.
+            seed (int | None): Seed of the random number generator, for reproducible runs.
+        """
+        self.median_latency_s = median_latency_s
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def apply(self) -> bool:
+        """
+        Sleeps for one sampled latency and decides whether the call fails.
+
+        Returns:
+            bool: True if the call should fail.
+        """
+        with self._lock:
+            latency = self.median_latency_s * math.exp(self._random.gauss(0, self.latency_sigma)) if self.median_latency_s else 0.0
+            failed = self._random.random() < self.error_rate
+        if latency:
+            time.sleep(latency)
+        return failed
+
+
+def make_png(width: int = 64, height: int = 48, seed: int = 0) -> bytes:
+    """
+    Builds a valid RGB PNG with a deterministic pattern, used as a stand-in satellite image.
+
+    Args:
+        width (int): The width of the image in pixels.
+        height (int): The height of the image in pixels.
+        seed (int): Changes the pattern, so different addresses get different image bytes.
+
+    Returns:
+        bytes: The PNG file bytes.
+    """
+    rows = []
+    for y in range(height):
+        row = bytearray([0])  # Filter type 0 (none)
+        for x in range(width):
+            row += bytes(((x * 4 + seed) % 256, (y * 5 + seed * 3) % 256, ((x + y) * 2 + seed * 7) % 256))
+        rows.append(bytes(row))
+
+    def chunk(chunk_type: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data) & 0xFFFFFFFF)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(b"".join(rows))) + chunk(b"IEND", b"")
+
+
+class FakeMapsClient():
+    """
+    Stand-in for googlemaps.Client, implementing the geocode and static_map calls used by GoogleMapsAPI.
+    """
+
+    # Shared by every instance, so the benchmark can configure the fake before the pipeline builds its clients
+    profile = FaultProfile()
+    calls = {"geocode": 0, "static_map": 0}
+    _lock = threading.Lock()
+
+    def __init__(self, key: str | None = None, **kwargs):
+        self.key = key
+
+    def _call(self, operation: str) -> None:
+        with self._lock:
+            FakeMapsClient.calls[operation] += 1
+        if self.profile.apply():
+            raise googlemaps.exceptions.Timeout()
+
+    def geocode(self, address: str, **kwargs) -> list:
+        self._call("geocode")
+        # Take the city from the text before the state/postcode, or fall back to the last comma-separated part
+        parts = [part.strip() for part in re.split(r",", address) if part.strip()]
+        city = parts[-2] if len(parts) >= 2 else (parts[0] if parts else "Unknown")
+        return [{
+            "formatted_address": address,
+            "address_components": [
+                {"long_name": city, "short_name": city, "types": ["locality", "political"]},
+                {"long_name": "Benchmark State", "short_name": "BS", "types": ["administrative_area_level_1", "political"]},
+                {"long_name": "Benchmark Country", "short_name": "BC", "types": ["country", "political"]}
+            ],
+            "geometry": {"location": {"lat": 0.0, "lng": 0.0}}
+        }]
+
+    def static_map(self, center: str = "", **kwargs):
+        self._call("static_map")
+        image = make_png(seed=zlib.crc32(str(center).encode("utf-8")) % 251)
+        # The real client streams the image in chunks
+        for start in range(0, len(image), 8192):
+            yield image[start:start + 8192]
+
+
+class _FakeModels():
+    """
+    Stand-in for genai.Client().models, answering each pipeline prompt with a plausible canned response.
+    """
+
+    def __init__(self, client: "FakeGenaiClient"):
+        self._client = client
+
+    @staticmethod
+    def _prompt_text(contents) -> str:
+        if isinstance(contents, str):
+            return contents
+        return "\n".join(part for part in contents if isinstance(part, str))
+
+    @staticmethod
+    def _answer(prompt: str) -> str:
+        if "extract every address" in prompt:
+            # Return every address found in the scraped text, one per line, like the real model would
+            text = prompt.split("--- TEXT ---", 1)[-1]
+            return "\n".join(dict.fromkeys(match.group(0).strip() for match in ADDRESS_PATTERN.finditer(text)))
+        if "contact page" in prompt:
+            # Return the first address found in the scraped text, like the real model would
+            text = prompt.split("--- TEXT ---", 1)[-1]
+            match = ADDRESS_PATTERN.search(text)
+            return match.group(0).strip() if match else ""
+        if "list the main products or services" in prompt:
+            return "\n".join(f"- **Product {i}**: A one-line description. Risk notes: general liability." for i in range(1, 7))
+        if "satellite image" in prompt:
+            return ("Satellite Image Analysis Report\n1. Flood Risk Assessment: No visible water bodies.\n"
+                    "2. Building Condition Analysis:\n- **Roof Condition**: Good.\n- **Structural Integrity**: Sound.\n"
+                    "- **Site Condition**: Tidy.\n3. Disclaimer: Based on imagery only.")
+        if "Format the given information" in prompt:
+            return "# Title: Benchmark - Nature of Operations Report\n" + prompt.split("--- DATA ---", 1)[-1].strip()
+        return " ".join(["The company operates a well-established business with a long operating history."] * 12)
+
+    def generate_content(self, model: str, contents, config=None) -> types.GenerateContentResponse:
+        with self._client._lock:
+            FakeGenaiClient.calls += 1
+            FakeGenaiClient.in_flight[model] = FakeGenaiClient.in_flight.get(model, 0) + 1
+            over_capacity = self._client.capacity is not None and FakeGenaiClient.in_flight[model] > self._client.capacity
+        try:
+            if over_capacity:
+                # Rejected straight away, like the real API once the per-model quota is used up
+                FakeGenaiClient.rejected += 1
+                raise errors.ClientError(429, {"error": {"code": 429, "message": "Resource exhausted.", "status": "RESOURCE_EXHAUSTED"}})
+            return self._generate_content(model, contents, config)
+        finally:
+            with self._client._lock:
+                FakeGenaiClient.in_flight[model] -= 1
+
+    def _generate_content(self, model: str, contents, config=None) -> types.GenerateContentResponse:
+        if self._client.profile.apply():
+            # Fail with either of the two transient errors the real API returns under load
+            if self._client.profile._random.random() < 0.5:
+                raise errors.ClientError(429, {"error": {"code": 429, "message": "Resource exhausted.", "status": "RESOURCE_EXHAUSTED"}})
+            raise errors.ServerError(503, {"error": {"code": 503, "message": "The model is overloaded.", "status": "UNAVAILABLE"}})
+
+        prompt = self._prompt_text(contents)
+        system_instruction = str(getattr(config, "system_instruction", None) or "")
+
+        # Content held in a context cache counts as prompt tokens, of which the cached ones are reported separately
+        cached_text = ""
+        cache_name = getattr(config, "cached_content", None)
+        if cache_name:
+            if system_instruction:
+                raise errors.ClientError(400, {"error": {"code": 400, "message": "CachedContent can not be used with system_instruction.", "status": "INVALID_ARGUMENT"}})
+            cached_text = self._client.caches.cached_text(cache_name)
+
+        # Cached tokens are already processed, so they add no latency
+        if self._client.latency_per_1k_prompt_tokens_s:
+            time.sleep(self._client.latency_per_1k_prompt_tokens_s * len(system_instruction + prompt) / 4 / 1000)
+        answer = self._answer(cached_text + "\n" + prompt if cached_text else prompt)
+        return types.GenerateContentResponse(
+            candidates=[types.Candidate(content=types.Content(role="model", parts=[types.Part(text=answer)]))],
+            usage_metadata=types.GenerateContentResponseUsageMetadata(
+                # Roughly 4 characters per token, like the real tokeniser on English text
+                prompt_token_count=len(system_instruction + cached_text + prompt) // 4 + (258 if not isinstance(contents, str) else 0),
+                cached_content_token_count=len(cached_text) // 4 if cached_text else None,
+                candidates_token_count=len(answer) // 4,
+                thoughts_token_count=len(answer) // 8
+            )
+        )
+
+
+class _FakeCaches():
+    """
+    Stand-in for genai.Client().caches, holding explicit context caches in memory with their expiry time.
+    """
+
+    def __init__(self):
+        self._caches = {}
+        self._lock = threading.Lock()
+        self.created = 0
+        self.deleted = 0
+
+    @staticmethod
+    def _ttl(config) -> timedelta:
+        return timedelta(seconds=float(str(getattr(config, "ttl", None) or "3600s").rstrip("s")))
+
+    def _get_live(self, name: str) -> dict:
+        cache = self._caches.get(name)
+        if cache is None or cache["expire_time"] <= datetime.now(timezone.utc):
+            self._caches.pop(name, None)
+            raise errors.ClientError(404, {"error": {"code": 404, "message": f"CachedContent not found: {name}", "status": "NOT_FOUND"}})
+        return cache
+
+    def _to_cached_content(self, name: str, cache: dict) -> types.CachedContent:
+        return types.CachedContent(name=name, model=cache["model"], display_name=cache["display_name"], expire_time=cache["expire_time"],
+                                   usage_metadata=types.CachedContentUsageMetadata(total_token_count=len(cache["text"]) // 4))
+
+    def cached_text(self, name: str) -> str:
+        """Returns everything held in a cache, as the model would see it."""
+        with self._lock:
+            return self._get_live(name)["text"]
+
+    def create(self, model: str, config=None) -> types.CachedContent:
+        text = str(getattr(config, "system_instruction", None) or "") + "\n" + "\n".join(str(content) for content in (getattr(config, "contents", None) or []))
+        with self._lock:
+            self.created += 1
+            name = f"cachedContents/fake-{self.created}"
+            self._caches[name] = {"model": model, "display_name": getattr(config, "display_name", None), "text": text,
+                                  "expire_time": datetime.now(timezone.utc) + self._ttl(config)}
+            return self._to_cached_content(name, self._caches[name])
+
+    def get(self, name: str, config=None) -> types.CachedContent:
+        with self._lock:
+            return self._to_cached_content(name, self._get_live(name))
+
+    def update(self, name: str, config=None) -> types.CachedContent:
+        with self._lock:
+            cache = self._get_live(name)
+            cache["expire_time"] = datetime.now(timezone.utc) + self._ttl(config)
+            return self._to_cached_content(name, cache)
+
+    def delete(self, name: str, config=None) -> None:
+        with self._lock:
+            self._get_live(name)
+            del self._caches[name]
+            self.deleted += 1
+
+    def live_count(self) -> int:
+        """Counts the caches that were neither deleted nor expired, which would still be billed for storage."""
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            return sum(1 for cache in self._caches.values() if cache["expire_time"] > now)
+
+
+class FakeGenaiClient():
+    """
+    Stand-in for genai.Client.
+    """
+
+    profile = FaultProfile()
+    calls = 0
+    _lock = threading.Lock()
+
+    # Context caches live on the server, so they are shared by every client
+    caches = _FakeCaches()
+
+    # Extra latency per 1,000 prompt tokens, as the real model takes longer to process longer prompts
+    latency_per_1k_prompt_tokens_s = 0.0
+
+    # The number of calls per model the fake serves at once (None for unlimited). Calls beyond it are rejected with 429.
+    capacity = None
+    in_flight = {}
+    rejected = 0
+
+    def __init__(self, api_key: str | None = None, **kwargs):
+        self.api_key = api_key
+        self.models = _FakeModels(self)
+
+
+class _SiteRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Serves the recorded websites, mapping extension-less paths (e.g. /texwin/about) to their .html files.
+    """
+
+    def __init__(self, *args, profile: FaultProfile, **kwargs):
+        self.profile = profile
+        super().__init__(*args, **kwargs)
+
+    def translate_path(self, path: str) -> str:
+        file_path = Path(super().translate_path(path))
+        if not file_path.exists() and file_path.with_suffix(".html").exists():
+            return str(file_path.with_suffix(".html"))
+        return str(file_path)
+
+    def do_GET(self):
+        if self.profile.apply():
+            self.send_error(503, "Service Unavailable")
+            return
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        # Keep the benchmark output readable
+        pass
+
+
+class SiteServer():
+    """
+    A local HTTP server serving the recorded company websites under http://127.0.0.1:<port>/<company_slug>/.
+    """
+
+    def __init__(self, sites_dir: Path = SITES_DIR, profile: FaultProfile | None = None):
+        """
+        Initialise the server. It is started with start() or by using it as a context manager.
+
+        Args:
+            sites_dir (Path): The directory containing one sub-directory per recorded website.
+            profile (FaultProfile | None): The latency and error distribution of the page responses.
+        """
+        self.sites_dir = Path(sites_dir)
+        self.profile = profile if profile else FaultProfile()
+        handler = partial(_SiteRequestHandler, directory=str(self.sites_dir), profile=self.profile)
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def site_url(self, company_slug: str) -> str:
+        return f"{self.base_url}/{company_slug}/"
+
+    def companies(self) -> list[str]:
+        return sorted(path.name for path in self.sites_dir.iterdir() if path.is_dir())
+
+    def start(self) -> "SiteServer":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+@contextmanager
+def fake_clients(gemini_profile: FaultProfile | None = None, maps_profile: FaultProfile | None = None):
+    """
+    Replaces genai.Client and googlemaps.Client with the fakes for the duration of the block. The shared clients of the
+    client registry are dropped on the way in and out, so that the pipeline builds them from the fakes and not the other way round.
+
+    Args:
+        gemini_profile (FaultProfile | None): The latency and error distribution of the fake Gemini calls.
+        maps_profile (FaultProfile | None): The latency and error distribution of the fake Maps calls.
+    """
+    original_genai_client = genai.Client
+    original_maps_client = googlemaps.Client
+    FakeGenaiClient.profile = gemini_profile if gemini_profile else FaultProfile()
+    FakeMapsClient.profile = maps_profile if maps_profile else FaultProfile()
+    FakeGenaiClient.calls = 0
+    FakeGenaiClient.latency_per_1k_prompt_tokens_s = 0.0
+    FakeGenaiClient.capacity = None
+    FakeGenaiClient.in_flight = {}
+    FakeGenaiClient.rejected = 0
+    FakeGenaiClient.caches = _FakeCaches()
+    FakeMapsClient.calls = {"geocode": 0, "static_map": 0}
+
+    genai.Client = FakeGenaiClient
+    googlemaps.Client = FakeMapsClient
+    clients.reset()
+    try:
+        yield
+    finally:
+        genai.Client = original_genai_client
+        googlemaps.Client = original_maps_client
+        clients.reset()
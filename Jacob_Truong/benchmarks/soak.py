@@ -0,0 +1,279 @@
+import argparse
+import gc
+import json
+import linecache
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+# The pipeline modules live in the parent directory
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("GOOGLE_GEMINI_API_KEY", "benchmark")
+os.environ.setdefault("GOOGLE_MAPS_API_KEY", "benchmark")
+# Parse in-thread, so that tracemalloc sees the memory of parsing as well
+os.environ["ARCS_PARSER_PROCESSES"] = "0"
+
+from fakes import SiteServer, fake_clients
+from ResearchPipeline import *
+
+# NOTE: This soak test runs the pipeline over and over against the recorded websites and the fake Google Maps and Gemini
+# clients, the way a long batch or a long-running report service does (one pipeline at a time, a long-lived staged executor,
+# or the report service with its workers), while sampling the RSS of the process and the memory traced by tracemalloc.
+# After the warmup, the growth of both per company researched is measured by least-squares fits over the samples (see
+# growth_per_iteration()), and the test fails (exit code 1) when either exceeds the threshold. The allocations that grew
+# the most between the end of the warmup and the end of the run are written to a report, to find what keeps the memory.
+
+KB = 1024
+
+
+def rss_bytes() -> int:
+    """
+    Gets the resident set size of the process.
+
+    Returns:
+        int: The current RSS in bytes, or the peak RSS where /proc is not available.
+    """
+    try:
+        with open("/proc/self/statm", encoding="ascii") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # NOTE: The peak can only grow, so a leak still shows up as growth, but memory given back does not
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * KB
+
+
+def slope(samples: list[dict], field: str) -> float:
+    """
+    Fits a line through the samples of a measurement with least squares.
+
+    Args:
+        samples (list[dict]): The samples, each with its "iteration" and the measurement.
+        field (str): The measurement (e.g. rss_bytes).
+
+    Returns:
+        float: The growth of the measurement per iteration, or 0 with fewer than two samples.
+    """
+    if len(samples) < 2:
+        return 0.0
+    mean_x = sum(sample["iteration"] for sample in samples) / len(samples)
+    mean_y = sum(sample[field] for sample in samples) / len(samples)
+    covariance = sum((sample["iteration"] - mean_x) * (sample[field] - mean_y) for sample in samples)
+    variance = sum((sample["iteration"] - mean_x) ** 2 for sample in samples)
+    return covariance / variance if variance else 0.0
+
+
+def growth_per_iteration(samples: list[dict], field: str) -> float:
+    """
+    Measures the steady growth of a measurement per iteration.
+
+    Args:
+        samples (list[dict]): The samples, each with its "iteration" and the measurement.
+        field (str): The measurement (e.g. rss_bytes).
+
+    Returns:
+        float: The smaller of the slopes of the first and the second half of the samples.
+    """
+    # NOTE: A leak grows the memory in both halves of the run, while a one-off step (e.g. a dict or an allocator arena
+    # growing once) only shows up in one of them, and would be taken for a leak by a single fit over the whole run
+    half = len(samples) // 2
+    return min(slope(samples[:half], field), slope(samples[half:], field))
+
+
+def company_name(company_slug: str, iteration: int) -> str:
+    """
+    Names the company researched on a recorded website in an iteration, e.g. "texwin 12".
+
+    Args:
+        company_slug (str): The recorded website.
+        iteration (int): The iteration number.
+
+    Returns:
+        str: A company name that is not used by any other iteration.
+    """
+    return f"{company_slug.replace('_', ' ')} {iteration}"
+
+
+@contextmanager
+def iteration_runner(args: argparse.Namespace, site_server: SiteServer, companies: list[str]):
+    """
+    Sets up the long-lived part of the run mode, and yields the function running one iteration of it.
+
+    Args:
+        args (argparse.Namespace): The parsed command-line arguments.
+        site_server (SiteServer): The server serving the recorded websites.
+        companies (list[str]): The recorded websites, one of which (or, in batch and service mode, all of which) is researched per iteration.
+
+    Yields:
+        Callable: Called with the iteration number to run it.
+    """
+    checkpoint_store = CheckpointStore("checkpoints")
+
+    def pipeline_for(company_slug: str, iteration: int) -> ResearchPipeline:
+        # NOTE: The recorded websites are researched under a new company name every iteration, the way a long-running service
+        # sees new companies, so that memory kept per company (e.g. metrics groups) shows up as growth
+        return ResearchPipeline(company_name(company_slug, iteration), site_server.site_url(company_slug), checkpoint_store,
+                                context_caching=args.context_cache)
+
+    if args.mode == "pipeline":
+        def run(iteration: int) -> None:
+            pipeline = pipeline_for(companies[iteration % len(companies)], iteration)
+            pipeline.write_report(pipeline.run())
+        yield run
+
+    elif args.mode == "batch":
+        from StagedExecutor import StagedExecutor
+
+        with StagedExecutor(ResearchPipeline.STEPS, ResearchPipeline.run_step, {"http": 2, "gemini": 2, "maps": 2},
+                            max_in_flight=len(companies), size=ResearchPipeline.state_size, name="soak") as executor:
+            def run(iteration: int) -> None:
+                futures = []
+                for company_slug in companies:
+                    pipeline = pipeline_for(company_slug, iteration)
+                    pipeline.start()
+                    futures.append(executor.submit(pipeline))
+                for future in futures:
+                    pipeline = future.result()
+                    pipeline.write_report(pipeline.report)
+            yield run
+
+    else:
+        from ReportService import ReportService
+
+        # NOTE: The service keeps its latest finished jobs for polling, so only a few are kept, or they would grow through the warmup
+        service = ReportService(workers=2, queue_depth=len(companies), max_finished_jobs=len(companies))
+        service.start()
+        try:
+            def run(iteration: int) -> None:
+                jobs = [service.submit(company_name(company_slug, iteration), site_server.site_url(company_slug)) for company_slug in companies]
+                for job in jobs:
+                    while not job.finished:
+                        job.wait_for_events(len(job.events), timeout=1.0)
+            yield run
+        finally:
+            service.stop()
+
+
+def write_allocation_report(report_path: Path, baseline: tracemalloc.Snapshot, snapshot: tracemalloc.Snapshot, result: dict, top: int) -> None:
+    """
+    Writes the allocations that grew the most between two snapshots, with the traceback of each.
+
+    Args:
+        report_path (Path): The text file to write.
+        baseline (tracemalloc.Snapshot): The snapshot taken at the end of the warmup.
+        snapshot (tracemalloc.Snapshot): The snapshot taken at the end of the run.
+        result (dict): The results of the soak test, written at the top of the report.
+        top (int): The number of allocation sites listed.
+    """
+    lines = [f"Soak test: {json.dumps(result)}", "", f"Top {top} allocation sites by growth since the end of the warmup:", ""]
+    for stat in snapshot.compare_to(baseline, "traceback")[:top]:
+        lines.append(f"{stat.size_diff / KB:+.1f} KB in {stat.count_diff:+d} blocks (now {stat.size / KB:.1f} KB in {stat.count} blocks)")
+        lines.extend(stat.traceback.format(most_recent_first=True))
+        lines.append("")
+    report_path.parent.mkdir(parents=True, exist_ok=True)
+    report_path.write_text("\n".join(lines), encoding="utf-8")
+
+
+def soak(args: argparse.Namespace) -> tuple[dict, tracemalloc.Snapshot, tracemalloc.Snapshot]:
+    """
+    Runs the iterations and samples the memory.
+
+    Args:
+        args (argparse.Namespace): The parsed command-line arguments.
+
+    Returns:
+        tuple[dict, tracemalloc.Snapshot, tracemalloc.Snapshot]: The results, and the snapshots taken at the end of the warmup and of the run.
+    """
+    # NOTE: The metrics keep the latest call records up to a bound, which a short warmup would not fill, so that bound is
+    # lowered here for its growth to stop within the warmup rather than look like a leak
+    metrics.MAX_CALLS = 1000
+    # Likewise for the companies aggregated apart, as every iteration researches new ones
+    metrics.MAX_COMPANIES = 20
+
+    samples = []
+    tracemalloc.start(args.traceback_frames)
+    baseline = None
+    start = time.perf_counter()
+
+    with SiteServer() as site_server, fake_clients():
+        companies = args.companies if args.companies else site_server.companies()
+        with iteration_runner(args, site_server, companies) as run:
+            for iteration in range(1, args.warmup + args.iterations + 1):
+                run(iteration)
+                if iteration == args.warmup:
+                    gc.collect()
+                    baseline = tracemalloc.take_snapshot()
+                if iteration >= args.warmup and (iteration - args.warmup) % args.sample_every == 0:
+                    # NOTE: Collected first, so that cycles waiting for the collector are not counted as growth
+                    gc.collect()
+                    traced, _ = tracemalloc.get_traced_memory()
+                    sample = {"iteration": iteration, "rss_bytes": rss_bytes(), "traced_bytes": traced}
+                    samples.append(sample)
+                    print(json.dumps({"iteration": iteration, "rss_mb": round(sample["rss_bytes"] / KB / KB, 2),
+                                      "traced_mb": round(traced / KB / KB, 2), "elapsed_s": round(time.perf_counter() - start, 1)}), flush=True)
+
+        gc.collect()
+        snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    linecache.clearcache()
+
+    companies_per_iteration = 1 if args.mode == "pipeline" else len(companies)
+    result = {
+        "mode": args.mode,
+        "iterations": args.iterations,
+        "warmup": args.warmup,
+        "companies_per_iteration": companies_per_iteration,
+        "rss_growth_kb_per_company": round(growth_per_iteration(samples, "rss_bytes") / companies_per_iteration / KB, 3),
+        "traced_growth_kb_per_company": round(growth_per_iteration(samples, "traced_bytes") / companies_per_iteration / KB, 3),
+        "rss_mb": round(samples[-1]["rss_bytes"] / KB / KB, 2) if samples else None,
+        "traced_mb": round(samples[-1]["traced_bytes"] / KB / KB, 2) if samples else None,
+        "duration_s": round(time.perf_counter() - start, 1)
+    }
+    return result, baseline, snapshot
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Memory soak test of long batch and service runs of the research pipeline')
+    parser.add_argument('--mode', default='pipeline', choices=['pipeline', 'batch', 'service'],
+                        help='Run one pipeline at a time, every company per iteration through one long-lived staged executor, '
+                             'or every company per iteration through one long-lived report service (default: pipeline)')
+    parser.add_argument('--iterations', type=int, default=2000, help='Iterations measured after the warmup (default: 2000)')
+    parser.add_argument('--warmup', type=int, default=50, help='Iterations run before measuring, to fill the caches and pools (default: 50)')
+    parser.add_argument('--sample-every', type=int, default=25, help='Iterations between two memory samples (default: 25)')
+    parser.add_argument('--companies', nargs='*', help='Recorded websites to use (default: all of benchmarks/sites)')
+    parser.add_argument('--context-cache', action='store_true', help='Run the pipeline with Gemini context caching against the fake cache service')
+    parser.add_argument('--max-growth-kb', type=float, default=2.0,
+                        help='Largest allowed growth of the RSS or the traced memory per company researched in KB (default: 2)')
+    parser.add_argument('--top', type=int, default=25, help='Allocation sites listed in the report (default: 25)')
+    parser.add_argument('--traceback-frames', type=int, default=8, help='Frames kept per traced allocation (default: 8)')
+    parser.add_argument('--report', default='soak_report.txt', help='Allocation diff report to write (default: soak_report.txt)')
+    args = parser.parse_args()
+    if args.iterations < 3 * args.sample_every:
+        parser.error("--iterations must cover at least four samples (see --sample-every)")
+
+    # Keep the soak output readable
+    logging.getLogger().setLevel(logging.ERROR)
+
+    # The pipeline writes its checkpoints, images and reports relative to the working directory
+    report_path = Path(args.report).resolve()
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir)
+        result, baseline, snapshot = soak(args)
+
+    write_allocation_report(report_path, baseline, snapshot, result, args.top)
+    print(json.dumps(result))
+    print(f"Allocation diff written to {report_path}")
+
+    growth = max(result["rss_growth_kb_per_company"], result["traced_growth_kb_per_company"])
+    if growth > args.max_growth_kb:
+        print(f"FAILED: Memory grew by {growth} KB per company researched (allowed {args.max_growth_kb} KB)")
+        sys.exit(1)
+    print("OK: Memory growth within the threshold.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,12 @@
 import os
 import sys
 import argparse
-from CompanyResearchAgent import *
-from SummaryAgent import *
-from SatelliteAnalysisAgent import *
-from ReportGeneratorAgent import *
 from dotenv import load_dotenv
+from StructuredLogging import StructuredLogging, structured_logging
+from Cassette import Cassette
+
+# NOTE: The pipeline modules are imported inside main(), after the arguments are parsed, so that --help and
+# argument errors return immediately instead of waiting for the heavy API client libraries to load.
 
 def main():
     load_dotenv()
@@ -16,8 +17,38 @@ def main():
     parser.add_argument('company_url', help='URL of the company website')
     parser.add_argument('-o', '--output', default='company_report.md', 
                        help='Output file name (default: company_report.md)')
-    
+    parser.add_argument('--resume', action='store_true',
+                       help='Skip stages that already have a valid checkpoint from a previous run')
+    parser.add_argument('--refresh', action='store_true',
+                       help='Re-scrape the website and re-download imagery, but only recompute the stages whose inputs changed')
+    parser.add_argument('--checkpoint-dir', default='checkpoints',
+                       help='Directory to store stage checkpoints in (default: checkpoints)')
+    parser.add_argument('--site-workers', type=int, default=4,
+                       help='Sites whose satellite image and analysis run at once (default: 4)')
+    parser.add_argument('--max-sites', type=int, default=None,
+                       help='Only analyse the satellite images of the first N sites; the rest are still listed in the report (default: all)')
+    parser.add_argument('--deadline', type=float, default=None, metavar='SECONDS',
+                       help='Time budget of each company, e.g. 90. Once it runs out, the optional work left is skipped and the report notes what was cut short (default: no limit)')
+    parser.add_argument('--context-cache', action='store_true',
+                       help='Hold each company\'s scraped corpus in a Gemini context cache shared by the background and products calls')
+    parser.add_argument('--report-db', default='reports.db', metavar='PATH',
+                       help='SQLite file indexing every written report for search_reports.py, or "" to not index (default: reports.db)')
+    parser.add_argument('--metrics', nargs='?', const='metrics', default=None, metavar='DIR',
+                       help='Write a JSON run report and a Prometheus textfile with call metrics to DIR (default: metrics)')
+    StructuredLogging.add_arguments(parser)
+    Cassette.add_arguments(parser)
+
     args = parser.parse_args()
+    structured_logging.configure_from_args(args, parser)
+    cassette = Cassette.from_args(args, parser)
+
+    from ResearchPipeline import ResearchPipeline
+    from CheckpointStore import CheckpointStore
+    from ReportStore import ReportStore
+    from ClientRegistry import clients
+    from Metrics import metrics
+
+    clients.use_cassette(cassette)
 
     COMPANY_NAME = args.company_name
     COMPANY_URL = args.company_url
@@ -25,34 +56,33 @@ def main():
     print(f"Starting research for: {COMPANY_NAME}")
     print(f"Company URL: {COMPANY_URL}")
 
-    # Step 1: Company Research
-    company_research_agent = CompanyResearchAgent(COMPANY_NAME, COMPANY_URL)
-    research_info = company_research_agent.run_full_research()
-
-    raw_background = research_info.get("background_text", "No background text available")
-    raw_products = research_info.get("products_text", "No products text available")
-    address = research_info.get("raw_address", "No address found")
-    location_info = research_info.get("location_info", {})
-
-    # Step 2: Summarisation
-    summary_agent = SummaryAgent(COMPANY_NAME)
-
-    background_summary = summary_agent.summarise_background(raw_background)
-    products_summary = summary_agent.list_products_services(raw_products)
-
-    # Step 3: Satellite Analysis
-    satellite_analysis_agent = SatelliteAnalysisAgent(COMPANY_NAME, address)
-    satellite_analysis = satellite_analysis_agent.run_satellite_analysis()
+    # Steps 1 to 4: Research, Summarisation, Satellite Analysis and Report Generation
+    # NOTE: Each stage is checkpointed under the checkpoint directory, so a failed run can be continued with --resume.
+    pipeline = ResearchPipeline(COMPANY_NAME, COMPANY_URL, CheckpointStore(args.checkpoint_dir), resume=args.resume, refresh=args.refresh,
+                                site_workers=args.site_workers, max_sites=args.max_sites, context_caching=args.context_cache, deadline_s=args.deadline,
+                                report_store=ReportStore(args.report_db) if args.report_db else None)
+    try:
+        report = pipeline.run()
 
-    # Step 4: Report Generation
-    report_generator_agent = ReportGeneratorAgent(COMPANY_NAME, address, location_info, background_summary, products_summary, satellite_analysis)
-    report = report_generator_agent.generate_report()
+        # Step 5: Output to Markdown file
+        pipeline.write_report(report)
+    finally:
+        # NOTE: Metrics are also written when a stage fails, as they show where the run got to.
+        if args.metrics:
+            clients.export_metrics()
+            json_path, prometheus_path = metrics.write_reports(args.metrics)
+            print(f"Metrics written to {json_path} and {prometheus_path}")
+            print(metrics.format_stage_costs())
+            print("Connection reuse:")
+            print(clients.format_stats())
+        # NOTE: Whatever was recorded before a stage failed is kept, so that the failure can be replayed.
+        if cassette:
+            cassette.save()
+            print("\n----- Cassette -----")
+            print(cassette.format_summary())
 
-    # Step 5: Output to Markdown file
-    # NOTE: This step can be included in the ReportGeneratorAgent class, but I will keep it separate in this
-    # implementation for the sake of clarity.
-    with open(f"nop_{COMPANY_NAME.lower().replace(' ', '_')}.md", "w", encoding="utf-8") as f:
-        f.write(report)
+    if args.resume or args.refresh:
+        print(pipeline.summary())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,64 @@
+import argparse
+import sys
+
+# NOTE: This searches the report store, which every run of cli.py, batch_run.py and service.py writes its reports to.
+# Reports written before the store existed (or with --report-db "") can be added with the import command.
+
+def main():
+    parser = argparse.ArgumentParser(description='Search the generated reports')
+    parser.add_argument('--report-db', default='reports.db', metavar='PATH',
+                        help='SQLite file the reports are indexed in (default: reports.db)')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    import_parser = commands.add_parser('import', help='Index existing Markdown reports')
+    import_parser.add_argument('paths', nargs='*', help='Report files or glob patterns (default: nop_*.md)')
+
+    search_parser = commands.add_parser('search', help='Search the sections of the latest report of each company')
+    search_parser.add_argument('query', help='Full-text query, e.g. timber, "flood risk" or \'timber OR brick\'')
+    search_parser.add_argument('--section', default=None, help='Only search this section, e.g. Findings or "Products & Services"')
+    search_parser.add_argument('--company', default=None, help='Only search the reports of this company')
+    search_parser.add_argument('--all-runs', action='store_true', help='Search every run of each company, not only its latest report')
+    search_parser.add_argument('--limit', type=int, default=20, help='Maximum number of results (default: 20)')
+
+    show_parser = commands.add_parser('show', help='Print a stored report')
+    show_parser.add_argument('company', nargs='?', default=None, help='The company, whose latest report is printed')
+    show_parser.add_argument('--id', type=int, default=None, help='The id of a specific report (as listed by search)')
+
+    commands.add_parser('list', help='List the companies with stored reports')
+
+    args = parser.parse_args()
+    if args.command == 'show' and args.company is None and args.id is None:
+        parser.error('show needs a company or --id')
+
+    from ReportStore import ReportStore
+
+    store = ReportStore(args.report_db)
+
+    if args.command == 'import':
+        print(f"Imported {store.import_files(args.paths or None)} report files into {args.report_db}")
+
+    elif args.command == 'search':
+        try:
+            results = store.search(args.query, section=args.section, company=args.company, all_runs=args.all_runs, limit=args.limit)
+        except ValueError as e:
+            sys.exit(str(e))
+
+        if not results:
+            print("No matching reports.")
+        for result in results:
+            site = f" - Site {result['site']}: {result['address']}" if result['site'] else ""
+            print(f"[{result['report_id']}] {result['company']} ({result['run_date']}) - {result['section']}{site}")
+            print(f"    {' '.join(result['snippet'].split())}")
+
+    elif args.command == 'show':
+        report = store.get(company=args.company, report_id=args.id)
+        if report is None:
+            sys.exit("No stored report found.")
+        print(report)
+
+    else:
+        for company in store.companies():
+            print(f"{company['company']}: {company['runs']} run(s), latest {company['latest_run_date']}")
+
+if __name__ == "__main__":
+    main()
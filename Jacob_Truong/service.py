@@ -0,0 +1,50 @@
+import argparse
+import os
+from dotenv import load_dotenv
+from StructuredLogging import StructuredLogging, structured_logging
+from Cassette import Cassette
+
+# NOTE: This starts the long-running report service, which keeps one warm set of API clients and caches for every job.
+# See the README for the HTTP endpoints.
+
+def main():
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description='Run the report service (a local HTTP API that queues research jobs)')
+    parser.add_argument('--host', default='127.0.0.1', help='Interface to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on (default: 8080)')
+    parser.add_argument('--workers', type=int, default=2, help='Number of jobs run at the same time (default: 2)')
+    parser.add_argument('--queue-depth', type=int, default=16,
+                       help='Maximum number of jobs waiting to run, further submissions are rejected with 429 (default: 16)')
+    parser.add_argument('--checkpoint-dir', default='checkpoints',
+                       help='Directory to store stage checkpoints in (default: checkpoints)')
+    parser.add_argument('--quota-db', default=None, metavar='PATH',
+                       help='SQLite file holding the Gemini and Maps rate limit budget shared by every process using it (default: ARCS_QUOTA_DB, if set)')
+    parser.add_argument('--report-db', default='reports.db', metavar='PATH',
+                       help='SQLite file indexing every written report for search_reports.py, or "" to not index (default: reports.db)')
+    StructuredLogging.add_arguments(parser)
+    Cassette.add_arguments(parser)
+
+    args = parser.parse_args()
+    structured_logging.configure_from_args(args, parser)
+    cassette = Cassette.from_args(args, parser)
+    if args.quota_db:
+        # NOTE: The API clients pick the shared quota up from the environment.
+        os.environ["ARCS_QUOTA_DB"] = args.quota_db
+
+    from ReportService import ReportService
+    from ClientRegistry import clients
+
+    clients.use_cassette(cassette)
+
+    service = ReportService(workers=args.workers, queue_depth=args.queue_depth, checkpoint_dir=args.checkpoint_dir,
+                            report_db=args.report_db or None)
+    service.serve(args.host, args.port)
+
+    # NOTE: The cassettes are written once the service is stopped, with the requests of every job it ran
+    if cassette:
+        cassette.save()
+        print(cassette.format_summary())
+
+if __name__ == "__main__":
+    main()